@@ -1,8 +1,9 @@
 from langchain.schema import Document
 from langchain_community.vectorstores.chroma import Chroma
-from embedding_function import get_embedding_function
 from dotenv import load_dotenv
+import hashlib
 import os
+import re
 
 load_dotenv()
 
@@ -14,24 +15,160 @@ TERMINAL_LOG_PATH = "oterm/logs"
 
 GIT_PR_PATH = "github/json"
 
+TERMINAL_OFFSETS_PATH = f"{ORION_HOME}/terminal_offsets.json"
+
+# A line of a terminal log that starts a new command: user@host ...$, ~/dir $, a bare $ / % / ❯ / ➜,
+# each optionally after a (virtualenv) prefix. The text typed after it must be the "command" group.
+TERMINAL_PROMPT_PATTERN = os.getenv(
+    "TERMINAL_PROMPT_PATTERN",
+    r"^(?:\([\w.-]+\)\s+)?(?:[\w.-]+@[\w.-]+\S*(?:\s+\S+)?\s*[$%#>]|[~/]\S*\s*[$%]|[$%❯➜])(?:\s+(?P<command>.*))?$",
+)
+
+# Most characters of one command's output that get embedded; the rest is noted as dropped
+TERMINAL_OUTPUT_CHARS = int(os.getenv("TERMINAL_OUTPUT_CHARS", 4000))
+
+# PDF parsing processes, pages parsed per task, and pages split and embedded per add_to_chroma call
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", os.cpu_count() or 1))
+
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", 16))
+
+PDF_EMBED_PAGES = int(os.getenv("PDF_EMBED_PAGES", 64))
+
 CHROMA_PATH = f"{ORION_HOME}/chroma"
 
+SPARSE_INDEX_PATH = f"{ORION_HOME}/sparse_index"
+
+CHUNK_MANIFEST_PATH = f"{ORION_HOME}/ingest_manifest.json"
+
+EMBEDDING_CACHE_PATH = f"{ORION_HOME}/embedding_cache.sqlite3"
+
+EMBEDDING_MODEL = "nomic-embed-text"
+
+# "ollama", or "hash" for the deterministic offline stand-in benchmark.py uses (don't switch an
+# existing store between them: the vectors aren't comparable)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "ollama")
+
+HASH_EMBEDDING_DIM = int(os.getenv("HASH_EMBEDDING_DIM", 384))
+
+# Most texts per embedding batch (one cache write, and the unit of work of one embedding
+# thread), and how many threads embed at once. OllamaEmbeddings sends one request per text,
+# so EMBED_CONCURRENCY is also the number of requests in flight against ollama: match it to
+# the server's OLLAMA_NUM_PARALLEL.
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
+
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", 4))
+
+ANSWER_CACHE_PATH = f"{ORION_HOME}/answer_cache.sqlite3"
+
+# Seconds a cached answer stays valid, how many answers to keep, and how similar (cosine) a
+# query's embedding must be to a cached query's to reuse its answer
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 24 * 60 * 60))
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 512))
+
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", 0.95))
+
+# Weighted reciprocal-rank fusion of dense and sparse results: score = sum(weight / (RRF_K + rank))
+DENSE_WEIGHT = float(os.getenv("DENSE_WEIGHT", 1.0))
+
+SPARSE_WEIGHT = float(os.getenv("SPARSE_WEIGHT", 1.0))
+
+RRF_K = int(os.getenv("RRF_K", 60))
+
+# GitHub PR diffs: characters per diff chunk, and most characters of diff embedded per file and per PR
+DIFF_CHUNK_CHARS = int(os.getenv("DIFF_CHUNK_CHARS", 1500))
+
+DIFF_FILE_BUDGET_CHARS = int(os.getenv("DIFF_FILE_BUDGET_CHARS", 12000))
+
+PR_DIFF_BUDGET_CHARS = int(os.getenv("PR_DIFF_BUDGET_CHARS", 40000))
+
+# Ingest daemon (ingest_daemon.py): where producers reach it, most items pending across all
+# sources before submits wait, items per commit, seconds an item waits for its batch to fill,
+# seconds a submit waits for room before it is refused, and commit attempts per batch
+INGEST_DAEMON_URL = os.getenv("INGEST_DAEMON_URL", "http://localhost:5052")
+
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 10000))
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 200))
+
+INGEST_BATCH_DELAY = float(os.getenv("INGEST_BATCH_DELAY", 2.0))
+
+INGEST_SUBMIT_TIMEOUT = float(os.getenv("INGEST_SUBMIT_TIMEOUT", 30))
+
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", 3))
+
+INGEST_STATS_INTERVAL = float(os.getenv("INGEST_STATS_INTERVAL", 60))
+
 LLM_MODEL = "llama3"
 
+# Most tokens of retrieved context put into the answer prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+
+# Documentation curation: most tokens of new content per LLM prompt, prompts in flight at once,
+# and how many of the most similar docs pages each prompt is shown in full
+CURATION_BATCH_TOKENS = int(os.getenv("CURATION_BATCH_TOKENS", 4000))
+
+CURATION_CONCURRENCY = int(os.getenv("CURATION_CONCURRENCY", 4))
+
+CURATION_CONTEXT_PAGES = int(os.getenv("CURATION_CONTEXT_PAGES", 5))
+
+CURATION_QUEUE_PATH = f"{ORION_HOME}/curation_queue.sqlite3"
+
+DOCS_SNAPSHOT_PATH = f"{ORION_HOME}/docs_snapshot.json"
+
+# Curation worker threads, seconds to wait for more jobs to coalesce with the oldest one,
+# attempts before a job is marked failed, and seconds a claimed job stays leased to its worker
+CURATION_WORKERS = int(os.getenv("CURATION_WORKERS", 2))
+
+CURATION_COALESCE_SECONDS = float(os.getenv("CURATION_COALESCE_SECONDS", 30))
+
+CURATION_MAX_ATTEMPTS = int(os.getenv("CURATION_MAX_ATTEMPTS", 5))
+
+CURATION_LEASE_SECONDS = float(os.getenv("CURATION_LEASE_SECONDS", 15 * 60))
+
+# LLM relevance grading of retrieved candidates: off by default, documents per grading prompt,
+# prompts in flight at once, and how many relevant documents are enough to stop grading
+GRADE_DOCUMENTS = os.getenv("GRADE_DOCUMENTS", "0") == "1"
+
+GRADE_BATCH_SIZE = int(os.getenv("GRADE_BATCH_SIZE", 4))
+
+GRADE_CONCURRENCY = int(os.getenv("GRADE_CONCURRENCY", 4))
+
+GRADE_ENOUGH = int(os.getenv("GRADE_ENOUGH", 6))
+
+GRADE_CACHE_SIZE = 4096
+
 CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
 
+# Query/document pairs per cross-encoder forward pass, seconds of reranking allowed per query,
+# and whether to run the cross-encoder with int8 dynamically quantized linear layers on CPU
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", 16))
 
-def total_documents():
-    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=get_embedding_function())
+RERANK_LATENCY_BUDGET = float(os.getenv("RERANK_LATENCY_BUDGET", 0.5))
+
+RERANK_QUANTIZE = os.getenv("RERANK_QUANTIZE", "1") == "1"
+
+
+def normalize_query(query: str) -> str:
+    """Lowercases query and collapses its whitespace, so trivially different queries share cache keys."""
+    return re.sub(r"\s+", " ", query.strip().lower())
 
-    return len(db.get(include=[])['ids'])
 
+def document_key(document: Document):
+    """Chunk id of a retrieved document, or a hash of its content if it has none."""
+    chunk_id = document.metadata.get("id")
+    if chunk_id:
+        return chunk_id
+    return hashlib.sha256(document.page_content.encode("utf-8")).hexdigest()
 
-def get_all_documents():
-    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=get_embedding_function())
 
+def total_documents(db: Chroma):
+    return len(db.get(include=[])['ids'])
+
+
+def get_all_documents(db: Chroma):
     data = db.get(include=['metadatas', 'documents'])
-    total = total_documents()
+    total = len(data['ids'])
 
     docs = []
     for i in range(total):
@@ -40,4 +177,17 @@ def get_all_documents():
         doc = Document(page_content=content, metadata=metadata)
         docs.append(doc)
 
-    return docs
\ No newline at end of file
+    return docs
+
+
+def get_documents_by_ids(db: Chroma, ids: list[str]):
+    """Fetches just the given chunks, returned in the order of ids. Ids missing from the store are skipped."""
+    if not ids:
+        return []
+    data = db.get(ids=ids, include=['metadatas', 'documents'])
+
+    docs_by_id = {}
+    for chunk_id, content, metadata in zip(data['ids'], data['documents'], data['metadatas']):
+        docs_by_id[chunk_id] = Document(page_content=content, metadata=metadata)
+
+    return [docs_by_id[chunk_id] for chunk_id in ids if chunk_id in docs_by_id]
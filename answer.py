@@ -1,9 +1,12 @@
-from aggregate_documents import LLM_MODEL
+from aggregate_documents import LLM_MODEL, CONTEXT_TOKEN_BUDGET, document_key
 from langchain_community.chat_models import ChatOllama
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
 from langchain.schema import Document
 from get_relevant_docs import get_docs
+from retrieval_context import get_retrieval_context
+from context_packing import pack_context
+from llm_scheduler import get_llm_scheduler, INTERACTIVE
 import argparse
 from datetime import datetime
 from dotenv import load_dotenv
@@ -13,11 +16,9 @@ load_dotenv()
 
 
 """
-Takes in a list of documents and a string question.
-
-Outputs which of those documents are relevant to the question and which are not, both as lists.
+Prompt that turns the retrieved documents and the user question into an answer.
 """
-def response(documents: list[Document], question: str):
+def get_answer_chain():
     # llm = ChatOllama(model=LLM_MODEL, temperature=0)    
     # inference_server_url = "https://api.openai.com/v1"
     
@@ -27,14 +28,7 @@ def response(documents: list[Document], question: str):
     #     openai_api_base=inference_server_url,
     #     temperature=0
     # )
-    inference_server_url = "https://generativelanguage.googleapis.com/v1beta/openai/"
-    
-    llm = ChatOpenAI(
-        model="gemini-2.5-flash",
-        openai_api_key=os.getenv("GEMINI_KEY"),
-        openai_api_base=inference_server_url,
-        temperature=0
-    )
+    llm = get_retrieval_context().llm
 
     prompt = PromptTemplate(
         template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|> You will be given a user query along 
@@ -47,20 +41,53 @@ def response(documents: list[Document], question: str):
         input_variables=["question", "documents"],
     )
 
-    generator = prompt | llm
+    return prompt | llm
+
+
+def format_documents(documents: list[Document], token_budget: int = CONTEXT_TOKEN_BUDGET):
+    packed, stats = pack_context(documents, token_budget)
+    print(
+        f"Context: {stats['tokens_out']} tokens from {stats['documents_out']} spans "
+        f"({stats['documents_in']} chunks, saved {stats['tokens_saved']} tokens, dropped {stats['dropped']})"
+    )
 
     document_text = ""
-    for document in documents:
+    for document in packed:
         doc_content = document.page_content
         doc_source = document.metadata.get("source")
         doc_time = document.metadata.get("time")
         document_text += f"\n Source: {doc_source} Time: {doc_time} \n Content: {doc_content} \n"
 
-    output = generator.invoke({"question": question, "documents": document_text})
+    return document_text
+
+
+"""
+Takes in a list of documents and a string question.
+
+Outputs the LLM's answer to the question, grounded in those documents.
+"""
+def response(documents: list[Document], question: str):
+    generator = get_answer_chain()
+
+    output = get_llm_scheduler().invoke(
+        generator, {"question": question, "documents": format_documents(documents)}, "gemini", INTERACTIVE
+    )
 
     return output.content
 
 
+"""
+Same as response, but yields the answer piece by piece as the LLM produces it.
+"""
+def stream_response(documents: list[Document], question: str):
+    generator = get_answer_chain()
+
+    inputs = {"question": question, "documents": format_documents(documents)}
+    for chunk in get_llm_scheduler().stream(generator, inputs, "gemini", INTERACTIVE):
+        if chunk.content:
+            yield chunk.content
+
+
 def rag_pipeline(query: str):
     formatted_doc_list, docs = get_docs(query)
     output = response(docs, query)
@@ -79,19 +106,94 @@ def format_sorted_docs(doc_list):
 
     return response
 
+"""
+Caches result unless the corpus changed since generation, the context's generation when the
+query was looked up: ingestion may already have invalidated cached answers, and this one was
+retrieved before it. refresh() bumps the generation before invalidating, so a change seen
+only after the write means the invalidation may have missed it, and it is dropped again.
+"""
+def cache_answer(query: str, query_embedding: list[float], docs: list[Document], result: dict, generation):
+    context = get_retrieval_context()
+    if context.generation() != generation:
+        return
+    contents = [document.page_content for document in docs]
+    context.answer_cache.store(
+        query,
+        query_embedding,
+        result,
+        [document_key(document) for document in docs],
+        context.embedding_function.embed_documents(contents) if contents else [],
+        context.sparse_index.text_scorer(contents)(query),
+    )
+    if context.generation() != generation:
+        context.answer_cache.discard(query)
+
+
 def docs_and_response(query: str):
+    context = get_retrieval_context()
+    query_embedding = context.embedding_function.embed_query(query)
+    generation = context.generation()
+    cached = context.answer_cache.lookup(query, query_embedding)
+    if cached is not None:
+        print("Answer cache hit")
+        return cached
+
     formatted_doc_list, output, docs = rag_pipeline(query)
     sort_doc_by_time(docs)
     sorted_docs_response = format_sorted_docs(docs)
 
-    return {"docs": sorted_docs_response, "response": output}
+    result = {"docs": sorted_docs_response, "response": output}
+    cache_answer(query, query_embedding, docs, result, generation)
+    return result
+
+"""
+Streaming version of docs_and_response.
+
+Yields ("docs", sorted_docs_response) as soon as retrieval is done, then ("token", text)
+for every piece of the answer.
+"""
+def stream_docs_and_response(query: str):
+    context = get_retrieval_context()
+    query_embedding = context.embedding_function.embed_query(query)
+    generation = context.generation()
+    cached = context.answer_cache.lookup(query, query_embedding)
+    if cached is not None:
+        print("Answer cache hit")
+        yield "docs", cached["docs"]
+        yield "token", cached["response"]
+        return
+
+    formatted_doc_list, docs = get_docs(query)
+
+    sorted_docs = list(docs)
+    sort_doc_by_time(sorted_docs)
+    sorted_docs_response = format_sorted_docs(sorted_docs)
+    yield "docs", sorted_docs_response
+
+    output = ""
+    for token in stream_response(docs, query):
+        output += token
+        yield "token", token
+
+    cache_answer(query, query_embedding, docs, {"docs": sorted_docs_response, "response": output}, generation)
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("query_text", type=str, help="The query text.")
+    parser.add_argument("--stream", action="store_true", help="Print the answer as it is generated.")
     args = parser.parse_args()
     query_text = args.query_text
 
+    if args.stream:
+        for kind, payload in stream_docs_and_response(query_text):
+            if kind == "docs":
+                print(payload)
+            else:
+                print(payload, end="", flush=True)
+        print()
+        return
+
     formatted_doc_list, output, docs = rag_pipeline(query_text)
     sort_doc_by_time(docs)
 
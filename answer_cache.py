@@ -0,0 +1,155 @@
+"""
+Semantic cache for docs_and_response results, persisted in sqlite.
+
+A query hits the cache either exactly (after normalizing case and whitespace) or when
+its embedding's cosine similarity to a cached query's embedding is at least the
+similarity threshold. Entries expire after ttl seconds, and the least recently used
+ones are evicted beyond max_entries.
+
+Each entry also records how "close" its weakest retrieved document was: the largest
+L2 distance between the query embedding and any document it used (dense_ceiling), and
+the lowest BM25 score of those documents (sparse_floor). A newly ingested chunk that
+beats either bound could have changed the retrieval, so invalidate() drops the entry.
+Entries that used a chunk which has since been deleted are dropped as well.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import numpy as np
+from aggregate_documents import normalize_query
+
+
+class AnswerCache:
+    def __init__(self, path: str, ttl: float, max_entries: int, similarity_threshold: float):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                query TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                result TEXT NOT NULL,
+                doc_ids TEXT NOT NULL,
+                dense_ceiling REAL NOT NULL,
+                sparse_floor REAL NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )"""
+        )
+        self._conn.commit()
+
+    def lookup(self, query: str, query_embedding: list[float]):
+        """Returns the cached result for query or a near-identical one, or None."""
+        now = time.time()
+        key = self._key(query)
+        with self._lock:
+            self._conn.execute("DELETE FROM answers WHERE created < ?", (now - self.ttl,))
+            row = self._conn.execute("SELECT key, result FROM answers WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                rows = self._conn.execute("SELECT key, embedding, result FROM answers").fetchall()
+                if rows:
+                    embeddings = np.stack([np.frombuffer(blob, dtype=np.float64) for _, blob, _ in rows])
+                    similarities = _cosine(embeddings, np.asarray(query_embedding, dtype=np.float64))
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.similarity_threshold:
+                        row = (rows[best][0], rows[best][2])
+
+            if row is not None:
+                self._conn.execute("UPDATE answers SET accessed = ? WHERE key = ?", (now, row[0]))
+            self._conn.commit()
+
+        return json.loads(row[1]) if row is not None else None
+
+    def store(self, query: str, query_embedding: list[float], result: dict, doc_ids: list[str],
+              doc_embeddings: list[list[float]], doc_sparse_scores: list[float]):
+        """
+        Caches result for query. doc_embeddings and doc_sparse_scores describe the documents
+        the answer used and set the bounds invalidate() checks new chunks against.
+        """
+        query_vector = np.asarray(query_embedding, dtype=np.float64)
+        if len(doc_embeddings) > 0:
+            distances = np.linalg.norm(np.asarray(doc_embeddings, dtype=np.float64) - query_vector, axis=1)
+            dense_ceiling = float(np.max(distances))
+        else:
+            dense_ceiling = float("inf")
+        # Documents that only came from dense retrieval score 0 here and say nothing about the sparse cutoff.
+        positive_scores = [score for score in doc_sparse_scores if score > 0]
+        sparse_floor = min(positive_scores) if positive_scores else 1e-9
+
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self._key(query), query, query_vector.tobytes(),
+                    json.dumps(result), json.dumps(doc_ids),
+                    dense_ceiling, sparse_floor, now, now,
+                ),
+            )
+            self._conn.execute(
+                "DELETE FROM answers WHERE key NOT IN (SELECT key FROM answers ORDER BY accessed DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def invalidate(self, chunk_embeddings: list[list[float]], sparse_scorer, removed_ids: list[str]) -> int:
+        """
+        Drops entries a corpus change could have affected.
+
+        chunk_embeddings are the embeddings of newly added chunks, sparse_scorer(query) returns
+        the BM25 scores of the chunks that match query, and removed_ids are deleted chunk ids.
+        Returns the number of entries dropped.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, query, embedding, doc_ids, dense_ceiling, sparse_floor FROM answers"
+            ).fetchall()
+
+        removed = set(removed_ids)
+        chunks = np.asarray(chunk_embeddings, dtype=np.float64) if len(chunk_embeddings) > 0 else None
+        stale_keys = []
+        for key, query, blob, doc_ids, dense_ceiling, sparse_floor in rows:
+            if removed.intersection(json.loads(doc_ids)):
+                stale_keys.append(key)
+                continue
+            if chunks is None:
+                continue
+
+            query_embedding = np.frombuffer(blob, dtype=np.float64)
+            if np.min(np.linalg.norm(chunks - query_embedding, axis=1)) <= dense_ceiling:
+                stale_keys.append(key)
+            elif max(sparse_scorer(query), default=0.0) >= sparse_floor:
+                stale_keys.append(key)
+
+        if stale_keys:
+            with self._lock:
+                self._conn.executemany("DELETE FROM answers WHERE key = ?", [(key,) for key in stale_keys])
+                self._conn.commit()
+        return len(stale_keys)
+
+    def discard(self, query: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers WHERE key = ?", (self._key(query),))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+
+    def _key(self, query: str) -> str:
+        return hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+
+
+def _cosine(matrix: np.ndarray, vector: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    norms[norms == 0] = 1.0
+    return matrix @ vector / norms
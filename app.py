@@ -1,6 +1,9 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-from answer import docs_and_response
+from answer import docs_and_response, stream_docs_and_response
+from retrieval_context import get_retrieval_context
+from rank_documents import get_reranker
+import json
 
 app = Flask(__name__)
 CORS(app)
@@ -14,5 +17,32 @@ def output():
     except:
         return "AI service is not running."
 
+"""
+Server-Sent Events version of /output.
+
+Sends a "docs" event with the time-sorted sources as soon as retrieval finishes, one
+"token" event per piece of the answer, and a final "done" event ("error" on failure).
+"""
+@app.route("/output/stream")
+def output_stream():
+    query = request.args.get('query')
+
+    def events():
+        try:
+            for kind, payload in stream_docs_and_response(query):
+                yield f"event: {kind}\ndata: {json.dumps(payload)}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            print(f"Streaming failed: {e}")
+            yield f"event: error\ndata: {json.dumps('AI service is not running.')}\n\n"
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 if __name__ == '__main__':
-    app.run(port=5050)
\ No newline at end of file
+    get_retrieval_context().warm()
+    get_reranker().warm()
+    app.run(port=5050)
@@ -0,0 +1,351 @@
+"""
+Ingestion and retrieval benchmarks on synthetic corpora:
+
+    python benchmark.py [--sizes 1000,10000,100000] [--queries 200] [--rerank]
+    python benchmark.py --sizes 1000000 --update-baselines
+
+For every size, a corpus of that many chunks with the shapes of the real sources (short
+Slack messages, 500 character PDF chunks, terminal command/output records, PR bodies and
+diff hunks) is generated deterministically and ingested through add_to_chroma into a fresh
+ORION_HOME, then queried. Embeddings come from the hash stand-in (EMBEDDING_BACKEND=hash),
+so nothing needs ollama or a network. Each size runs in its own process, so its peak RSS
+and stores are its own.
+
+Reported per size: ingest throughput (chunks/s), query latency p50/p95/p99 for dense,
+sparse and hybrid retrieval (get_docs' dense + sparse + fusion stage; with --rerank, the
+whole of get_docs, which needs the cross-encoder downloaded), peak RSS and the size of the
+Chroma and sparse index directories.
+
+Results are compared to benchmark_baselines.json: if any metric is worse than its baseline by
+more than --tolerance (20% by default), the run exits with status 1. --update-baselines
+records this run's results as the new baselines instead. Baselines are only comparable on
+the machine they were recorded on.
+"""
+import argparse
+import bisect
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baselines.json")
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+# Chunks per add_to_chroma call. A multiple of 400 and 6 (the spans of a synthetic PDF and PR,
+# see Corpus.chunk), so no (source, page) unit is split across two calls, which would make the
+# second call remove the first one's chunks as stale.
+INGEST_BATCH = 6000
+
+WARMUP_QUERIES = 10
+
+# Share of each source in the corpus
+SOURCE_MIX = [("slack", 0.4), ("pdf", 0.3), ("terminal", 0.15), ("github", 0.15)]
+
+VOCABULARY_SIZE = 20000
+
+# Queries use words of middling frequency, like real questions do: not stopwords, not typos
+QUERY_WORD_RANKS = (50, 5000)
+
+# Metrics compared against the baselines, and which way is better
+HIGHER_IS_BETTER = {"ingest_chunks_per_second"}
+
+COMPARED_METRICS = [
+    "ingest_chunks_per_second",
+    "dense_p50_ms", "dense_p95_ms", "dense_p99_ms",
+    "sparse_p50_ms", "sparse_p95_ms", "sparse_p99_ms",
+    "hybrid_p50_ms", "hybrid_p95_ms", "hybrid_p99_ms",
+    "get_docs_p50_ms", "get_docs_p95_ms", "get_docs_p99_ms",
+    "peak_rss_mb", "index_mb",
+]
+
+
+class Corpus:
+    """Deterministic synthetic chunks; the same seed always gives the same corpus and queries."""
+
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+        rng = random.Random(seed)
+        consonants, vowels = "bcdfghklmnprstvz", "aeiou"
+        words = set()
+        while len(words) < VOCABULARY_SIZE:
+            syllables = rng.randint(1, 4)
+            words.add("".join(rng.choice(consonants) + rng.choice(vowels) for _ in range(syllables)) + rng.choice(["", "s", "n", "r", "t"]))
+        self.words = sorted(words)
+        rng.shuffle(self.words)
+        # Zipf-distributed word frequencies, as in natural text
+        weights = [1.0 / rank for rank in range(1, VOCABULARY_SIZE + 1)]
+        self.cumulative = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self.cumulative.append(total)
+
+    def _words(self, rng: random.Random, count: int) -> list[str]:
+        top = self.cumulative[-1]
+        return [self.words[bisect.bisect_left(self.cumulative, rng.random() * top)] for _ in range(count)]
+
+    def _sentences(self, rng: random.Random, chars: int) -> str:
+        text = []
+        length = 0
+        while length < chars:
+            sentence = " ".join(self._words(rng, rng.randint(5, 18))).capitalize() + "."
+            text.append(sentence)
+            length += len(sentence) + 1
+        return " ".join(text)[:chars]
+
+    def _identifier(self, rng: random.Random) -> str:
+        return "_".join(self._words(rng, rng.randint(1, 3)))
+
+    def _timestamp(self, rng: random.Random) -> str:
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(1704067200 + rng.randint(0, 365 * 24 * 3600)))
+
+    def chunk(self, number: int):
+        """(text, metadata) of chunk number, generated on its own so corpora can be streamed."""
+        rng = random.Random(f"{self.seed}:{number}")
+        point = rng.random()
+        for kind, share in SOURCE_MIX:
+            if point < share:
+                break
+            point -= share
+
+        if kind == "slack":
+            text = self._sentences(rng, rng.randint(40, 300))
+            metadata = {"source": f"slack/C{rng.randint(0, 50):04d}", "page": f"{1704067200 + number}.{rng.randint(0, 999999):06d}"}
+        elif kind == "pdf":
+            text = self._sentences(rng, rng.randint(420, 500))
+            metadata = {"source": f"data/manual_{number // 400}.pdf", "page": (number // 4) % 100, "start_index": (number % 4) * 420}
+        elif kind == "terminal":
+            command = f"{rng.choice(['python', 'git', 'npm', 'docker', 'pytest', 'ls', 'grep'])} {self._identifier(rng)}"
+            output = "\n".join(
+                f"{rng.choice(['INFO', 'WARN', 'ERROR', ''])} {'/'.join(self._words(rng, 3))}.py:{rng.randint(1, 900)} {' '.join(self._words(rng, rng.randint(2, 10)))}"
+                for _ in range(rng.randint(1, 12))
+            )
+            text = f"$ {command}\n{output}"[:500]
+            metadata = {"source": f"oterm/logs/session_{number // 200}.log", "page": number * 97}
+        else:
+            pr = number // 6
+            title = " ".join(self._words(rng, 6)).capitalize()
+            if number % 6 == 0:
+                text = f"{title}\n\n{self._sentences(rng, rng.randint(100, 500))}"
+                metadata = {"source": "github", "page": f"{pr}2024-01-01T00:00:00Z"}
+            else:
+                path = f"src/{self._identifier(rng)}/{self._identifier(rng)}.py"
+                start = rng.randint(1, 800)
+                lines = [f"{rng.choice('+- ')}    {self._identifier(rng)} = {self._identifier(rng)}({self._identifier(rng)})" for _ in range(rng.randint(4, 30))]
+                text = f"PR #{pr}: {title}\nFile: {path}\n@@ -{start},{len(lines)} +{start},{len(lines)} @@\n" + "\n".join(lines)
+                metadata = {"source": "github", "page": f"{pr}2024-01-01T00:00:00Z", "path": path}
+
+        metadata.update(type=kind, time=self._timestamp(rng))
+        return text, metadata
+
+    def chunks(self, count: int, batch: int = INGEST_BATCH):
+        """Yields lists of up to batch Documents, count chunks in all."""
+        from langchain.schema.document import Document
+        for start in range(0, count, batch):
+            yield [Document(page_content=text, metadata=metadata)
+                   for text, metadata in (self.chunk(number) for number in range(start, min(start + batch, count)))]
+
+    def queries(self, count: int) -> list[str]:
+        rng = random.Random(f"{self.seed}:queries")
+        low, high = QUERY_WORD_RANKS
+        return [" ".join(rng.choice(self.words[low:high]) for _ in range(rng.randint(2, 6))) for _ in range(count)]
+
+
+def percentiles(samples: list[float]) -> dict:
+    ordered = sorted(samples)
+
+    def at(p):
+        return round(ordered[min(int(p / 100 * len(ordered)), len(ordered) - 1)] * 1000, 3)
+
+    return {"p50": at(50), "p95": at(95), "p99": at(99)}
+
+
+def directory_mb(path: str) -> float:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            with contextlib.suppress(OSError):
+                total += os.path.getsize(os.path.join(root, name))
+    return round(total / (1 << 20), 2)
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1 << 20) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def time_queries(function, queries: list[str]) -> list[float]:
+    for query in queries[:WARMUP_QUERIES]:
+        function(query)
+    latencies = []
+    for query in queries[WARMUP_QUERIES:]:
+        start = time.perf_counter()
+        function(query)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+"""
+Runs one size in this process. ORION_HOME and EMBEDDING_BACKEND must already be set
+(run_size does that), since the stores' paths are read when the modules are imported.
+"""
+def measure(size: int, query_count: int, seed: int, rerank: bool) -> dict:
+    from aggregate_documents import CHROMA_PATH, SPARSE_INDEX_PATH
+    from dense_embeddings import add_to_chroma, dense_relevant_documents
+    from sparse_embeddings import sparse_relevant_documents
+    from get_relevant_docs import get_docs, reciprocal_rank_fusion, retrieval_pool
+    from retrieval_context import get_retrieval_context
+
+    corpus = Corpus(seed)
+    results = {"size": size}
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for batch in corpus.chunks(size):
+            add_to_chroma(batch)
+    elapsed = time.perf_counter() - started
+    results["ingest_seconds"] = round(elapsed, 2)
+    results["ingest_chunks_per_second"] = round(size / elapsed, 1)
+
+    get_retrieval_context().sparse_index.merge()
+
+    def hybrid(query):
+        # get_docs' retrieval stage: dense and sparse side by side, then fusion
+        dense = retrieval_pool.submit(dense_relevant_documents, query, 5)
+        sparse = retrieval_pool.submit(sparse_relevant_documents, query, 5)
+        return reciprocal_rank_fusion([dense.result(), sparse.result()], [1.0, 1.0])
+
+    queries = corpus.queries(query_count + WARMUP_QUERIES)
+    timed = {
+        "dense": lambda query: dense_relevant_documents(query, 5),
+        "sparse": lambda query: sparse_relevant_documents(query, 5),
+        "hybrid": hybrid,
+    }
+    if rerank:
+        timed["get_docs"] = get_docs
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, function in timed.items():
+            for label, value in percentiles(time_queries(function, queries)).items():
+                results[f"{name}_{label}_ms"] = value
+
+    results["peak_rss_mb"] = peak_rss_mb()
+    results["chroma_mb"] = directory_mb(CHROMA_PATH)
+    results["sparse_mb"] = directory_mb(SPARSE_INDEX_PATH)
+    results["index_mb"] = round(results["chroma_mb"] + results["sparse_mb"], 2)
+    return results
+
+
+def run_size(size: int, query_count: int, seed: int, rerank: bool, keep: bool) -> dict:
+    """Runs measure() for size in a fresh process with its own ORION_HOME."""
+    home = tempfile.mkdtemp(prefix=f"orion-bench-{size}-")
+    result_path = os.path.join(home, "result.json")
+    env = dict(os.environ, ORION_HOME=home, EMBEDDING_BACKEND="hash")
+    command = [sys.executable, os.path.abspath(__file__), "--measure", str(size), "--queries", str(query_count),
+               "--seed", str(seed), "--result", result_path] + (["--rerank"] if rerank else [])
+    try:
+        subprocess.run(command, env=env, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        with open(result_path, "r") as f:
+            return json.load(f)
+    finally:
+        if keep:
+            print(f"Kept the stores for {size} chunks in {home}")
+        else:
+            shutil.rmtree(home, ignore_errors=True)
+
+
+def load_baselines(path: str = BASELINES_PATH) -> dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_baselines(baselines: dict, path: str = BASELINES_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp_path, path)
+
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Metrics of result that are worse than baseline by more than tolerance (a fraction)."""
+    found = []
+    for metric in COMPARED_METRICS:
+        if metric not in result or not baseline.get(metric):
+            continue
+        value, expected = result[metric], baseline[metric]
+        change = (expected - value) / expected if metric in HIGHER_IS_BETTER else (value - expected) / expected
+        if change > tolerance:
+            found.append(f"{metric}: {value} vs baseline {expected} ({change:+.0%} worse)")
+    return found
+
+
+def print_results(results: list[dict]):
+    columns = ["size", "ingest_chunks_per_second", "dense_p95_ms", "sparse_p95_ms", "hybrid_p95_ms",
+               "get_docs_p95_ms", "peak_rss_mb", "index_mb"]
+    columns = [column for column in columns if any(column in result for result in results)]
+    print("  ".join(f"{column:>24}" for column in columns))
+    for result in results:
+        print("  ".join(f"{result.get(column, ''):>24}" for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingestion and retrieval on synthetic corpora.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Comma-separated corpus sizes, in chunks.")
+    parser.add_argument("--queries", type=int, default=200, help="Timed queries per retriever.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rerank", action="store_true", help="Also time the whole of get_docs, cross-encoder included.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression against the baselines, as a fraction.")
+    parser.add_argument("--update-baselines", action="store_true", help="Store this run's results as the baselines.")
+    parser.add_argument("--keep", action="store_true", help="Keep each size's stores instead of deleting them.")
+    parser.add_argument("--measure", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        result = measure(args.measure, args.queries, args.seed, args.rerank)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        return
+
+    results = []
+    for size in (int(size) for size in args.sizes.split(",")):
+        print(f"Benchmarking {size} chunks...")
+        results.append(run_size(size, args.queries, args.seed, args.rerank, args.keep))
+    print_results(results)
+
+    baselines = load_baselines()
+    if args.update_baselines:
+        for result in results:
+            baselines[str(result["size"])] = result
+        save_baselines(baselines)
+        print(f"Updated baselines in {BASELINES_PATH}")
+        return
+
+    failed = False
+    for result in results:
+        baseline = baselines.get(str(result["size"]))
+        if baseline is None:
+            print(f"No baseline for {result['size']} chunks (record one with --update-baselines)")
+            continue
+        found = regressions(result, baseline, args.tolerance)
+        for regression in found:
+            print(f"REGRESSION at {result['size']} chunks: {regression}")
+        failed = failed or bool(found)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
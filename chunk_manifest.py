@@ -0,0 +1,134 @@
+"""
+Per-source record of which chunk ids are stored, used to make re-ingestion incremental.
+
+manifest.json:
+    {"units": {source: {page: [chunk ids]}},
+     "files": {path: {"size": int, "mtime_ns": int, "sha256": str (only if hashed)}}}
+
+A unit is one (source, page) pair: a PDF page, a Slack message, a PR, a terminal log.
+When a unit is re-ingested, any id it used to have that it no longer produces is stale.
+"files" holds the fingerprint of every file-backed source at its last ingest so unchanged
+files can be skipped without loading them. Where the content hash is recorded too, a file
+whose mtime changed (copied, touched, synced) but whose content didn't is skipped as well;
+it is only hashed once its size or mtime differ.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+
+def file_fingerprint(path: str) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ChunkManifest:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._data = self._read()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def reload(self):
+        """Picks up changes other ingesters made since we last read the manifest."""
+        with self._lock:
+            self._data = self._read()
+
+    def unit_ids(self, source: str, page) -> list[str]:
+        with self._lock:
+            return list(self._data["units"].get(source, {}).get(str(page), []))
+
+    def source_ids(self, source: str) -> dict[str, list[str]]:
+        """All pages of a source and their chunk ids."""
+        with self._lock:
+            return {page: list(ids) for page, ids in self._data["units"].get(source, {}).items()}
+
+    def changed_files(self, paths: list[str]) -> list[str]:
+        """Paths that are new or whose size/mtime differ from the last ingest."""
+        with self._lock:
+            files = self._data["files"]
+            return [path for path in paths if not self._same_fingerprint(files.get(path), file_fingerprint(path))]
+
+    def same_contents(self, path: str, sha256: str) -> bool:
+        """Whether sha256 is the content hash recorded for path at its last ingest."""
+        with self._lock:
+            return (self._data["files"].get(path) or {}).get("sha256") == sha256
+
+    def missing_files(self, directory: str, paths: list[str]) -> list[str]:
+        """Recorded files under directory that are no longer among paths."""
+        present = set(paths)
+        prefix = os.path.join(directory, "")
+        with self._lock:
+            return [path for path in self._data["files"] if path.startswith(prefix) and path not in present]
+
+    @contextmanager
+    def update(self):
+        """
+        Locks the manifest across processes, reloads it, and saves it on exit.
+        Keep the body short; other ingesters wait on it.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock, open(f"{self.path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._data = self._read()
+                yield self
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(self._data, f)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # The methods below only modify the in-memory copy; call them inside update().
+
+    def set_unit(self, source: str, page, ids: list[str]):
+        pages = self._data["units"].setdefault(source, {})
+        if ids:
+            pages[str(page)] = list(ids)
+        else:
+            pages.pop(str(page), None)
+        if not pages:
+            self._data["units"].pop(source, None)
+
+    def drop_source(self, source: str):
+        self._data["units"].pop(source, None)
+
+    def record_files(self, paths: list[str], hashes: dict[str, str] = None):
+        """Records paths as ingested; hashes ({path: sha256}) are stored along with their fingerprints."""
+        for path in paths:
+            fingerprint = file_fingerprint(path)
+            if hashes and path in hashes:
+                fingerprint["sha256"] = hashes[path]
+            self._data["files"][path] = fingerprint
+
+    def forget_files(self, paths: list[str]):
+        for path in paths:
+            self._data["files"].pop(path, None)
+
+    def clear(self):
+        self._data = {"units": {}, "files": {}}
+
+    @staticmethod
+    def _same_fingerprint(recorded: dict, current: dict) -> bool:
+        return recorded is not None and all(recorded.get(key) == value for key, value in current.items())
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"units": {}, "files": {}}
@@ -0,0 +1,141 @@
+"""
+Packs retrieved chunks into the answer prompt within a token budget.
+
+Chunks that come from the same source and page and touch or overlap (split_documents uses
+an 80 character overlap) are merged into one span with the repeated text removed. Spans
+are then added best-ranked first until the budget runs out, so the lowest-ranked material
+is what gets dropped. The last span that only partly fits is cut to the remaining budget.
+"""
+import math
+from langchain.schema import Document
+
+# Rough cost of the "Source: ... Time: ... Content:" wrapper around each document in the prompt
+DOCUMENT_OVERHEAD_TOKENS = 16
+
+# Shortest suffix/prefix match treated as split overlap when chunks carry no start_index
+MIN_TEXT_OVERLAP = 20
+
+# Don't bother including a truncated span shorter than this
+MIN_TRUNCATED_TOKENS = 50
+
+
+def estimate_tokens(text: str) -> int:
+    """About four characters per token, which is close enough for budgeting English text and code."""
+    return math.ceil(len(text) / 4)
+
+
+def text_overlap(left: str, right: str) -> int:
+    """Length of the longest suffix of left that is also a prefix of right."""
+    for size in range(min(len(left), len(right)), MIN_TEXT_OVERLAP - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+class Span:
+    def __init__(self, document: Document, rank: int):
+        self.text = document.page_content
+        self.metadata = dict(document.metadata)
+        self.rank = rank
+        self.start = document.metadata.get("start_index")
+
+    @property
+    def end(self):
+        return self.start + len(self.text)
+
+    def append(self, other: "Span", overlap: int):
+        self.text += other.text[overlap:]
+        self._take_rank(other)
+
+    def prepend(self, other: "Span", overlap: int):
+        self.text = other.text + self.text[overlap:]
+        self._take_rank(other)
+
+    def _take_rank(self, other: "Span"):
+        # A merged span ranks as its best member and reports that member's metadata
+        if other.rank < self.rank:
+            self.rank = other.rank
+            self.metadata = dict(other.metadata, start_index=self.metadata.get("start_index"))
+
+
+def merge_spans(spans: list[Span]) -> list[Span]:
+    """Merges touching or overlapping spans of one (source, page)."""
+    if all(span.start is not None for span in spans):
+        spans = sorted(spans, key=lambda span: span.start)
+        merged = [spans[0]]
+        for span in spans[1:]:
+            last = merged[-1]
+            if span.start <= last.end:
+                last.append(span, min(last.end - span.start, len(span.text)))
+            else:
+                merged.append(span)
+        return merged
+
+    # No offsets to go by (chunks ingested before start_index existed), so merge on repeated text
+    merged = []
+    for span in spans:
+        for existing in merged:
+            if span.text in existing.text:
+                existing.append(span, len(span.text))
+                break
+            overlap = text_overlap(existing.text, span.text)
+            if overlap:
+                existing.append(span, overlap)
+                break
+            overlap = text_overlap(span.text, existing.text)
+            if overlap:
+                existing.prepend(span, overlap)
+                break
+        else:
+            merged.append(span)
+    return merged
+
+
+"""
+Takes documents in ranked order (best first) and a token budget.
+
+Returns the packed documents, best first, and stats about the packing:
+{"documents_in", "documents_out", "tokens_in", "tokens_out", "tokens_saved", "dropped", "truncated"}
+"""
+def pack_context(documents: list[Document], token_budget: int):
+    groups = {}
+    for rank, document in enumerate(documents):
+        # A PR's diff chunks share its page but not its text, so they are grouped by file
+        key = (document.metadata.get("source"), document.metadata.get("page"), document.metadata.get("path"))
+        groups.setdefault(key, []).append(Span(document, rank))
+
+    spans = []
+    for group in groups.values():
+        spans.extend(merge_spans(group))
+    spans.sort(key=lambda span: span.rank)
+
+    packed = []
+    used = 0
+    truncated = 0
+    for span in spans:
+        cost = estimate_tokens(span.text) + DOCUMENT_OVERHEAD_TOKENS
+        if used + cost <= token_budget:
+            packed.append(Document(page_content=span.text, metadata=span.metadata))
+            used += cost
+            continue
+
+        # First span that doesn't fit: cut it to what is left, and drop everything ranked below it
+        remaining = token_budget - used - DOCUMENT_OVERHEAD_TOKENS
+        if remaining >= MIN_TRUNCATED_TOKENS or (len(packed) == 0 and remaining > 0):
+            text = span.text[:remaining * 4]
+            packed.append(Document(page_content=text, metadata=span.metadata))
+            used += estimate_tokens(text) + DOCUMENT_OVERHEAD_TOKENS
+            truncated = 1
+        break
+
+    tokens_in = sum(estimate_tokens(document.page_content) + DOCUMENT_OVERHEAD_TOKENS for document in documents)
+    stats = {
+        "documents_in": len(documents),
+        "documents_out": len(packed),
+        "tokens_in": tokens_in,
+        "tokens_out": used,
+        "tokens_saved": tokens_in - used,
+        "dropped": len(spans) - len(packed),
+        "truncated": truncated,
+    }
+    return packed, stats
@@ -1,9 +1,16 @@
+import asyncio
 import json
+import numpy as np
 from langchain_community.chat_models import ChatOllama
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
-from aggregate_documents import LLM_MODEL
-from supabase_client import get_docs_structure
+from langchain.schema import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from aggregate_documents import LLM_MODEL, CURATION_BATCH_TOKENS, CURATION_CONCURRENCY, CURATION_CONTEXT_PAGES
+from supabase_client import get_docs_snapshot
+from llm_scheduler import get_llm_scheduler, BACKGROUND
+from retrieval_context import get_retrieval_context
+from context_packing import estimate_tokens
 from dotenv import load_dotenv
 import os
 
@@ -56,9 +63,116 @@ return valid json or you will be terminated.
         input_variables=["docs_structure", "new_chunks"],
     )
 
-async def get_documentation_suggestions(new_chunks: list) -> list:
+class CurationError(Exception):
+    """Curation could not run at all, as opposed to a single batch failing."""
+
+
+def batch_documents(documents: list[Document], token_budget: int = CURATION_BATCH_TOKENS) -> list[list[Document]]:
+    """
+    Groups documents, in order, into batches of at most token_budget tokens of content.
+    A document bigger than the budget on its own is split into budget-sized pieces first.
+    """
+    splitter = RecursiveCharacterTextSplitter(chunk_size=token_budget * 4, chunk_overlap=0)
+    batches = []
+    batch = []
+    used = 0
+    for document in documents:
+        pieces = [document]
+        if estimate_tokens(document.page_content) > token_budget:
+            pieces = splitter.split_documents([document])
+        for piece in pieces:
+            cost = estimate_tokens(piece.page_content)
+            if batch and used + cost > token_budget:
+                batches.append(batch)
+                batch = []
+                used = 0
+            batch.append(piece)
+            used += cost
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+"""
+Embeddings of every page in the docs tree, used to pick which pages a batch of chunks
+should see. A page is represented by its title and by each of its blocks; its score
+against a batch is its best block's cosine similarity to any chunk in the batch.
+Block embeddings go through the embedding cache, so unchanged blocks aren't re-embedded.
+"""
+class PageIndex:
+    def __init__(self, collections: list):
+        texts = []
+        self.page_ids = []
+        for collection in collections:
+            for page in collection.get("pages") or []:
+                title = page.get("title") or page.get("slug") or ""
+                texts.append(title)
+                self.page_ids.append(page.get("id"))
+                for block in page.get("page_blocks") or []:
+                    texts.append(f"{title}\n{block.get('content') or ''}")
+                    self.page_ids.append(page.get("id"))
+
+        self.embedding_function = get_retrieval_context().embedding_function
+        self.vectors = _unit_rows(self.embedding_function.embed_documents(texts)) if texts else None
+
+    def relevant_pages(self, documents: list[Document], k: int = CURATION_CONTEXT_PAGES) -> set:
+        if self.vectors is None:
+            return set()
+        chunks = _unit_rows(self.embedding_function.embed_documents([document.page_content for document in documents]))
+        similarities = (self.vectors @ chunks.T).max(axis=1)
+
+        best = {}
+        for page_id, similarity in zip(self.page_ids, similarities):
+            best[page_id] = max(best.get(page_id, -1.0), float(similarity))
+        return set(sorted(best, key=best.get, reverse=True)[:k])
+
+
+def _unit_rows(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float64)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def parse_queries(content: str) -> list:
+    # Clean up the response and parse JSON
+    response_text = content.replace("```json", "").replace("```", "").strip()
+    return json.loads(response_text).get("queries", [])
+
+
+async def suggest_for_batch(batch: list[Document], snapshot, page_index: PageIndex, number: int) -> list:
+    """Asks the LLM for queries covering one batch, showing it only the pages relevant to that batch."""
+    page_ids = await asyncio.to_thread(page_index.relevant_pages, batch)
+    docs_structure = snapshot.render(page_ids=page_ids)
+
+    # Format chunks for the prompt
+    formatted_chunks = "\n---\n".join([f"Source: {chunk.metadata.get('source')}\nContent: {chunk.page_content}" for chunk in batch])
+
+    # Shared Gemini client; curation runs behind interactive answers in the scheduler
+    scheduler = get_llm_scheduler()
+    chain = get_curation_prompt() | scheduler.client("gemini")
+    response = await scheduler.ainvoke(chain, {
+        "docs_structure": docs_structure,
+        "new_chunks": formatted_chunks
+    }, "gemini", BACKGROUND)
+
+    try:
+        return parse_queries(response.content)
+    except (json.JSONDecodeError, AttributeError):
+        print(f"Error: LLM did not return valid JSON for curation batch {number}.")
+        print(f"LLM Response:\n{response.content}")
+        return []
+
+
+async def get_documentation_suggestions(new_chunks: list,
+                                        token_budget: int = CURATION_BATCH_TOKENS,
+                                        max_concurrency: int = CURATION_CONCURRENCY) -> list:
     """
     Uses an LLM to get a list of SQL queries to update documentation.
+
+    new_chunks are split into batches of at most token_budget tokens, and up to max_concurrency
+    batches are sent at once. Queries from every batch that succeeded are returned in batch order;
+    a failed batch is reported and skipped. Raises CurationError if nothing could be curated.
     """
     # llm = ChatOllama(model=LLM_MODEL, temperature=0.4)
 
@@ -71,36 +185,41 @@ async def get_documentation_suggestions(new_chunks: list) -> list:
     #     temperature=1
     # )
 
-    inference_server_url = "https://generativelanguage.googleapis.com/v1beta/openai/"
-    
-    llm = ChatOpenAI(
-        model="gemini-2.5-flash",
-        openai_api_key=os.getenv("GEMINI_KEY"),
-        openai_api_base=inference_server_url,
-        temperature=0
-    )
-    
-    prompt = get_curation_prompt()
-    
-    docs_structure = get_docs_structure()
-    if not docs_structure:
-        return []
+    snapshot = get_docs_snapshot()
+    if not await asyncio.to_thread(snapshot.sync):
+        raise CurationError("could not fetch the docs structure")
 
-    # Format chunks for the prompt
-    formatted_chunks = "\n---\n".join([f"Source: {chunk.metadata.get('source')}\nContent: {chunk.page_content}" for chunk in new_chunks])
+    try:
+        page_index = await asyncio.to_thread(PageIndex, snapshot.tree())
+    except Exception as e:
+        raise CurationError(f"could not embed the docs structure: {e}") from e
 
-    chain = prompt | llm
-    response = await chain.ainvoke({
-        "docs_structure": docs_structure,
-        "new_chunks": formatted_chunks
-    })
+    batches = batch_documents(new_chunks, token_budget)
+    print(f"Curating {len(new_chunks)} chunks in {len(batches)} batches")
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(batch, number):
+        async with semaphore:
+            return await suggest_for_batch(batch, snapshot, page_index, number)
 
     try:
-        # Clean up the response and parse JSON
-        response_text = response.content.replace("```json", "").replace("```", "").strip()
-        suggestions_json = json.loads(response_text)
-        return suggestions_json.get("queries", [])
-    except json.JSONDecodeError:
-        print("Error: LLM did not return valid JSON.")
-        print(f"LLM Response:\n{response.content}")
-        return []
\ No newline at end of file
+        results = await asyncio.gather(
+            *(run(batch, number) for number, batch in enumerate(batches, start=1)),
+            return_exceptions=True,
+        )
+    finally:
+        # This loop ends with the curation run (llm_curation's asyncio.run); so do its connections
+        await get_llm_scheduler().aclose_loop_clients()
+
+    queries = []
+    failed = 0
+    for number, result in enumerate(results, start=1):
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"Curation batch {number}/{len(batches)} failed: {type(result).__name__}: {result}")
+        else:
+            queries.extend(result)
+
+    if batches and failed == len(batches):
+        raise CurationError(f"all {failed} batches failed")
+    return queries
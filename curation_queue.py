@@ -0,0 +1,265 @@
+"""
+Persistent queue of documentation curation jobs, so ingestion doesn't wait on the LLM.
+
+Pipelines enqueue() the documents they ingested and return. A separate worker process
+(python curation_queue.py) drains the queue:
+
+- Coalescing: a worker waits until the oldest pending job is coalesce_window seconds old,
+  then claims it together with every other pending job, so a burst of small ingests
+  (Slack messages, terminal sessions) is curated as one run.
+- Leases: claimed jobs are leased to the worker for lease seconds, and the worker renews the
+  lease every lease / 3 seconds for as long as it is curating them. If the worker dies, the
+  lease runs out and another worker (or the same one after a restart) picks the jobs up.
+  Only the worker that holds a job's lease can complete or fail it.
+- Retries: a failed run puts its jobs back with exponential backoff, up to max_attempts.
+
+Jobs live in a sqlite file, so nothing is lost across restarts.
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from langchain.schema import Document
+from aggregate_documents import (
+    CURATION_QUEUE_PATH, CURATION_WORKERS, CURATION_COALESCE_SECONDS,
+    CURATION_MAX_ATTEMPTS, CURATION_LEASE_SECONDS,
+)
+
+# Most jobs claimed into one curation run
+MAX_COALESCED_JOBS = 50
+
+# Seconds before the first retry of a failed job; doubles with every attempt
+RETRY_BACKOFF = 30.0
+
+POLL_INTERVAL = 2.0
+
+
+class CurationQueue:
+    def __init__(self, path: str = CURATION_QUEUE_PATH, coalesce_window: float = CURATION_COALESCE_SECONDS,
+                 lease: float = CURATION_LEASE_SECONDS, max_attempts: int = CURATION_MAX_ATTEMPTS):
+        self.path = path
+        self.coalesce_window = coalesce_window
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                documents TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                available_at REAL NOT NULL,
+                lease_until REAL,
+                worker TEXT,
+                error TEXT
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at)")
+
+    def enqueue(self, documents: list[Document]) -> int:
+        """Adds a curation job for documents and returns its id."""
+        payload = json.dumps([{"page_content": d.page_content, "metadata": d.metadata} for d in documents])
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (documents, status, created, available_at) VALUES (?, 'pending', ?, ?)",
+                (payload, now, now),
+            )
+            return cursor.lastrowid
+
+    def claim(self, worker: str):
+        """
+        Claims every runnable job once the oldest has waited out the coalescing window.
+        Returns (job ids, documents), or None if there is nothing to run yet.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    """SELECT id, documents, created FROM jobs
+                       WHERE (status = 'pending' AND available_at <= ?)
+                          OR (status = 'running' AND lease_until < ?)
+                       ORDER BY id LIMIT ?""",
+                    (now, now, MAX_COALESCED_JOBS),
+                ).fetchall()
+                if not rows or min(created for _, _, created in rows) > now - self.coalesce_window:
+                    self._conn.execute("COMMIT")
+                    return None
+
+                ids = [job_id for job_id, _, _ in rows]
+                self._conn.executemany(
+                    "UPDATE jobs SET status = 'running', lease_until = ?, worker = ? WHERE id = ?",
+                    [(now + self.lease, worker, job_id) for job_id in ids],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        documents = [Document(**document) for _, payload, _ in rows for document in json.loads(payload)]
+        return ids, documents
+
+    def renew(self, ids: list[int], worker: str) -> list[int]:
+        """Extends worker's lease on the given jobs. Returns the ids it still holds."""
+        now = time.time()
+        held = []
+        with self._lock:
+            for job_id in ids:
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running' AND worker = ?",
+                    (now + self.lease, job_id, worker),
+                )
+                if cursor.rowcount:
+                    held.append(job_id)
+        return held
+
+    def complete(self, ids: list[int], worker: str) -> list[int]:
+        """Deletes the jobs worker still holds. Returns the ids that were deleted."""
+        done = []
+        with self._lock:
+            for job_id in ids:
+                cursor = self._conn.execute(
+                    "DELETE FROM jobs WHERE id = ? AND status = 'running' AND worker = ?", (job_id, worker)
+                )
+                if cursor.rowcount:
+                    done.append(job_id)
+        return done
+
+    def fail(self, ids: list[int], worker: str, error: str):
+        """
+        Puts the jobs worker still holds back with backoff, or marks them failed once they are
+        out of attempts. Jobs another worker has taken over are left to it.
+        """
+        now = time.time()
+        with self._lock:
+            for job_id in ids:
+                row = self._conn.execute(
+                    "SELECT attempts FROM jobs WHERE id = ? AND status = 'running' AND worker = ?", (job_id, worker)
+                ).fetchone()
+                if row is None:
+                    continue
+                attempts = row[0] + 1
+                status = "failed" if attempts >= self.max_attempts else "pending"
+                self._conn.execute(
+                    """UPDATE jobs SET status = ?, attempts = ?, available_at = ?, lease_until = NULL,
+                       worker = NULL, error = ? WHERE id = ?""",
+                    (status, attempts, now + RETRY_BACKOFF * 2 ** (attempts - 1), error, job_id),
+                )
+
+    def counts(self) -> dict:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def retry_failed(self) -> int:
+        """Gives jobs that ran out of attempts another full set of attempts."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'pending', attempts = 0, available_at = ? WHERE status = 'failed'",
+                (time.time(),),
+            )
+            return cursor.rowcount
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_curation_queue() -> CurationQueue:
+    """Returns the process-wide curation queue, creating it on first use."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                os.makedirs(os.path.dirname(CURATION_QUEUE_PATH) or ".", exist_ok=True)
+                _queue = CurationQueue()
+    return _queue
+
+
+def enqueue_curation(documents: list[Document]):
+    job_id = get_curation_queue().enqueue(documents)
+    print(f"Queued curation job {job_id} for {len(documents)} documents")
+
+
+def renew_lease(queue: CurationQueue, ids: list[int], name: str, done: threading.Event):
+    """Keeps the lease on ids until done is set, so a long (e.g. rate-limited) run isn't taken over."""
+    while not done.wait(queue.lease / 3):
+        held = queue.renew(ids, name)
+        if len(held) < len(ids):
+            print(f"[{name}] Lost the lease on jobs {sorted(set(ids) - set(held))}")
+            ids = held
+
+
+def run_worker(queue: CurationQueue, curate, name: str, stop: threading.Event):
+    """Claims and curates jobs until stop is set. curate(documents) should raise on failure."""
+    while not stop.is_set():
+        claimed = queue.claim(name)
+        if claimed is None:
+            stop.wait(POLL_INTERVAL)
+            continue
+
+        ids, documents = claimed
+        print(f"[{name}] Curating jobs {ids} ({len(documents)} documents)")
+        done = threading.Event()
+        heartbeat = threading.Thread(target=renew_lease, args=(queue, ids, name, done), daemon=True)
+        heartbeat.start()
+        try:
+            curate(documents)
+        except Exception as e:
+            # Any failure, expected or not, goes back on the queue rather than killing the worker
+            print(f"[{name}] Curation of jobs {ids} failed: {type(e).__name__}: {e}")
+            done.set()
+            queue.fail(ids, name, f"{type(e).__name__}: {e}")
+        else:
+            done.set()
+            completed = queue.complete(ids, name)
+            if len(completed) < len(ids):
+                print(f"[{name}] Jobs {sorted(set(ids) - set(completed))} were taken over by another worker")
+        finally:
+            done.set()
+            heartbeat.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run curation workers, or inspect the curation queue.")
+    parser.add_argument("--workers", type=int, default=CURATION_WORKERS, help="Number of worker threads.")
+    parser.add_argument("--status", action="store_true", help="Print job counts by status and exit.")
+    parser.add_argument("--retry-failed", action="store_true", help="Requeue jobs that ran out of attempts and exit.")
+    args = parser.parse_args()
+
+    queue = get_curation_queue()
+    if args.status:
+        print(queue.counts())
+        return
+    if args.retry_failed:
+        print(f"Requeued {queue.retry_failed()} failed jobs")
+        return
+
+    from dense_embeddings import llm_curation
+
+    stop = threading.Event()
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [
+        threading.Thread(target=run_worker, args=(queue, llm_curation, f"{prefix}:{i}", stop), daemon=True)
+        for i in range(args.workers)
+    ]
+    for thread in threads:
+        thread.start()
+    print(f"Curation workers running ({args.workers}), queue: {queue.counts()}")
+
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        # Jobs being curated right now stay leased and are picked up again after their lease runs out
+        stop.set()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,18 @@
-"""
-might have to change unique ID calc
-"""
-from langchain_community.document_loaders.pdf import PyPDFDirectoryLoader
-from langchain_community.document_loaders import DirectoryLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.schema.document import Document
-from embedding_function import get_embedding_function
-from langchain_community.vectorstores.chroma import Chroma
-from aggregate_documents import DATA_PATH, CHROMA_PATH, TERMINAL_LOG_PATH, GIT_PR_PATH
+from aggregate_documents import DATA_PATH, TERMINAL_LOG_PATH, EMBED_BATCH_SIZE, EMBED_CONCURRENCY, PDF_WORKERS, PDF_PAGES_PER_TASK, PDF_EMBED_PAGES
+from retrieval_context import get_retrieval_context
+from pr_diffs import pr_diff_documents
+from terminal_logs import load_offsets, save_offsets, log_changed, read_new_records
+from pdf_pages import iter_pdf_pages
+from chunk_manifest import file_hash
 from datetime import datetime
 import asyncio
-from curate import get_documentation_suggestions
+from curate import get_documentation_suggestions, CurationError
+from curation_queue import enqueue_curation
 from supabase_client import execute_documentation_changes
 import os
-import json
+import hashlib
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -21,14 +20,13 @@ load_dotenv()
 ORION_HOME = os.getenv("ORION_HOME")
 
 
-# must change this for non PDF data
-def load_pdf_documents():
-    # For PDFs in a directory (default behavior):
-    document_loader = PyPDFDirectoryLoader(DATA_PATH)
-    documents = document_loader.load()
-    for document in documents:
-        document.metadata["type"] = "pdf"
-    return documents
+def list_files(directory: str, suffix: str = ""):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if not name.startswith(".") and name.endswith(suffix) and os.path.isfile(os.path.join(directory, name))
+    )
 
 def load_slack_documents(messages):
     documents = []
@@ -36,75 +34,175 @@ def load_slack_documents(messages):
         documents.append(Document(page_content=message['text'], metadata={"source": f"slack/{message['channel']}", "page": message['timestamp'], "time": message['datetime'], "type": "slack"}))
     return documents
 
-def load_terminal_documents():
-    document_loader = DirectoryLoader(TERMINAL_LOG_PATH)
-    documents = document_loader.load()
-    for document in documents:
-        document.metadata["type"] = "terminal"
-
+def load_terminal_documents(path: str, records):
+    documents = []
+    for record in records:
+        text = record.text()
+        if text:
+            documents.append(Document(page_content=text, metadata={"source": path, "page": record.start, "type": "terminal"}))
     return documents
 
-def load_github_prs():
-    for fname in os.listdir(f"{ORION_HOME}/{GIT_PR_PATH}"):
-        if fname.endswith("refined_pr_info.json"):
-            filepath = os.path.join(f"{ORION_HOME}/{GIT_PR_PATH}", fname)
-            break
-    else:
-        raise FileNotFoundError("No file ending with refined_pr_info.json found")
-
-    with open(filepath, "r") as file:
-        data = json.load(file)
-        documents = []
-        for pr in data:
-            ts = pr['created_at']
-            dt = datetime.strptime(ts, "%Y-%m-%dT%H:%M:%SZ")
-            formatted = dt.strftime("%Y-%m-%d %H:%M:%S")
-            # body = (pr.get('pr_body') or "") + (pr.get('diff') or "")
-            body = (pr.get('pr_body') or "")
-
-            documents.append(Document(page_content=body, metadata={"source": "github", "page": f"{pr['pr_number']}{pr['created_at']}", "time":formatted, "type": "github"}))
-        return documents
+"""
+Takes refined PR records (see github/pr_store.py) and returns one document per PR, plus the
+PR's diff chunks (see pr_diffs.py), which are already cut along hunk boundaries and
+shouldn't go through split_documents.
+"""
+def load_github_prs(prs):
+    documents = []
+    diff_chunks = []
+    for pr in prs:
+        ts = pr['created_at']
+        dt = datetime.strptime(ts, "%Y-%m-%dT%H:%M:%SZ")
+        formatted = dt.strftime("%Y-%m-%d %H:%M:%S")
+        body = (pr.get('pr_body') or "")
+
+        metadata = {"source": "github", "page": f"{pr['pr_number']}{pr['created_at']}", "time":formatted, "type": "github"}
+        documents.append(Document(page_content=body, metadata=metadata))
+        diff_chunks.extend(pr_diff_documents(pr, metadata))
+    return documents, diff_chunks
 
 def split_documents(documents: list[Document]):
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=500,
         chunk_overlap=80,
         length_function=len,
+        add_start_index=True,
     )
 
     return text_splitter.split_documents(documents)
 
 
-def add_to_chroma(chunks: list[Document]):
-    db = Chroma(
-        persist_directory=CHROMA_PATH, embedding_function=get_embedding_function()
-    )
+def add_to_chroma(chunks: list[Document], replace_sources: list[str] = None,
+                  batch_size: int = EMBED_BATCH_SIZE, max_workers: int = EMBED_CONCURRENCY):
+    """
+    Stores the chunks that are not in Chroma yet and removes the ones they replace.
 
-    chunks_with_ids = calculate_chunk_ids(chunks)
+    Every (source, page) unit present in chunks counts as re-ingested in full, so ids the
+    unit used to have but no longer produces are deleted from Chroma and the sparse index.
+    Sources in replace_sources are replaced as a whole, including pages that no longer
+    show up at all (a PDF that got shorter or was deleted).
 
-    existing_items = db.get(include=[])
-    existing_ids = set(existing_items["ids"])
-    print(f"Number of existing documents in DB: {len(existing_ids)}")
+    Returns the number of chunks added.
+    """
+    context = get_retrieval_context()
+    db = context.db
+    manifest = context.chunk_manifest
+    if not manifest.exists():
+        bootstrap_chunk_manifest()
+    manifest.reload()
 
-    new_chunks = []
+    chunks_with_ids = calculate_chunk_ids(chunks)
+
+    units = {}
     for chunk in chunks_with_ids:
         if ("time" not in chunk.metadata):
             chunk.metadata["time"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        unit = (chunk.metadata.get("source"), str(chunk.metadata.get("page")))
+        units.setdefault(unit, []).append(chunk.metadata["id"])
+
+    previous_ids = []
+    for source in replace_sources or []:
+        for ids in manifest.source_ids(source).values():
+            previous_ids.extend(ids)
+    for source, page in units:
+        previous_ids.extend(manifest.unit_ids(source, page))
+
+    current_ids = set(chunk.metadata["id"] for chunk in chunks_with_ids)
+    stale_ids = list(set(previous_ids) - current_ids)
+
+    existing_ids = set()
+    candidate_ids = list(current_ids)
+    for start in range(0, len(candidate_ids), 1000):
+        existing_ids.update(db.get(ids=candidate_ids[start:start + 1000], include=[])["ids"])
+
+    new_chunks = []
+    for chunk in chunks_with_ids:
         if chunk.metadata["id"] not in existing_ids:
             new_chunks.append(chunk)
 
     if len(new_chunks) > 0:
         print(f"Adding new documents: {len(new_chunks)}")
-        new_chunk_ids = [chunk.metadata["id"] for chunk in new_chunks]
-        db.add_documents(new_chunks, ids=new_chunk_ids)
+        store_chunks(new_chunks, batch_size, max_workers)
     else:
         print("No new documents to add")
 
+    if len(stale_ids) > 0:
+        print(f"Removing stale documents: {len(stale_ids)}")
+        db.delete(ids=stale_ids)
+        context.sparse_index.delete(stale_ids)
+
+    with manifest.update():
+        for source in replace_sources or []:
+            manifest.drop_source(source)
+        for (source, page), ids in units.items():
+            manifest.set_unit(source, page, ids)
+
+    if len(new_chunks) > 0 or len(stale_ids) > 0:
+        # Generation first: answers retrieved before it are then either dropped here or not stored
+        context.refresh()
+        invalidate_cached_answers(new_chunks, stale_ids)
+
     return len(new_chunks)
 
+
+def invalidate_cached_answers(new_chunks: list[Document], removed_ids: list[str]):
+    """Drops cached answers whose retrieval the added or removed chunks could have changed."""
+    context = get_retrieval_context()
+    texts = [chunk.page_content for chunk in new_chunks]
+    # Just stored, so these are all embedding cache hits
+    embeddings = context.embedding_function.embed_documents(texts) if texts else []
+
+    dropped = context.answer_cache.invalidate(embeddings, context.sparse_index.text_scorer(texts), removed_ids)
+    if dropped > 0:
+        print(f"Invalidated {dropped} cached answers")
+
+
+def bootstrap_chunk_manifest():
+    """Builds the chunk manifest out of what is already in Chroma, for stores ingested before it existed."""
+    context = get_retrieval_context()
+    data = context.db.get(include=["metadatas"])
+
+    units = {}
+    for chunk_id, metadata in zip(data["ids"], data["metadatas"]):
+        unit = (metadata.get("source"), str(metadata.get("page")))
+        units.setdefault(unit, []).append(chunk_id)
+
+    with context.chunk_manifest.update() as manifest:
+        for (source, page), ids in units.items():
+            manifest.set_unit(source, page, ids)
+    print(f"Built chunk manifest for {len(data['ids'])} existing documents")
+
+
+def store_chunks(chunks: list[Document], batch_size: int, max_workers: int):
+    """
+    Embeds and writes chunks one window of batch_size * max_workers at a time.
+
+    Each window is embedded concurrently first, which fills the embedding cache, and is then
+    written to Chroma (whose own embedding call is now all cache hits) and, as a segment of
+    its own, to the sparse index; the index's size-tiered merging keeps small segments cheap.
+    An interrupted ingest keeps every finished window in both, and re-running it only embeds
+    what is left.
+    """
+    context = get_retrieval_context()
+    window = batch_size * max_workers
+
+    for start in range(0, len(chunks), window):
+        batch = chunks[start:start + window]
+        batch_ids = [chunk.metadata["id"] for chunk in batch]
+        batch_texts = [chunk.page_content for chunk in batch]
+
+        context.embedding_function.embed_documents(batch_texts, batch_size=batch_size, max_workers=max_workers)
+        context.db.add_documents(batch, ids=batch_ids)
+        context.sparse_index.add(batch_ids, batch_texts)
+        print(f"Stored {min(start + window, len(chunks))}/{len(chunks)} chunks")
+
 def llm_curation(chunks: list[Document]):
     """
     Gets documentation change suggestions from an LLM and executes them.
+    Pipelines don't call this directly; curation_queue workers run it for queued jobs.
+    Raises curate.CurationError if no suggestions could be made, or if the suggested changes
+    were rolled back, so the queue retries the job. Queries rejected by validation are only
+    reported: retrying would get the same ones rejected again.
     """
     print(f"Starting LLM curation for {len(chunks)} chunks...")
     
@@ -131,7 +229,7 @@ def llm_curation(chunks: list[Document]):
     for result in results:
         print(f"Query: {result['query']}")
         print(f"Status: {result['status']}")
-        if result['status'] == 'error':
+        if result['status'] != 'success':
             error_count += 1
             print(f"Details: {result['details']}")
         else:
@@ -139,43 +237,130 @@ def llm_curation(chunks: list[Document]):
         print("-" * 10)
     
     print(f"LLM Curation finished. {success_count} queries succeeded, {error_count} failed.")
+    rolled_back = [result for result in results if result['status'] == 'error']
+    if rolled_back:
+        raise CurationError(f"{len(rolled_back)} queries rolled back: {rolled_back[0]['details']}")
 
 
 def calculate_chunk_ids(chunks):
-    last_page_id = None
-    current_chunk_index = 0
+    """
+    Ids are "<source>:<page>:<content hash>", so a chunk keeps its id for as long as its text
+    is unchanged, wherever it ends up on the page. Identical chunks on the same page get an
+    occurrence suffix.
+    """
+    seen = {}
 
     for chunk in chunks:
         source = chunk.metadata.get("source")
         page = chunk.metadata.get("page")
-        current_page_id = f"{source}:{page}"
+        digest = hashlib.sha256(chunk.page_content.encode("utf-8")).hexdigest()[:16]
+        chunk_id = f"{source}:{page}:{digest}"
 
-        if current_page_id == last_page_id:
-            current_chunk_index += 1
-        else:
-            current_chunk_index = 0
-
-        chunk_id = f"{current_page_id}:{current_chunk_index}"
-        last_page_id = current_page_id
+        occurrence = seen.get(chunk_id, 0)
+        seen[chunk_id] = occurrence + 1
+        if occurrence > 0:
+            chunk_id = f"{chunk_id}:{occurrence}"
 
         chunk.metadata["id"] = chunk_id
 
     return chunks
 
+
+"""
+Compares the files in directory against the chunk manifest.
+
+Returns (changed, removed): files that are new or modified since their last ingest, and
+files that were ingested before but are gone now.
+"""
+def diff_directory(directory: str, suffix: str = ""):
+    manifest = get_retrieval_context().chunk_manifest
+    manifest.reload()
+    paths = list_files(directory, suffix)
+    return manifest.changed_files(paths), manifest.missing_files(directory, paths)
+
+
+"""
+Takes files diff_directory reported as changed and hashes them.
+
+Returns (changed, hashes): the files whose content differs from their last ingest, and
+{path: sha256} for all of them. Files with the same content as before (only their mtime
+moved) are recorded as ingested again, so they aren't hashed next time.
+"""
+def filter_unchanged_contents(paths: list[str]):
+    manifest = get_retrieval_context().chunk_manifest
+    hashes = {path: file_hash(path) for path in paths}
+    unchanged = [path for path in paths if manifest.same_contents(path, hashes[path])]
+    if len(unchanged) > 0:
+        record_ingested_files(unchanged, [], hashes)
+    return [path for path in paths if path not in unchanged], hashes
+
+
+def record_ingested_files(changed: list[str], removed: list[str], hashes: dict[str, str] = None):
+    with get_retrieval_context().chunk_manifest.update() as manifest:
+        manifest.record_files(changed, hashes)
+        manifest.forget_files(removed)
+
+
+def prune_pages(source: str, pages: set):
+    """Removes everything stored for pages of source other than pages (a re-ingested file that got shorter)."""
+    context = get_retrieval_context()
+    manifest = context.chunk_manifest
+    manifest.reload()
+    stale = {page: ids for page, ids in manifest.source_ids(source).items() if page not in {str(p) for p in pages}}
+    if len(stale) == 0:
+        return
+
+    stale_ids = [chunk_id for ids in stale.values() for chunk_id in ids]
+    print(f"Removing stale documents: {len(stale_ids)}")
+    context.db.delete(ids=stale_ids)
+    context.sparse_index.delete(stale_ids)
+    with manifest.update():
+        for page in stale:
+            manifest.set_unit(source, page, [])
+    context.refresh()
+    invalidate_cached_answers([], stale_ids)
+
 """
 Set default to False if low API rates
 """
 def pdf_pipeline(run_curation: bool = True):
-    documents = load_pdf_documents()
-    chunks = split_documents(documents)
-    if add_to_chroma(chunks) == 0:
+    changed, removed = diff_directory(DATA_PATH, ".pdf")
+    changed, hashes = filter_unchanged_contents(changed)
+    if len(changed) == 0 and len(removed) == 0:
+        print("No changed PDFs")
+        return
+
+    # Pages are split and embedded as they come out of the parsing pool, PDF_EMBED_PAGES at a time
+    documents = []
+    batch = []
+    pages = {}
+    failed = []
+    added = 0
+    for path, number, text in iter_pdf_pages(changed, failed, PDF_WORKERS, PDF_PAGES_PER_TASK):
+        if not text.strip():
+            continue
+        document = Document(page_content=text, metadata={"source": path, "page": number, "type": "pdf"})
+        documents.append(document)
+        batch.append(document)
+        pages.setdefault(path, set()).add(number)
+        if len(batch) >= PDF_EMBED_PAGES:
+            added += add_to_chroma(split_documents(batch))
+            batch = []
+    if len(batch) > 0:
+        added += add_to_chroma(split_documents(batch))
+
+    # Files that failed to parse are left as they were and retried next time
+    ingested = [path for path in changed if path not in failed]
+    for path in ingested:
+        prune_pages(path, pages.get(path, set()))
+    if len(removed) > 0:
+        add_to_chroma([], replace_sources=removed)
+    record_ingested_files(ingested, removed, hashes)
+    if added == 0:
         return
 
     if (run_curation):
-        try:
-            llm_curation(documents)
-        except:
-            print("Curation failed.")
+        enqueue_curation(documents)
 
 """
 Set default to False if low API rates
@@ -187,62 +372,79 @@ def slack_pipeline(messages, run_curation: bool = True):
         return
 
     if (run_curation):
-        try:
-            llm_curation(documents)
-        except:
-            print("Curation failed")
+        enqueue_curation(documents)
 
 """
 Set default to False if low API rates
 """
 def terminal_pipeline(run_curation: bool = True):
-    documents = load_terminal_documents()
-    chunks = split_documents(documents)
-    if add_to_chroma(chunks) == 0:
+    offsets = load_offsets()
+    paths = list_files(TERMINAL_LOG_PATH)
+    changed = [path for path in paths if log_changed(path, offsets.get(path))]
+    _, removed = diff_directory(TERMINAL_LOG_PATH)
+    removed = sorted(set(removed) | (set(offsets) - set(paths)))
+    if len(changed) == 0 and len(removed) == 0:
+        print("No changed terminal logs")
+        return
+
+    # Only what was appended to each log since the last run is read and embedded
+    documents = []
+    added = 0
+    for path in changed:
+        records, offsets[path], from_start = read_new_records(path, offsets.get(path))
+        new_documents = load_terminal_documents(path, records)
+        chunks = split_documents(new_documents)
+        added += add_to_chroma(chunks, replace_sources=[path] if from_start else None)
+        save_offsets(offsets)
+        documents.extend(new_documents)
+
+    if len(removed) > 0:
+        add_to_chroma([], replace_sources=removed)
+        for path in removed:
+            offsets.pop(path, None)
+        save_offsets(offsets)
+    record_ingested_files(changed, removed)
+    if added == 0:
         return
     
     if (run_curation):
-        try:
-            llm_curation(documents)
-        except:
-            print("Curation failed.")
+        enqueue_curation(documents)
 
 """
 Set default to False if low API rates
 """
-def git_pr_pipeline(run_curation: bool = True):
-    documents = load_github_prs()
-    chunks = split_documents(documents)
+def git_pr_pipeline(prs, run_curation: bool = True):
+    documents, diff_chunks = load_github_prs(prs)
+    chunks = split_documents(documents) + diff_chunks
     if add_to_chroma(chunks) == 0:
         return
     if (run_curation):
-        try:
-            llm_curation(documents)
-        except:
-            print("Curation failed.")
+        enqueue_curation(documents)
 
 
 def remove_all():
-    db = Chroma(
-        persist_directory=CHROMA_PATH, embedding_function=get_embedding_function()
-    )
+    context = get_retrieval_context()
+    db = context.db
 
     existing_items = db.get(include=[])
     existing_ids = existing_items["ids"]
 
     db.delete(ids=existing_ids)
+    context.sparse_index.clear()
+    with context.chunk_manifest.update() as manifest:
+        manifest.clear()
+    context.answer_cache.clear()
+    context.refresh()
 
 
 def dense_relevant_documents(query: str, num_docs: int):
-    embedding_function = get_embedding_function()
-    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=embedding_function)
-
-    results = db.similarity_search(query=query, k=num_docs)
+    with get_retrieval_context().reading() as db:
+        results = db.similarity_search(query=query, k=num_docs)
 
     return results
 
 
 if __name__ == "__main__":
     pdf_pipeline()
-    # git_pr_pipeline()
+    # GitHub PRs are ingested by github/fetch_prs.py
     # terminal_pipeline()
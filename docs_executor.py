@@ -0,0 +1,246 @@
+"""
+Validates curation SQL locally and runs it against the docs database as one transaction.
+
+validate_statements() checks every statement before anything is sent:
+- it must be a single INSERT, UPDATE or DELETE on collections, pages or page_blocks;
+- statements the docs snapshot can parse are dry-run, in order, on a copy of the snapshot,
+  so duplicate ids, references to pages or collections that don't exist, and updates or
+  deletes that match nothing are caught without a round trip.
+Rejected statements are left out; statements that depended on them fail the dry run too.
+
+The accepted statements, plus the docs_meta version bump, then go to a backend in one
+transaction, so a failure leaves the docs untouched:
+- PostgresBackend: a pooled psycopg2 connection (DOCS_DATABASE_URL, e.g. Supabase's direct
+  Postgres connection string);
+- SQLiteBackend: a local sqlite file with the same schema (DOCS_SQLITE_PATH), for tests;
+- SupabaseRpcBackend: the fallback, sending the whole batch in one execute_sql RPC call,
+  which Postgres runs as a single transaction.
+"""
+import copy
+import re
+import sqlite3
+import threading
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+from docs_snapshot import (
+    TABLES, StatementError, UnsupportedStatement,
+    apply_statement, empty_tables, parse_statement, tables_from_tree,
+)
+
+ALLOWED_STATEMENT = re.compile(
+    r"""^\s*(?:insert\s+into|update|delete\s+from)\s+(?:"?public"?\.)?"?(?P<table>\w+)"?""",
+    re.IGNORECASE,
+)
+
+STRING_OR_CAST = re.compile(r"('(?:[^']|'')*')|::\w+")
+
+BUMP_VERSION = "UPDATE docs_meta SET version = version + 1 WHERE id = 1"
+
+
+def _without_strings(sql: str) -> str:
+    return re.sub(r"'(?:[^']|'')*'", "''", sql)
+
+
+def _terminated(sql: str) -> str:
+    return sql.strip().rstrip(";").strip() + ";"
+
+
+def validate_statements(statements: list, tables: dict):
+    """
+    Checks statements against the rules above, dry-running them on a copy of tables.
+    Returns (accepted statements in order, {index in statements: reason} for rejected ones).
+    """
+    state = copy.deepcopy(tables)
+    accepted = []
+    rejected = {}
+    for index, sql in enumerate(statements):
+        if not isinstance(sql, str) or not sql.strip():
+            rejected[index] = "not a SQL statement"
+            continue
+
+        match = ALLOWED_STATEMENT.match(sql)
+        if match is None or match.group("table").lower() not in TABLES:
+            rejected[index] = "only INSERT, UPDATE and DELETE on collections, pages and page_blocks are allowed"
+            continue
+        if ";" in _without_strings(sql).strip().rstrip(";"):
+            rejected[index] = "one statement per query"
+            continue
+
+        try:
+            statement = parse_statement(sql)
+        except UnsupportedStatement:
+            # Valid-looking but too complex to dry-run (expressions, subqueries); the database decides.
+            accepted.append(sql)
+            continue
+        except StatementError as e:
+            rejected[index] = str(e)
+            continue
+
+        try:
+            if apply_statement(state, statement) == 0:
+                raise StatementError(f"{statement.kind.upper()} matches no rows in {statement.table}")
+        except StatementError as e:
+            rejected[index] = str(e)
+            continue
+        accepted.append(sql)
+
+    return accepted, rejected
+
+
+class PostgresBackend:
+    def __init__(self, dsn: str, min_connections: int = 1, max_connections: int = 4):
+        self.pool = ThreadedConnectionPool(min_connections, max_connections, dsn)
+        self._has_meta = None
+
+    def fetch_tables(self):
+        try:
+            with self._connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                tables = empty_tables()
+                for table in TABLES:
+                    cursor.execute(f"SELECT * FROM {table}")
+                    tables[table] = {str(row["id"]): _plain(row) for row in cursor.fetchall()}
+                return tables
+        except Exception as e:
+            print(f"Error fetching docs structure: {e}")
+            return None
+
+    def fetch_version(self):
+        try:
+            with self._connection() as conn, conn.cursor() as cursor:
+                if not self._meta_exists(cursor):
+                    return None
+                cursor.execute("SELECT version FROM docs_meta WHERE id = 1")
+                row = cursor.fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            print(f"Error fetching docs version: {e}")
+            return None
+
+    def execute_batch(self, statements: list[str]):
+        """Runs statements and the version bump in one transaction. Returns the new version."""
+        with self._connection() as conn, conn.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+            if not self._meta_exists(cursor):
+                return None
+            cursor.execute(f"{BUMP_VERSION} RETURNING version")
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def _meta_exists(self, cursor) -> bool:
+        if self._has_meta is None:
+            cursor.execute("SELECT to_regclass('docs_meta') IS NOT NULL")
+            self._has_meta = cursor.fetchone()[0]
+        return self._has_meta
+
+    def _connection(self):
+        return _PooledConnection(self.pool)
+
+
+class _PooledConnection:
+    """Borrows a connection for one transaction: commits on success, rolls back on error."""
+
+    def __init__(self, pool: ThreadedConnectionPool):
+        self.pool = pool
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = self.pool.getconn()
+        return self.conn
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.pool.putconn(self.conn)
+
+
+def _plain(row: dict) -> dict:
+    """Makes a Postgres row JSON-friendly, like the Supabase REST API returns it."""
+    return {k: v if v is None or isinstance(v, (str, int, float, bool, list, dict)) else str(v) for k, v in row.items()}
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS collections (id TEXT PRIMARY KEY, slug TEXT, label TEXT, position INTEGER);
+CREATE TABLE IF NOT EXISTS pages (
+    id TEXT PRIMARY KEY, collection_id TEXT NOT NULL REFERENCES collections (id) ON DELETE CASCADE,
+    slug TEXT, title TEXT, position INTEGER
+);
+CREATE TABLE IF NOT EXISTS page_blocks (
+    id TEXT PRIMARY KEY, page_id TEXT NOT NULL REFERENCES pages (id) ON DELETE CASCADE,
+    kind TEXT, content TEXT, position INTEGER, meta TEXT
+);
+CREATE TABLE IF NOT EXISTS docs_meta (id INTEGER PRIMARY KEY, version INTEGER NOT NULL);
+INSERT OR IGNORE INTO docs_meta VALUES (1, 0);
+"""
+
+
+class SQLiteBackend:
+    """Local stand-in for the docs database. Postgres casts (::jsonb, ::uuid) are dropped."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.executescript(SQLITE_SCHEMA)
+
+    def fetch_tables(self):
+        tables = empty_tables()
+        with self._lock:
+            for table in TABLES:
+                cursor = self._conn.execute(f"SELECT * FROM {table}")
+                columns = [column[0] for column in cursor.description]
+                tables[table] = {row[0]: dict(zip(columns, row)) for row in cursor.fetchall()}
+        return tables
+
+    def fetch_version(self):
+        with self._lock:
+            return self._conn.execute("SELECT version FROM docs_meta WHERE id = 1").fetchone()[0]
+
+    def execute_batch(self, statements: list[str]):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for sql in statements:
+                    self._conn.execute(STRING_OR_CAST.sub(lambda m: m.group(1) or "", sql))
+                self._conn.execute(BUMP_VERSION)
+                version = self._conn.execute("SELECT version FROM docs_meta WHERE id = 1").fetchone()[0]
+                self._conn.execute("COMMIT")
+                return version
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+
+class SupabaseRpcBackend:
+    def __init__(self, client):
+        self.client = client
+
+    def fetch_tables(self):
+        try:
+            response = self.client.from_("collections").select("*, pages(*, page_blocks(*))").execute()
+            return tables_from_tree(response.data or [])
+        except Exception as e:
+            print(f"Error fetching docs structure: {e}")
+            return None
+
+    def fetch_version(self):
+        """The docs_meta version, or None if it can't be read (e.g. the table doesn't exist yet)."""
+        try:
+            response = self.client.from_("docs_meta").select("version").eq("id", 1).execute()
+            return response.data[0]["version"] if response.data else None
+        except Exception as e:
+            print(f"Error fetching docs version: {e}")
+            return None
+
+    def execute_batch(self, statements: list[str]):
+        batch = " ".join(_terminated(sql) for sql in statements)
+        if self.fetch_version() is not None:
+            batch += f" {BUMP_VERSION};"
+        # execute_sql runs its whole argument inside one function call, i.e. one transaction
+        self.client.rpc("execute_sql", {"query": batch}).execute()
+        return self.fetch_version()
@@ -0,0 +1,393 @@
+"""
+Local, versioned snapshot of the documentation tree (collections -> pages -> page_blocks).
+
+The docs database keeps a version number in docs_meta that every writer bumps after
+changing the docs:
+
+    CREATE TABLE docs_meta (id int PRIMARY KEY, version bigint NOT NULL);
+    INSERT INTO docs_meta VALUES (1, 0);
+
+sync() reads only that number and refetches the whole tree when it differs from the
+snapshot's. Changes we make ourselves don't need a refetch: apply() replays the executed
+INSERT/UPDATE/DELETE statements on the snapshot and adopts the bumped version. If a
+statement can't be replayed (anything beyond literal values and `col = literal AND ...`
+filters), or someone else wrote in between, the snapshot is marked dirty and the next
+sync() refetches.
+
+Rendered pages are cached until the next change.
+"""
+import json
+import os
+import re
+import threading
+
+# table -> (foreign key column, parent table)
+TABLES = {
+    "collections": None,
+    "pages": ("collection_id", "collections"),
+    "page_blocks": ("page_id", "pages"),
+}
+
+CHILD_TABLES = {"collections": "pages", "pages": "page_blocks"}
+
+TOKEN_RE = re.compile(
+    r"""\s*(?:
+        (?P<string>'(?:[^']|'')*')
+      | (?P<number>-?\d+(?:\.\d+)?)
+      | (?P<ident>[A-Za-z_][A-Za-z0-9_]*|"(?:[^"]|"")+")
+      | (?P<symbol>::|[(),=;*.])
+    )""",
+    re.VERBOSE,
+)
+
+
+class UnsupportedStatement(ValueError):
+    """The statement is valid SQL, maybe, but not something the snapshot can replay."""
+
+
+class StatementError(ValueError):
+    """The statement would fail against the docs tree (unknown table, duplicate id, missing parent...)."""
+
+
+class Statement:
+    def __init__(self, kind: str, table: str, rows: list = None, assignments: dict = None, where: dict = None):
+        self.kind = kind
+        self.table = table
+        self.rows = rows or []
+        self.assignments = assignments or {}
+        self.where = where or {}
+
+
+def tokenize(sql: str) -> list:
+    tokens = []
+    position = 0
+    sql = sql.strip()
+    while position < len(sql):
+        match = TOKEN_RE.match(sql, position)
+        if match is None or match.end() == position:
+            raise UnsupportedStatement(f"can't read SQL near {sql[position:position + 20]!r}")
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "ident" and text.startswith('"'):
+            text = text[1:-1].replace('""', '"')
+        elif kind == "ident":
+            text = text.lower()
+        tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, sql: str):
+        self.tokens = tokenize(sql)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, expected: str = None):
+        kind, text = self.peek()
+        if kind is None or (expected is not None and text != expected):
+            raise UnsupportedStatement(f"expected {expected or 'more SQL'}, got {text!r}")
+        self.position += 1
+        return kind, text
+
+    def accept(self, expected: str) -> bool:
+        if self.peek()[1] == expected:
+            self.position += 1
+            return True
+        return False
+
+    def identifier(self) -> str:
+        kind, text = self.take()
+        if kind != "ident":
+            raise UnsupportedStatement(f"expected a name, got {text!r}")
+        return text
+
+    def table(self) -> str:
+        name = self.identifier()
+        if self.accept("."):
+            # schema-qualified, e.g. public.pages
+            name = self.identifier()
+        return name
+
+    def value(self):
+        kind, text = self.take()
+        if kind == "string":
+            value = text[1:-1].replace("''", "'")
+        elif kind == "number":
+            value = float(text) if "." in text else int(text)
+        elif kind == "ident" and text in ("null", "true", "false"):
+            value = {"null": None, "true": True, "false": False}[text]
+        else:
+            raise UnsupportedStatement(f"only literal values can be replayed, got {text!r}")
+
+        if self.accept("::"):
+            cast = self.identifier()
+            if cast in ("json", "jsonb") and isinstance(value, str):
+                value = json.loads(value)
+        return value
+
+    def where(self) -> dict:
+        conditions = {}
+        if not self.accept("where"):
+            return conditions
+        while True:
+            column = self.identifier()
+            self.take("=")
+            conditions[column] = self.value()
+            if not self.accept("and"):
+                return conditions
+
+    def end(self):
+        self.accept(";")
+        if self.position != len(self.tokens):
+            raise UnsupportedStatement("only one statement at a time can be replayed")
+
+
+def parse_statement(sql: str) -> Statement:
+    """Parses one INSERT, UPDATE or DELETE with literal values. Raises UnsupportedStatement otherwise."""
+    parser = _Parser(sql)
+    verb = parser.identifier()
+
+    if verb == "insert":
+        parser.take("into")
+        table = parser.table()
+        parser.take("(")
+        columns = [parser.identifier()]
+        while parser.accept(","):
+            columns.append(parser.identifier())
+        parser.take(")")
+        parser.take("values")
+        rows = []
+        while True:
+            parser.take("(")
+            values = [parser.value()]
+            while parser.accept(","):
+                values.append(parser.value())
+            parser.take(")")
+            if len(values) != len(columns):
+                raise StatementError(f"INSERT has {len(columns)} columns but {len(values)} values")
+            rows.append(dict(zip(columns, values)))
+            if not parser.accept(","):
+                break
+        parser.end()
+        return Statement("insert", table, rows=rows)
+
+    if verb == "update":
+        table = parser.table()
+        parser.take("set")
+        assignments = {}
+        while True:
+            column = parser.identifier()
+            parser.take("=")
+            assignments[column] = parser.value()
+            if not parser.accept(","):
+                break
+        where = parser.where()
+        parser.end()
+        return Statement("update", table, assignments=assignments, where=where)
+
+    if verb == "delete":
+        parser.take("from")
+        table = parser.table()
+        where = parser.where()
+        parser.end()
+        return Statement("delete", table, where=where)
+
+    raise UnsupportedStatement(f"{verb.upper()} statements can't be replayed")
+
+
+def apply_statement(tables: dict, statement: Statement) -> int:
+    """
+    Applies statement to tables ({table: {id: row}}) in place, enforcing primary keys and
+    parent references, and cascading deletes to children. Returns the number of rows affected.
+    """
+    if statement.table not in TABLES:
+        raise StatementError(f"unknown table {statement.table!r}")
+    rows = tables[statement.table]
+    reference = TABLES[statement.table]
+
+    def check_parent(row):
+        if reference is not None:
+            column, parent = reference
+            if row.get(column) not in tables[parent]:
+                raise StatementError(f"{statement.table}.{column} {row.get(column)!r} doesn't exist in {parent}")
+
+    if statement.kind == "insert":
+        for row in statement.rows:
+            if row.get("id") is None:
+                raise UnsupportedStatement(f"INSERT INTO {statement.table} without an explicit id")
+            if row["id"] in rows:
+                raise StatementError(f"duplicate id {row['id']!r} in {statement.table}")
+            check_parent(row)
+            rows[row["id"]] = dict(row)
+        return len(statement.rows)
+
+    matched = [row for row in rows.values() if all(row.get(k) == v for k, v in statement.where.items())]
+
+    if statement.kind == "update":
+        for row in matched:
+            updated = dict(row, **statement.assignments)
+            check_parent(updated)
+            if updated["id"] != row["id"]:
+                if updated["id"] in rows:
+                    raise StatementError(f"duplicate id {updated['id']!r} in {statement.table}")
+                del rows[row["id"]]
+            rows[updated["id"]] = updated
+        return len(matched)
+
+    for row in matched:
+        _delete(tables, statement.table, row["id"])
+    return len(matched)
+
+
+def _delete(tables: dict, table: str, row_id):
+    tables[table].pop(row_id, None)
+    child = CHILD_TABLES.get(table)
+    if child is not None:
+        column = TABLES[child][0]
+        for child_id in [cid for cid, row in tables[child].items() if row.get(column) == row_id]:
+            _delete(tables, child, child_id)
+
+
+def empty_tables() -> dict:
+    return {table: {} for table in TABLES}
+
+
+def tables_from_tree(collections: list) -> dict:
+    """Flattens a nested collections -> pages -> page_blocks tree into {table: {id: row}}."""
+    tables = empty_tables()
+    for collection in collections:
+        tables["collections"][collection["id"]] = {k: v for k, v in collection.items() if k != "pages"}
+        for page in collection.get("pages") or []:
+            tables["pages"][page["id"]] = {k: v for k, v in page.items() if k != "page_blocks"}
+            for block in page.get("page_blocks") or []:
+                tables["page_blocks"][block["id"]] = dict(block)
+    return tables
+
+
+def _by_position(rows):
+    return sorted(rows, key=lambda row: row.get("position") or 0)
+
+
+class DocsSnapshot:
+    def __init__(self, path: str, fetch_tables, fetch_version):
+        """
+        fetch_tables() returns every row as {table: {id: row}} (or None on failure); fetch_version()
+        returns the docs_meta version (or None if it can't be read, in which case every sync refetches).
+        """
+        self.path = path
+        self.fetch_tables = fetch_tables
+        self.fetch_version = fetch_version
+        self._lock = threading.RLock()
+        self._rendered = {}
+        self.tables = empty_tables()
+        self.version = None
+        self.dirty = True
+        self._load()
+
+    def sync(self) -> bool:
+        """Brings the snapshot up to date. Returns False if it couldn't be fetched and is empty."""
+        remote = self.fetch_version()
+        with self._lock:
+            if not self.dirty and remote is not None and remote == self.version:
+                return True
+
+        tables = self.fetch_tables()
+        with self._lock:
+            if tables is None:
+                print("Docs snapshot: refetch failed, using the last snapshot")
+                return self.version is not None
+            self.tables = tables
+            self.version = remote
+            self.dirty = remote is None
+            self._rendered.clear()
+            self._save()
+            return True
+
+    def apply(self, statements: list[str], new_version):
+        """
+        Replays statements that were just committed. new_version is docs_meta's
+        version after our bump; anything but our version + 1 means another writer got in too.
+        """
+        with self._lock:
+            for sql in statements:
+                try:
+                    apply_statement(self.tables, parse_statement(sql))
+                except ValueError as e:
+                    print(f"Docs snapshot: can't replay statement, will refetch ({e})")
+                    self.dirty = True
+                    break
+
+            if self.version is None or new_version != self.version + 1:
+                self.dirty = True
+            self.version = new_version
+            self._rendered.clear()
+            self._save()
+
+    def mark_dirty(self):
+        with self._lock:
+            self.dirty = True
+            self._save()
+
+    def tree(self) -> list:
+        """The snapshot in fetch_docs_tree()'s nested shape, everything sorted by position."""
+        with self._lock:
+            pages = {}
+            for page in _by_position(self.tables["pages"].values()):
+                blocks = [dict(b) for b in _by_position(self.tables["page_blocks"].values()) if b.get("page_id") == page["id"]]
+                pages.setdefault(page.get("collection_id"), []).append(dict(page, page_blocks=blocks))
+            return [
+                dict(collection, pages=pages.get(collection["id"], []))
+                for collection in _by_position(self.tables["collections"].values())
+            ]
+
+    def render(self, page_ids=None, collection_ids=None) -> str:
+        """
+        The docs structure as text, in get_docs_structure()'s format. collection_ids limits it
+        to those collections; page_ids shows only those pages' blocks, other pages by their row alone.
+        """
+        with self._lock:
+            collections = _by_position(self.tables["collections"].values())
+            if collection_ids is not None:
+                collections = [c for c in collections if c["id"] in collection_ids]
+            if not collections:
+                return "No documentation found."
+            return "\n".join(self.render_collection(c["id"], page_ids) for c in collections)
+
+    def render_collection(self, collection_id, page_ids=None) -> str:
+        with self._lock:
+            collection = self.tables["collections"][collection_id]
+            pages = _by_position(p for p in self.tables["pages"].values() if p.get("collection_id") == collection_id)
+            output = [f"Collection: {collection}"]
+            for page in pages:
+                expanded = page_ids is None or page["id"] in page_ids
+                output.append(self.render_page(page["id"]) if expanded else f"  Page: {page}")
+            output.append("-" * 20)
+            return "\n".join(output)
+
+    def render_page(self, page_id) -> str:
+        with self._lock:
+            if page_id not in self._rendered:
+                page = self.tables["pages"][page_id]
+                blocks = _by_position(b for b in self.tables["page_blocks"].values() if b.get("page_id") == page_id)
+                self._rendered[page_id] = "\n".join([f"  Page: {page}"] + [f"    Block: {block}" for block in blocks])
+            return self._rendered[page_id]
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.tables = data["tables"]
+            self.version = data["version"]
+            self.dirty = data["dirty"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "dirty": self.dirty, "tables": self.tables}, f)
+        os.replace(tmp_path, self.path)
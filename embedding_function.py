@@ -1,12 +1,113 @@
+import math
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from langchain_community.embeddings import ollama
+from langchain_core.embeddings import Embeddings
+from aggregate_documents import (
+    EMBEDDING_CACHE_PATH, EMBEDDING_MODEL, EMBED_BATCH_SIZE, EMBED_CONCURRENCY, EMBEDDING_BACKEND, HASH_EMBEDDING_DIM,
+)
+from embedding_cache import EmbeddingCache, content_key
+from sparse_index import tokenize
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding backend with the persistent content-hash cache.
+
+    Texts already in the cache are never sent to the backend again. Misses are split into
+    batches of at most batch_size, with at most max_workers batches in flight, and each batch
+    is written to the cache as soon as it comes back so a crash only loses the batches still
+    in flight.
+
+    A batch is not one request: OllamaEmbeddings embeds a batch one text per request (its
+    /api/embeddings endpoint takes a single prompt). The batch endpoint, /api/embed, returns
+    normalized vectors, which can't be mixed with the ones already in Chroma. Concurrency is
+    what max_workers buys, so misses are spread over every worker rather than packed into
+    full batches that would leave some of them idle.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, namespace: str,
+                 batch_size: int = EMBED_BATCH_SIZE, max_workers: int = EMBED_CONCURRENCY):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.namespace = namespace
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+
+    def embed_documents(self, texts: list[str], batch_size: int = None, max_workers: int = None) -> list[list[float]]:
+        batch_size = batch_size or self.batch_size
+        max_workers = max_workers or self.max_workers
+        keys = [content_key(f"{self.namespace}:document", text) for text in texts]
+        vectors = self.cache.get_many(set(keys))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing[key] = text
+
+        if missing:
+            missing_keys = list(missing)
+            size = min(batch_size, math.ceil(len(missing_keys) / max_workers))
+            batches = [missing_keys[i:i + size] for i in range(0, len(missing_keys), size)]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(self.embeddings.embed_documents, [missing[key] for key in batch]): batch
+                    for batch in batches
+                }
+                for future in as_completed(futures):
+                    embedded = dict(zip(futures[future], future.result()))
+                    self.cache.put_many(embedded)
+                    vectors.update(embedded)
+
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        key = content_key(f"{self.namespace}:query", text)
+        cached = self.cache.get_many([key])
+        if key in cached:
+            return cached[key]
+
+        vector = self.embeddings.embed_query(text)
+        self.cache.put_many({key: vector})
+        return vector
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Deterministic, offline stand-in for the embedding model (EMBEDDING_BACKEND=hash), so
+    benchmarks run without ollama or a network. Every token and pair of adjacent tokens is
+    hashed into one of dim buckets with a hashed sign, and the vector is L2-normalized, so
+    texts that share words still end up close together.
+    """
+
+    def __init__(self, dim: int = HASH_EMBEDDING_DIM):
+        self.dim = dim
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+    def _embed(self, text: str) -> list[float]:
+        vector = [0.0] * self.dim
+        tokens = tokenize(text)
+        for feature in tokens + [f"{left} {right}" for left, right in zip(tokens, tokens[1:])]:
+            hashed = zlib.crc32(feature.encode("utf-8"))
+            vector[hashed % self.dim] += 1.0 if hashed & 0x80000000 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
 
 
 def get_embedding_function():
-    ollama_emb = ollama.OllamaEmbeddings(model='nomic-embed-text')
+    if EMBEDDING_BACKEND == "hash":
+        return CachedEmbeddings(HashEmbeddings(), EmbeddingCache(EMBEDDING_CACHE_PATH), namespace=f"hash-{HASH_EMBEDDING_DIM}")
+
+    ollama_emb = ollama.OllamaEmbeddings(model=EMBEDDING_MODEL)
 
-    return ollama_emb
+    return CachedEmbeddings(ollama_emb, EmbeddingCache(EMBEDDING_CACHE_PATH), namespace=EMBEDDING_MODEL)
 
 
 if __name__ == "__main__":
     test_vectorizer = get_embedding_function()
-    print(test_vectorizer)
\ No newline at end of file
+    print(test_vectorizer)
@@ -1,56 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+from langchain.schema import Document
+from aggregate_documents import DENSE_WEIGHT, SPARSE_WEIGHT, RRF_K, GRADE_DOCUMENTS, GRADE_ENOUGH, document_key
 from dense_embeddings import dense_relevant_documents
 from sparse_embeddings import sparse_relevant_documents
 from grade_documents import grade
 from rank_documents import rank_docs
 import time
 
+# Shared across requests so dense and sparse retrieval of one query run side by side
+retrieval_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
 
-def get_docs(query_text: str):
+
+def timed(function, *args):
     start = time.time()
-    dense_results = dense_relevant_documents(query_text, 5)
-    end = time.time()
-    time_dense = end - start
+    result = function(*args)
+    return result, time.time() - start
+
+
+"""
+Weighted reciprocal-rank fusion.
+
+Each document scores sum(weight / (k + rank)) over the result lists it appears in, with
+rank starting at 1. Documents are deduplicated by chunk id (or content hash).
+"""
+def reciprocal_rank_fusion(result_lists: list[list[Document]], weights: list[float], k: int = RRF_K):
+    scores = {}
+    documents = {}
+    for results, weight in zip(result_lists, weights):
+        for rank, document in enumerate(results, start=1):
+            key = document_key(document)
+            scores[key] = scores.get(key, 0.0) + weight / (k + rank)
+            documents.setdefault(key, document)
+
+    ranked_keys = sorted(scores, key=scores.get, reverse=True)
+    return [documents[key] for key in ranked_keys]
 
+
+def get_docs(query_text: str, dense_weight: float = DENSE_WEIGHT, sparse_weight: float = SPARSE_WEIGHT):
     start = time.time()
-    sparse_results = sparse_relevant_documents(query_text, 5)
-    end = time.time()
-    time_sparse = end - start
+    dense_future = retrieval_pool.submit(timed, dense_relevant_documents, query_text, 5)
+    sparse_future = retrieval_pool.submit(timed, sparse_relevant_documents, query_text, 5)
+    dense_results, time_dense = dense_future.result()
+    sparse_results, time_sparse = sparse_future.result()
+    time_retrieval = time.time() - start
 
     if len(dense_results) == 0 and len(sparse_results) == 0:
         print("Unable to find matching results.")
         return "Unable to find matching results.", []
 
     start = time.time()
-    # relevant_dense_documents, irrelevant_dense_documents = grade(dense_results, query_text)
-    relevant_dense_documents = dense_results
-    end = time.time()
-    time_relevant_dense = end - start
+    all_documents = reciprocal_rank_fusion(
+        [dense_results, sparse_results], [dense_weight, sparse_weight]
+    )
+    time_fusion = time.time() - start
 
+    # Grading the fused list grades each candidate once, best first, and stops early
     start = time.time()
-    # relevant_sparse_documents, irrelevant_sparse_documents = grade(sparse_results, query_text)
-    relevant_sparse_documents = sparse_results
+    if GRADE_DOCUMENTS:
+        relevant_documents, irrelevant_documents = grade(all_documents, query_text, enough=GRADE_ENOUGH)
+    else:
+        relevant_documents = all_documents
     end = time.time()
-    time_relevant_sparse = end - start
+    time_grade = end - start
 
-    if len(relevant_dense_documents) == 0 and len(relevant_sparse_documents):
+    if len(relevant_documents) == 0:
         print("Unable to find matching results.")
         return "Unable to find matching results.", []
 
-    all_documents = []
-    for document in relevant_sparse_documents:
-        all_documents.append(document)
-
-    for document in relevant_dense_documents:
-        found = False
-        for existing in all_documents:
-            if existing.metadata.get("id") == document.metadata.get("id"):
-                found = True
-        if not found:
-            all_documents.append(document)
-
     start = time.time()
-    # reranked_documents = rank_docs(all_documents, query_text)
-    reranked_documents = all_documents
+    reranked_documents = rank_docs(relevant_documents, query_text)
     end = time.time()
     time_rerank = end - start
 
@@ -62,7 +80,8 @@ def get_docs(query_text: str):
     print("-----------------")
     print(f"Dense retrieval: {time_dense}")
     print(f"Sparse retrieval: {time_sparse}")
-    print(f"Relevant dense: {time_relevant_dense}")
-    print(f"Relevant sparse: {time_relevant_sparse}")
+    print(f"Retrieval (concurrent): {time_retrieval}")
+    print(f"Fusion: {time_fusion}")
+    print(f"Grading: {time_grade}")
     print(f"Rerank: {time_rerank}")
-    return response_text, reranked_documents
\ No newline at end of file
+    return response_text, reranked_documents
@@ -1,264 +1,319 @@
-import requests
+import aiohttp
+import asyncio
 import json
 import os
 import sys
+import time
 from typing import List, Dict, Any
-import subprocess
+from urllib.parse import urlparse, parse_qs
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from dense_embeddings import git_pr_pipeline
+from ingest_daemon import submit
+from analyze_prs import extract_commit_info
+from pr_store import PRStore
 from dotenv import load_dotenv
 
+load_dotenv()
+
+# Point at github/mock_api.py (e.g. http://localhost:5055) to test without GitHub
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+
+# Requests in flight at once, which is also the size of the connection pool
+MAX_CONCURRENCY = int(os.getenv("GITHUB_CONCURRENCY", 8))
+
+PER_PAGE = 100
+
+MAX_RETRIES = 5
+
+DIFF_MEDIA_TYPE = "application/vnd.github.v3.diff"
+
+
+def parse_link_header(header: str) -> Dict[str, str]:
+    """Parses a Link header into {rel: url}."""
+    links = {}
+    for part in (header or "").split(","):
+        section = part.split(";")
+        if len(section) < 2:
+            continue
+        url = section[0].strip().strip("<>")
+        for param in section[1:]:
+            name, _, value = param.strip().partition("=")
+            if name == "rel":
+                links[value.strip('"')] = url
+    return links
+
+
+def page_number(url: str) -> int:
+    return int(parse_qs(urlparse(url).query).get("page", ["1"])[0])
+
+
 class GitHubPRFetcher:
-    def __init__(self, token: str = None):
+    """
+    Async GitHub client: one pooled aiohttp session, at most max_concurrency requests in flight.
+
+    validators maps URLs to the ETag/Last-Modified of their last response; conditional
+    requests send them back, and a 304 (which doesn't count against the rate limit) means
+    nothing changed. When GitHub says the rate limit is used up, every request waits for
+    the reset instead of failing. Use as `async with GitHubPRFetcher(...) as fetcher:`.
+    """
+
+    def __init__(self, token: str = None, base_url: str = GITHUB_API_URL,
+                 max_concurrency: int = MAX_CONCURRENCY, validators: Dict[str, Dict[str, str]] = None):
         self.token = token
-        self.base_url = "https://api.github.com"
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.validators = validators if validators is not None else {}
         self.headers = {
-            "Accept": "application/vnd.github.v3+json",
-            "User-Agent": "PR-Fetcher"
+            "Accept": "application/vnd.github+json",
+            "User-Agent": "PR-Fetcher",
+            "X-GitHub-Api-Version": "2022-11-28",
         }
         if token:
-            self.headers["Authorization"] = f"token {token}"
-    
-    def get_pull_requests(self, owner: str, repo: str, state: str = "open", 
-                         per_page: int = 30, page: int = 1) -> List[Dict[Any, Any]]:
+            self.headers["Authorization"] = f"Bearer {token}"
+        self.requests_made = 0
+        self.not_modified = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._paused_until = 0.0
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(
+            headers=self.headers, connector=connector, timeout=aiohttp.ClientTimeout(total=120)
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def request(self, url: str, accept: str = None, conditional: bool = False):
         """
-        Fetch pull requests from a GitHub repository
-        
-        Args:
-            owner: Repository owner
-            repo: Repository name
-            state: PR state ('open', 'closed', 'all')
-            per_page: Number of results per page (max 100)
-            page: Page number
+        GETs url, retrying rate limits and server errors. Returns (status, body, headers); body
+        is parsed JSON, or text if accept is given, and None for a 304.
         """
-        url = f"{self.base_url}/repos/{owner}/{repo}/pulls?per_page={per_page}&page={page}&state=all"
-        
-        try:
-            response = requests.get(url, headers=self.headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching PRs: {e}")
+        headers = {}
+        if accept:
+            headers["Accept"] = accept
+        validator = self.validators.get(url) if conditional else None
+        if validator and validator.get("etag"):
+            headers["If-None-Match"] = validator["etag"]
+        if validator and validator.get("last_modified"):
+            headers["If-Modified-Since"] = validator["last_modified"]
+
+        for attempt in range(MAX_RETRIES + 1):
+            await self._wait_for_rate_limit()
+            async with self._semaphore:
+                async with self.session.get(url, headers=headers) as response:
+                    self.requests_made += 1
+                    self._note_rate_limit(response.headers)
+                    if response.status == 304:
+                        self.not_modified += 1
+                        return 304, None, response.headers
+
+                    delay = None
+                    if attempt < MAX_RETRIES:
+                        if response.status in (403, 429):
+                            delay = self._rate_limit_delay(response.headers)
+                        elif response.status >= 500:
+                            delay = 2 ** attempt
+                    if delay is None:
+                        response.raise_for_status()
+                        body = await response.text() if accept else await response.json()
+                        if conditional:
+                            self._remember(url, response.headers)
+                        return response.status, body, response.headers
+
+            print(f"GitHub returned {response.status} for {url}, retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
+
+    async def get_pull_requests(self, owner: str, repo: str, since: str = None) -> List[Dict[Any, Any]]:
+        """
+        Pull requests updated after since (an ISO 8601 updated_at), most recently updated first.
+        With since=None the whole history is fetched, every page after the first concurrently.
+        PR bodies are included, so no per-PR request is needed.
+        """
+        url = f"{self.base_url}/repos/{owner}/{repo}/pulls?state=all&sort=updated&direction=desc&per_page={PER_PAGE}"
+        status, prs, headers = await self.request(url, conditional=True)
+        if status == 304:
             return []
-    
-    def get_all_pull_requests(self, owner: str, repo: str, state: str = "open") -> List[Dict[Any, Any]]:
-        """Fetch all pull requests across multiple pages"""
-        all_prs = []
-        page = 1
-        
-        while True:
-            print("H PAGE", page)
-            prs = self.get_pull_requests(owner, repo, state, per_page=50, page=page)
-            if not prs:
-                break
-            
-            all_prs.extend(prs)
-            page += 1
-            
-            # GitHub API returns fewer results when we've reached the end
-            
-            if len(prs) < 50:
-                break
-
-            if len(all_prs) >= 50:
-                break
-        
-        return all_prs
-    
-    def get_new_pull_requests(self, owner, repo, token, json_filename, refined_filename, state) -> List[Dict[Any, Any]]:
-        """Fetch all pull requests across multiple pages"""
-        new_prs = []
-        with open(json_filename, 'r') as f:
-            existing_prs = json.load(f)
-            print("Number of existing PRs:", len(existing_prs))
-            print(type(existing_prs))
-
-        existing_pr_numbers = set(existing_prs[i]["number"] for i in range(len(existing_prs)))
-        print(existing_pr_numbers)
-
-        url = f"{self.base_url}/repos/{owner}/{repo}/pulls?&page=1&per_page=20&state=all&sort=created&direction=desc"
-        response = requests.get(url, headers=self.headers)
-
-        recent_prs = response.json()
-        for pr in recent_prs:
-            if pr["number"] not in existing_pr_numbers:
-                print("New PR found:", pr["number"], pr["title"])
-                new_prs.append(pr)
-
-        if len(new_prs) == 0:
-            print("No new PRs found.")
-            return
-
-        new_json_filename = f"json/new_{owner}_{repo}_pull_requests.json"
-        new_refined_json_filename = f"json/new_{owner}_{repo}_refined_pr_info.json"
-        with open(new_json_filename, 'w') as f:
-            json.dump(new_prs, f, indent=2)
-
-        subprocess.run(["python3", "analyze_prs.py", new_json_filename, "n"], shell=False)
-
-        with open(new_refined_json_filename, 'r') as f:
-            new_pr_info = json.load(f)
-
-        for i in range(len(new_pr_info)):
-            result = subprocess.run([
-                                        "curl",
-                                        "-H", "Accept: application/vnd.github+json",
-                                        "-H", f"Authorization: Bearer {token}",
-                                        "-H", "X-GitHub-Api-Version: 2022-11-28",
-                                        f"https://api.github.com/repos/{owner}/{repo}/pulls/{new_pr_info[i]['pr_number']}",
-                                    ], capture_output=True, text=True)
-            pr_specific_info = json.loads(result.stdout)
-            pr_body = pr_specific_info["body"]
-            new_pr_info[i]['pr_body'] = pr_body
-
-            pr_number = new_pr_info[i]["pr_number"]
-            result = subprocess.run([
-                    "curl",
-                    "-L",
-                    "-H", f"Authorization: Bearer {token}",
-                    "-H", "Accept: application/vnd.github.v3.diff",
-                    "-H", "X-GitHub-Api-Version: 2022-11-28",
-                    f"https://api.github.com/repos/{owner}/{repo}/pulls/{pr_number}"
-                ], capture_output=True, text=True)
-            diff = result.stdout
-            new_pr_info[i]["diff"] = f'"""{diff}"""'
-
-        with open(new_refined_json_filename, 'w') as f:
-            json.dump(new_pr_info, f, indent=2)
-
-        with open(refined_filename, 'r') as f:
-            refined_existing_prs = json.load(f)
-
-        refined_existing_prs.extend(new_pr_info)
-        with open(refined_filename, 'w') as f:
-            json.dump(refined_existing_prs, f, indent=2)
-
-    
+        links = parse_link_header(headers.get("Link"))
+
+        if since is None and "last" in links:
+            pages = await asyncio.gather(*(
+                self.request(f"{url}&page={page}") for page in range(2, page_number(links["last"]) + 1)
+            ))
+            for _, page, _ in pages:
+                prs.extend(page)
+        else:
+            # Sorted by update time, so stop at the first page that reaches back past since
+            while "next" in links and not (since and prs and prs[-1]["updated_at"] <= since):
+                _, page, headers = await self.request(links["next"])
+                prs.extend(page)
+                links = parse_link_header(headers.get("Link"))
+
+        # A PR updated mid-sync can show up on two pages; keep its first (newest) copy
+        unique = {}
+        for pr in prs:
+            if since is None or pr["updated_at"] > since:
+                unique.setdefault(pr["number"], pr)
+        return list(unique.values())
+
+    async def get_diff(self, owner: str, repo: str, number: int):
+        """The PR's diff, or None if it hasn't changed since it was last fetched or GitHub won't render it."""
+        url = f"{self.base_url}/repos/{owner}/{repo}/pulls/{number}"
+        try:
+            status, diff, _ = await self.request(url, accept=DIFF_MEDIA_TYPE, conditional=True)
+        except aiohttp.ClientResponseError as e:
+            # 406 when the diff is too large for GitHub to generate
+            print(f"No diff for PR #{number}: {e.status} {e.message}")
+            return None
+        return None if status == 304 else diff
+
+    async def _wait_for_rate_limit(self):
+        delay = self._paused_until - time.time()
+        if delay > 0:
+            print(f"GitHub rate limit used up, waiting {delay:.0f}s for it to reset")
+            await asyncio.sleep(delay)
+
+    def _note_rate_limit(self, headers):
+        if headers.get("X-RateLimit-Remaining") == "0" and headers.get("X-RateLimit-Reset"):
+            self._paused_until = max(self._paused_until, float(headers["X-RateLimit-Reset"]) + 1)
+
+    def _rate_limit_delay(self, headers):
+        """Seconds to wait before retrying a 403/429, or None if it isn't a rate limit."""
+        if headers.get("Retry-After"):
+            return float(headers["Retry-After"])
+        if headers.get("X-RateLimit-Remaining") == "0" and headers.get("X-RateLimit-Reset"):
+            return max(1.0, float(headers["X-RateLimit-Reset"]) - time.time() + 1)
+        return None
+
+    def _remember(self, url: str, headers):
+        validator = {}
+        if headers.get("ETag"):
+            validator["etag"] = headers["ETag"]
+        if headers.get("Last-Modified"):
+            validator["last_modified"] = headers["Last-Modified"]
+        if validator:
+            self.validators[url] = validator
+
     def save_to_file(self, data: List[Dict[Any, Any]], filename: str):
         """Save PR data to JSON file"""
         with open(filename, 'w') as f:
             json.dump(data, f, indent=2)
         print(f"Saved {len(data)} pull requests to {filename}")
-    
+
     def get_pr_summary(self, prs: List[Dict[Any, Any]]) -> Dict[str, Any]:
         """Get summary statistics of pull requests"""
         if not prs:
             return {}
-        
+
         states = {}
         authors = {}
         labels = {}
-        
+
         for pr in prs:
             # Count states
             state = pr.get('state', 'unknown')
             states[state] = states.get(state, 0) + 1
-            
+
             # Count authors
             author = pr.get('user', {}).get('login', 'unknown')
             authors[author] = authors.get(author, 0) + 1
-            
+
             # Count labels
             for label in pr.get('labels', []):
                 label_name = label.get('name', 'unknown')
                 labels[label_name] = labels.get(label_name, 0) + 1
-        
+
         return {
             "total_prs": len(prs),
             "states": states,
             "top_authors": dict(sorted(authors.items(), key=lambda x: x[1], reverse=True)[:10]),
             "top_labels": dict(sorted(labels.items(), key=lambda x: x[1], reverse=True)[:10])
         }
-    
-    def add_pr_body_to_json(self, refined_json_filename: str, token, owner, repo):
-        """Add PR body descriptions to the refined PR info JSON file"""
-        with open(refined_json_filename, 'r') as f:
-            refined_pr_info = json.load(f)
-
-        for i in range(len(refined_pr_info)):
-            result = subprocess.run([
-                                        "curl",
-                                        "-H", "Accept: application/vnd.github+json",
-                                        "-H", f"Authorization: Bearer {token}",
-                                        "-H", "X-GitHub-Api-Version: 2022-11-28",
-                                        f"https://api.github.com/repos/{owner}/{repo}/pulls/{refined_pr_info[i]['pr_number']}",
-                                    ], capture_output=True, text=True)
-            pr_specific_info = json.loads(result.stdout)
-            print(type(pr_specific_info))
-            pr_body = pr_specific_info["body"]
-            refined_pr_info[i]['pr_body'] = pr_body
-
-        with open(refined_json_filename, 'w') as f:
-            json.dump(refined_pr_info, f, indent=2)
-
-    def add_diff_to_pr_info(self, owner, repo, refined_json_filename, token):
-        """
-        Add diff information to each PR dictionary in the JSON file.
-        """
-        with open(refined_json_filename, 'r') as f:
-            refined_pr_info = json.load(f)
-
-        for i in range(len(refined_pr_info)):
-            pr_number = refined_pr_info[i]["pr_number"]
-            result = subprocess.run([
-                    "curl",
-                    "-L",
-                    "-H", f"Authorization: Bearer {token}",
-                    "-H", "Accept: application/vnd.github.v3.diff",
-                    "-H", "X-GitHub-Api-Version: 2022-11-28",
-                    f"https://api.github.com/repos/{owner}/{repo}/pulls/{pr_number}"
-                ], capture_output=True, text=True)
-            diff = result.stdout
-            refined_pr_info[i]["diff"] = f'"""{diff}"""'
-        
-        with open(refined_json_filename, 'w') as f:
-            json.dump(refined_pr_info, f, indent=2)
+
+
+# PRs submitted for ingestion at a time
+INGEST_BATCH_SIZE = 100
+
+
+def open_store(owner: str, repo: str) -> PRStore:
+    store = PRStore(f"json/{owner}_{repo}_prs.sqlite3")
+    if len(store) == 0:
+        imported = store.import_json(f"json/{owner}_{repo}_refined_pr_info.json")
+        if imported:
+            print(f"Imported {imported} PRs from the old refined_pr_info file")
+    return store
+
+
+"""
+Fetches PRs updated since the last sync (everything if full), plus their diffs, and appends
+the new versions to the PR store.
+
+Returns the number of new PR versions.
+"""
+async def sync_pull_requests(store: PRStore, owner: str, repo: str, token: str, full: bool = False) -> int:
+    since = None if full else store.latest_updated_at()
+    validators = {} if full else store.get_meta("validators", {})
+    started = time.time()
+    async with GitHubPRFetcher(token, validators=validators) as fetcher:
+        prs = await fetcher.get_pull_requests(owner, repo, since=since)
+        print(f"Found {len(prs)} new or updated pull requests")
+        diffs = await asyncio.gather(*(fetcher.get_diff(owner, repo, pr["number"]) for pr in prs))
+        print(f"{fetcher.requests_made} requests ({fetcher.not_modified} not modified) in {time.time() - started:.1f}s")
+
+    records = []
+    for info, pr, diff in zip(extract_commit_info(prs), prs, diffs):
+        info["pr_body"] = pr.get("body")
+        info["diff"] = diff
+        records.append(info)
+
+    added = store.append(records)
+    store.set_meta("validators", fetcher.validators)
+    return added
+
+
+def ingest_pending(store: PRStore, batch_size: int = INGEST_BATCH_SIZE) -> int:
+    """Submits the PRs that changed since the last ingest, a batch at a time, each once the previous one is committed."""
+    ingested = 0
+    while True:
+        batch = store.pending(batch_size)
+        if not batch:
+            return ingested
+        submit("github", batch, wait=True)
+        store.mark_ingested(batch)
+        ingested += len(batch)
+        print(f"Ingested {ingested} changed PRs")
+
 
 def main():
     # Get GitHub token from environment variable
-    load_dotenv()
     token = os.getenv('GITHUB_TOKEN')
-    
+
     # Get repository name from command line argument
     if len(sys.argv) < 2:
-        print("Usage: python3 fetch_prs.py <owner/repo>")
+        print("Usage: python3 fetch_prs.py <owner/repo> [--full]")
         print("Example: python3 fetch_prs.py refinedev/refine")
         sys.exit(1)
-    
+
     repo_name = sys.argv[1].strip()
-    
+
     # Validate repository name format
     if '/' not in repo_name or len(repo_name.split('/')) != 2:
         print("Error: Repository name must be in format 'owner/repo'")
         print("Example: refinedev/refine")
         sys.exit(1)
-    
+
     if not token:
         print("Warning: No GITHUB_TOKEN found. API rate limits will be lower.")
-    
-    fetcher = GitHubPRFetcher(token)
 
     owner = repo_name.split('/')[0]
     repo = repo_name.split('/')[1]
-    
+
     print(f"Fetching pull requests from {owner}/{repo}...")
 
-    filename = f"json/{owner}_{repo}_pull_requests.json"
-    refined_json_filename = f"json/{owner}_{repo}_refined_pr_info.json"
-
-    if len(sys.argv) == 2:
-        all_prs = fetcher.get_all_pull_requests(owner, repo, state="all")
-        print(f"Found {len(all_prs)} total pull requests")
-        
-        # Save to file with repo name in filename
-        fetcher.save_to_file(all_prs, filename)
-        subprocess.run(["python3", "analyze_prs.py", filename], shell=False)
-        fetcher.add_pr_body_to_json(refined_json_filename, token, owner, repo)
-        fetcher.add_diff_to_pr_info(owner, repo, refined_json_filename, token)
-    else:
-        fetcher.get_new_pull_requests(owner, repo, token, filename, refined_json_filename, state="all")
-
-    git_pr_pipeline()
+    store = open_store(owner, repo)
+    asyncio.run(sync_pull_requests(store, owner, repo, token, full="--full" in sys.argv[2:]))
+    ingest_pending(store)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,149 @@
+"""
+Local stand-in for the GitHub pull request API, for testing fetch_prs.py without a token
+or rate limits:
+
+    python3 mock_api.py --prs 5000 --port 5055
+    GITHUB_API_URL=http://localhost:5055 python3 fetch_prs.py mock/repo
+
+Serves synthetic PRs on the same routes GitHub uses, with Link pagination, ETags (and
+304s for If-None-Match), X-RateLimit-* headers and per-request latency. --rate-limit makes
+it answer 403 once that many requests have been made in the current window, like GitHub does.
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, request
+
+app = Flask(__name__)
+
+prs = []
+settings = {"latency": 0.0, "rate_limit": 0, "window": 60}
+rate_state = {"used": 0, "reset": 0}
+rate_lock = threading.Lock()
+
+
+def make_prs(count: int, owner: str = "mock", repo: str = "repo"):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    result = []
+    for number in range(1, count + 1):
+        created = start + timedelta(hours=number)
+        stamp = created.strftime("%Y-%m-%dT%H:%M:%SZ")
+        result.append({
+            "number": number,
+            "title": f"Change {number}: update module_{number % 50}",
+            "body": f"This PR updates module_{number % 50} to handle case {number}.",
+            "state": "closed" if number % 3 else "open",
+            "user": {"login": f"dev{number % 7}"},
+            "labels": [{"name": "bug" if number % 2 else "feature"}],
+            "head": {"sha": hashlib.sha1(f"head{number}".encode()).hexdigest(), "ref": f"feature/{number}"},
+            "base": {"sha": hashlib.sha1(f"base{number}".encode()).hexdigest(), "ref": "main"},
+            "merge_commit_sha": None,
+            "created_at": stamp,
+            "updated_at": stamp,
+            "merged_at": None,
+        })
+    return result
+
+
+def make_diff(pr) -> str:
+    number = pr["number"]
+    return (
+        f"diff --git a/src/module_{number % 50}.py b/src/module_{number % 50}.py\n"
+        f"index {pr['base']['sha'][:7]}..{pr['head']['sha'][:7]} 100644\n"
+        f"--- a/src/module_{number % 50}.py\n"
+        f"+++ b/src/module_{number % 50}.py\n"
+        f"@@ -1,3 +1,4 @@\n"
+        f" def handle(value):\n"
+        f"+    # case {number}\n"
+        f"     return value\n"
+    )
+
+
+def respond(body: str, mimetype: str, headers: dict = None):
+    """Applies latency, rate limiting and ETags the way GitHub would."""
+    if settings["latency"]:
+        time.sleep(settings["latency"])
+
+    with rate_lock:
+        now = time.time()
+        if now >= rate_state["reset"]:
+            rate_state["used"] = 0
+            rate_state["reset"] = now + settings["window"]
+        limit = settings["rate_limit"]
+        if limit and rate_state["used"] >= limit:
+            return Response(
+                json.dumps({"message": "API rate limit exceeded"}), status=403, mimetype="application/json",
+                headers={"X-RateLimit-Limit": str(limit), "X-RateLimit-Remaining": "0",
+                         "X-RateLimit-Reset": str(int(rate_state["reset"]))},
+            )
+
+        etag = '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+        not_modified = request.headers.get("If-None-Match") == etag
+        if not not_modified:
+            # 304s are free on GitHub too
+            rate_state["used"] += 1
+        headers = dict(headers or {}, ETag=etag)
+        if limit:
+            headers["X-RateLimit-Limit"] = str(limit)
+            headers["X-RateLimit-Remaining"] = str(limit - rate_state["used"])
+            headers["X-RateLimit-Reset"] = str(int(rate_state["reset"]))
+
+    if not_modified:
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype=mimetype, headers=headers)
+
+
+@app.route("/repos/<owner>/<repo>/pulls")
+def list_pulls(owner, repo):
+    per_page = min(int(request.args.get("per_page", 30)), 100)
+    page = int(request.args.get("page", 1))
+    ordered = sorted(prs, key=lambda pr: pr["updated_at"], reverse=request.args.get("direction", "desc") == "desc")
+    last_page = max(1, -(-len(ordered) // per_page))
+
+    links = []
+    base = request.base_url + "?" + "&".join(f"{k}={v}" for k, v in request.args.items() if k != "page")
+    if page < last_page:
+        links.append(f'<{base}&page={page + 1}>; rel="next"')
+        links.append(f'<{base}&page={last_page}>; rel="last"')
+    if page > 1:
+        links.append(f'<{base}&page=1>; rel="first"')
+        links.append(f'<{base}&page={page - 1}>; rel="prev"')
+
+    body = json.dumps(ordered[(page - 1) * per_page:page * per_page])
+    return respond(body, "application/json", {"Link": ", ".join(links)} if links else None)
+
+
+@app.route("/repos/<owner>/<repo>/pulls/<int:number>")
+def get_pull(owner, repo, number):
+    if not 1 <= number <= len(prs):
+        return Response(json.dumps({"message": "Not Found"}), status=404, mimetype="application/json")
+    pr = prs[number - 1]
+    if "diff" in request.headers.get("Accept", ""):
+        return respond(make_diff(pr), "text/plain")
+    return respond(json.dumps(pr), "application/json")
+
+
+@app.route("/_mock/update/<int:number>", methods=["POST"])
+def touch_pull(number):
+    """Marks a PR as updated now, to test incremental syncs."""
+    pr = prs[number - 1]
+    pr["updated_at"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    pr["body"] += " (edited)"
+    return {"number": number, "updated_at": pr["updated_at"]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prs", type=int, default=5000, help="Number of synthetic PRs.")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every response.")
+    parser.add_argument("--rate-limit", type=int, default=0, help="Requests per window before 403s, 0 for none.")
+    parser.add_argument("--window", type=int, default=60, help="Rate limit window in seconds.")
+    args = parser.parse_args()
+
+    prs.extend(make_prs(args.prs))
+    settings.update(latency=args.latency, rate_limit=args.rate_limit, window=args.window)
+    app.run(port=args.port, threaded=True)
@@ -0,0 +1,122 @@
+"""
+Append-only store of pull request versions, in sqlite.
+
+Every sync appends one row per PR version, keyed by (number, updated_at); a version that
+is already stored is ignored, nothing is rewritten. Diffs are stored only when they were
+actually fetched (a 304 leaves them NULL), so latest_diff() looks back to the most recent
+version that has one.
+
+Each row is marked once it has been ingested, so pending() hands the pipeline only the
+latest version of PRs that changed since the last ingest, in batches, without loading
+the whole history.
+"""
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List
+
+
+class PRStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS pr_versions (
+                number INTEGER NOT NULL,
+                updated_at TEXT NOT NULL,
+                info TEXT NOT NULL,
+                diff TEXT,
+                ingested INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (number, updated_at)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pr_versions_pending ON pr_versions (ingested, number)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+
+    def append(self, records: Iterable[Dict[str, Any]], ingested: bool = False) -> int:
+        """
+        Appends refined PR records (as made by analyze_prs.extract_commit_info, plus pr_body and
+        optionally diff). Returns how many were new versions.
+        """
+        rows = []
+        for record in records:
+            info = {k: v for k, v in record.items() if k != "diff"}
+            rows.append((record["pr_number"], record["updated_at"], json.dumps(info), record.get("diff"), int(ingested)))
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany("INSERT OR IGNORE INTO pr_versions VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+            return self._conn.total_changes - before
+
+    def pending(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """Latest versions of PRs that haven't been ingested yet, lowest PR number first, with their diff."""
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT v.number, v.updated_at, v.info FROM pr_versions v
+                   WHERE v.ingested = 0
+                     AND v.updated_at = (SELECT MAX(updated_at) FROM pr_versions WHERE number = v.number)
+                   ORDER BY v.number LIMIT ?""",
+                (limit,),
+            ).fetchall()
+
+        records = []
+        for number, updated_at, info in rows:
+            record = json.loads(info)
+            record["diff"] = self.latest_diff(number)
+            records.append(record)
+        return records
+
+    def mark_ingested(self, records: Iterable[Dict[str, Any]]):
+        """Marks the given versions, and every older version of the same PRs, as ingested."""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE pr_versions SET ingested = 1 WHERE number = ? AND updated_at <= ?",
+                [(record["pr_number"], record["updated_at"]) for record in records],
+            )
+            self._conn.commit()
+
+    def latest_diff(self, number: int):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT diff FROM pr_versions WHERE number = ? AND diff IS NOT NULL ORDER BY updated_at DESC LIMIT 1",
+                (number,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def latest_updated_at(self):
+        with self._lock:
+            return self._conn.execute("SELECT MAX(updated_at) FROM pr_versions").fetchone()[0]
+
+    def get_meta(self, key: str, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key: str, value):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(DISTINCT number) FROM pr_versions").fetchone()[0]
+
+    def import_json(self, refined_json_filename: str) -> int:
+        """
+        One-time migration from a *_refined_pr_info.json file written by earlier versions. Those PRs
+        were already ingested, so they are stored as such.
+        """
+        if not os.path.exists(refined_json_filename):
+            return 0
+        with open(refined_json_filename, 'r') as f:
+            records = json.load(f)
+        for record in records:
+            # Older files wrapped the diff in triple quotes
+            diff = record.get("diff")
+            if isinstance(diff, str) and diff.startswith('"""') and diff.endswith('"""'):
+                record["diff"] = diff[3:-3]
+        return self.append(records, ingested=True)
@@ -1,21 +1,16 @@
-from langchain_community.vectorstores.chroma import Chroma
-from embedding_function import get_embedding_function
-from aggregate_documents import CHROMA_PATH, LLM_MODEL
-from langchain_community.chat_models import ChatOllama
+from aggregate_documents import GRADE_BATCH_SIZE, GRADE_CONCURRENCY, GRADE_CACHE_SIZE, document_key, normalize_query
+from retrieval_context import get_retrieval_context
+from llm_scheduler import get_llm_scheduler, GRADING
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain.schema import Document
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 
 
-"""
-Takes in a list of documents and a string question.
-
-Outputs which of those documents are relevant to the question and which are not, both as lists.
-"""
-def grade(documents: list[Document], question: str):
-    llm = ChatOllama(model=LLM_MODEL, format="json", temperature=0)
-
-    prompt = PromptTemplate(
+def get_grading_prompt():
+    return PromptTemplate(
         template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|> You are a grader assessing relevance 
         of a retrieved document to a user question. If the document contains keywords related to the user question, 
         grade it as relevant. It does not need to be a stringent test. The goal is to filter out erroneous retrievals. \n
@@ -28,23 +23,129 @@ def grade(documents: list[Document], question: str):
         input_variables=["question", "document"],
     )
 
-    retrieval_grader = prompt | llm | JsonOutputParser()
+
+def get_batch_grading_prompt():
+    return PromptTemplate(
+        template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|> You are a grader assessing relevance 
+        of retrieved documents to a user question. If a document contains keywords related to the user question, 
+        grade it as relevant. It does not need to be a stringent test. The goal is to filter out erroneous retrievals. \n
+        Give each document a binary score 'yes' or 'no' to indicate whether it is relevant to the question. \n
+        Provide the scores as a JSON with a single key 'scores' holding a list with one score per document, in the 
+        order the documents are given, and no preamble or explanation.
+         <|eot_id|><|start_header_id|>user<|end_header_id|>
+        Here are the {count} retrieved documents: \n\n {documents} \n\n
+        Here is the user question: {question} \n <|eot_id|><|start_header_id|>assistant<|end_header_id|>
+        """,
+        input_variables=["question", "documents", "count"],
+    )
+
+
+"""
+Grades per (normalized question, chunk id), shared by every query in the process.
+"""
+class GradeCache:
+    def __init__(self, max_entries: int = GRADE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._grades = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, question: str, document: Document):
+        key = (normalize_query(question), document_key(document))
+        with self._lock:
+            if key not in self._grades:
+                return None
+            self._grades.move_to_end(key)
+            return self._grades[key]
+
+    def put(self, question: str, document: Document, score: str):
+        key = (normalize_query(question), document_key(document))
+        with self._lock:
+            self._grades[key] = score
+            self._grades.move_to_end(key)
+            while len(self._grades) > self.max_entries:
+                self._grades.popitem(last=False)
+
+
+grade_cache = GradeCache()
+
+def grade_batch(documents: list[Document], question: str) -> list[str]:
+    """Scores documents with one prompt, falling back to one prompt each if the reply doesn't line up."""
+    scheduler = get_llm_scheduler()
+    llm = scheduler.client("ollama")
+    if len(documents) > 1:
+        batch_grader = get_batch_grading_prompt() | llm | JsonOutputParser()
+        numbered = "\n\n".join(f"Document {i + 1}:\n{document.page_content}" for i, document in enumerate(documents))
+        try:
+            inputs = {"question": question, "documents": numbered, "count": len(documents)}
+            scores = scheduler.invoke(batch_grader, inputs, "ollama", GRADING)["scores"]
+            if len(scores) == len(documents):
+                return [str(score).lower() for score in scores]
+        except Exception as e:
+            print(f"Batch grading failed, grading one by one: {e}")
+
+    retrieval_grader = get_grading_prompt() | llm | JsonOutputParser()
+    return [
+        str(scheduler.invoke(
+            retrieval_grader, {"question": question, "document": document.page_content}, "ollama", GRADING
+        )["score"]).lower()
+        for document in documents
+    ]
+
+
+"""
+Takes in a list of documents and a string question.
+
+Outputs which of those documents are relevant to the question and which are not, both as lists.
+
+Documents are graded batch_size per prompt with up to max_workers prompts in flight, and
+grades are cached per (question, chunk id). If enough is set, grading stops once that many
+relevant documents have been found; documents that were never graded are left out of both lists.
+"""
+def grade(documents: list[Document], question: str, enough: int = None,
+          batch_size: int = GRADE_BATCH_SIZE, max_workers: int = GRADE_CONCURRENCY):
+    scores = {}
+    ungraded = []
+    for i, document in enumerate(documents):
+        cached = grade_cache.get(question, document)
+        if cached is None:
+            ungraded.append(i)
+        else:
+            scores[i] = cached
+
+    def enough_found():
+        return enough is not None and sum(1 for score in scores.values() if score == "yes") >= enough
+
+    if ungraded and not enough_found():
+        batches = [ungraded[i:i + batch_size] for i in range(0, len(ungraded), batch_size)]
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {
+            executor.submit(grade_batch, [documents[i] for i in batch], question): batch
+            for batch in batches
+        }
+        try:
+            for future in as_completed(futures):
+                for i, score in zip(futures[future], future.result()):
+                    scores[i] = score
+                    grade_cache.put(question, documents[i], score)
+                if enough_found():
+                    break
+        finally:
+            # Batches that haven't started yet are dropped; running ones finish in the background
+            executor.shutdown(wait=False, cancel_futures=True)
 
     relevant_documents = []
     irrelevant_documents = []
-    for document in documents:
-        doc_txt = document.page_content
-        score = retrieval_grader.invoke({"question": question, "document": doc_txt})["score"]
-        if score == "yes":
+    for i, document in enumerate(documents):
+        if scores.get(i) == "yes":
             relevant_documents.append(document)
-        if score == "no":
+        if scores.get(i) == "no":
             irrelevant_documents.append(document)
 
     return relevant_documents, irrelevant_documents
 
 
 if __name__ == "__main__":
-    vectorstore = Chroma(persist_directory=CHROMA_PATH, embedding_function=get_embedding_function())
+    vectorstore = get_retrieval_context().db
 
     retriever = vectorstore.as_retriever(search_kwargs={"k": 10})
 
@@ -55,4 +156,4 @@ if __name__ == "__main__":
     relevant_documents, irrelevant_documents = grade(documents, question)
 
     for document in relevant_documents:
-        print(document.metadata.get("source"))
\ No newline at end of file
+        print(document.metadata.get("source"))
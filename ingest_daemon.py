@@ -0,0 +1,418 @@
+"""
+One long-running ingestion service that every source submits to:
+
+    python ingest_daemon.py serve [--port 5052]
+
+Producers (orion-slack.py, slack_events.py, github/fetch_prs.py, oterm/oterm.sh) call
+submit(), which POSTs to the daemon at INGEST_DAEMON_URL. If no daemon is running, submit()
+runs the source's pipeline in-process instead, so every producer still works on its own.
+
+- Bounded queue: at most INGEST_QUEUE_SIZE items are pending across all sources. A submit
+  that doesn't fit waits for room, and after INGEST_SUBMIT_TIMEOUT seconds is refused with
+  a 503, which submit() backs off and retries: producers slow down to the commit rate
+  instead of piling work up in memory.
+- Micro-batching: items are batched per source, and a source's batch is committed once it
+  has INGEST_BATCH_SIZE items or its oldest item has waited INGEST_BATCH_DELAY seconds.
+  Repeats within a batch (a Slack message seen by both the poller and the event receiver,
+  a PR submitted twice) are committed once. pdf and terminal are scan sources: a submit is
+  a request to pick up whatever changed on disk, and all pending requests share one scan.
+- One writer: batches are committed one at a time by a single thread through the source's
+  pipeline in dense_embeddings, so only the daemon holds Chroma open for writing, and each
+  commit writes the dense and sparse indexes together (add_to_chroma) before the batch is
+  acknowledged. A failed commit is retried up to INGEST_MAX_ATTEMPTS times.
+
+Submitting with wait=True returns only once the items are committed, which is what producers
+that keep a cursor (Slack state, the PR store) use before moving it. GET /ingest/stats, and a
+log line every INGEST_STATS_INTERVAL seconds, report per-source throughput, queue depth and
+lag (seconds from submit to commit).
+
+    python ingest_daemon.py submit pdf|terminal [--wait]
+    python ingest_daemon.py stats
+"""
+import argparse
+import json
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+from flask import Flask, Blueprint, request, jsonify
+import requests
+from aggregate_documents import (
+    INGEST_DAEMON_URL, INGEST_QUEUE_SIZE, INGEST_BATCH_SIZE, INGEST_BATCH_DELAY,
+    INGEST_SUBMIT_TIMEOUT, INGEST_MAX_ATTEMPTS, INGEST_STATS_INTERVAL,
+)
+
+SCAN_SOURCES = {"pdf", "terminal"}
+
+# Which items of a source are the same thing; within a batch only the last one is committed
+DEDUPE_KEYS = {
+    "slack": lambda message: (message.get("channel"), message.get("timestamp")),
+    "github": lambda pr: pr.get("pr_number"),
+    "pdf": lambda item: None,
+    "terminal": lambda item: None,
+}
+
+# Seconds between retries of a submit the daemon refused because its queue was full
+SUBMIT_BACKOFF = 1.0
+
+MAX_SUBMIT_BACKOFF = 30.0
+
+# How many recent commits per source the lag percentiles and throughput are computed over
+STATS_WINDOW = 1000
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+class IngestFailed(Exception):
+    pass
+
+
+def run_pipeline(source: str, items: list):
+    """Runs the dense_embeddings pipeline for source on items (imported lazily: it opens Chroma)."""
+    import dense_embeddings
+    if source == "slack":
+        dense_embeddings.slack_pipeline(items)
+    elif source == "github":
+        dense_embeddings.git_pr_pipeline(items)
+    elif source == "terminal":
+        dense_embeddings.terminal_pipeline()
+    elif source == "pdf":
+        dense_embeddings.pdf_pipeline()
+    else:
+        raise ValueError(f"Unknown source: {source}")
+
+
+class Ticket:
+    """Completes once all of one submit's items are committed, or one of its batches gave up."""
+
+    def __init__(self, count: int):
+        self.remaining = count
+        self.error = None
+        self._done = threading.Event()
+        if count == 0:
+            self._done.set()
+
+    def committed(self):
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self._done.set()
+
+    def failed(self, error: str):
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._done.wait(timeout)
+
+
+class SourceStats:
+    def __init__(self):
+        self.submitted = 0
+        self.committed = 0
+        self.deduplicated = 0
+        self.failed = 0
+        self.batches = 0
+        self.commit_seconds = 0.0
+        self._lags = deque(maxlen=STATS_WINDOW)
+        self._commits = deque(maxlen=STATS_WINDOW)
+
+    def record_commit(self, items: int, lags: list[float], seconds: float):
+        self.committed += items
+        self.batches += 1
+        self.commit_seconds += seconds
+        self._lags.extend(lags)
+        self._commits.append((time.time(), items))
+
+    def snapshot(self, pending: int) -> dict:
+        lags = sorted(self._lags)
+
+        def percentile(p):
+            return round(lags[min(int(p * len(lags)), len(lags) - 1)], 3) if lags else None
+
+        # Items per second over the last minute of commits
+        since = time.time() - 60
+        recent = sum(items for at, items in self._commits if at >= since)
+        return {
+            "pending": pending,
+            "submitted": self.submitted,
+            "committed": self.committed,
+            "deduplicated": self.deduplicated,
+            "failed": self.failed,
+            "batches": self.batches,
+            "items_per_second": round(recent / 60, 2),
+            "commit_seconds": round(self.commit_seconds, 2),
+            "lag_p50": percentile(0.5),
+            "lag_p95": percentile(0.95),
+            "lag_max": round(lags[-1], 3) if lags else None,
+        }
+
+
+class Entry:
+    __slots__ = ("item", "ticket", "enqueued_at")
+
+    def __init__(self, item, ticket: Ticket, enqueued_at: float):
+        self.item = item
+        self.ticket = ticket
+        self.enqueued_at = enqueued_at
+
+
+"""
+Bounded, per-source micro-batching queue with a single committing thread. commit(source,
+items) is called for every batch; it defaults to run_pipeline.
+"""
+class IngestDaemon:
+    def __init__(self, commit=run_pipeline, max_items: int = INGEST_QUEUE_SIZE, batch_size: int = INGEST_BATCH_SIZE,
+                 batch_delay: float = INGEST_BATCH_DELAY, max_attempts: int = INGEST_MAX_ATTEMPTS,
+                 stats_interval: float = INGEST_STATS_INTERVAL):
+        self.commit = commit
+        self.max_items = max_items
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_attempts = max_attempts
+        self.stats_interval = stats_interval
+        self._pending = {source: deque() for source in DEDUPE_KEYS}
+        self._pending_items = 0
+        self._attempts = {}
+        self._retry_at = {}
+        self._stats = {source: SourceStats() for source in DEDUPE_KEYS}
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, source: str, items: list = None, timeout: float = INGEST_SUBMIT_TIMEOUT) -> Ticket:
+        """
+        Queues items (ignored for scan sources) and returns their Ticket. Blocks while the queue
+        is full; raises IngestQueueFull if there still isn't room after timeout seconds.
+        """
+        if source not in self._pending:
+            raise ValueError(f"Unknown source: {source}")
+        items = [None] if source in SCAN_SOURCES else list(items or [])
+        ticket = Ticket(len(items))
+        if not items:
+            return ticket
+
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            # A submit bigger than the whole queue is let in once the queue is empty
+            while self._pending_items > 0 and self._pending_items + len(items) > self.max_items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._closed:
+                    raise IngestQueueFull(f"Ingest queue is full ({self._pending_items} items pending)")
+                self._condition.wait(remaining)
+
+            now = time.monotonic()
+            self._pending[source].extend(Entry(item, ticket, now) for item in items)
+            self._pending_items += len(items)
+            self._stats[source].submitted += len(items)
+            self._condition.notify_all()
+        return ticket
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {source: stats.snapshot(len(self._pending[source])) for source, stats in self._stats.items()}
+
+    def close(self):
+        """Commits whatever is pending and stops the committing thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _ready_source(self, now: float):
+        """The source whose batch is due, oldest first, and the seconds until the next one is due otherwise."""
+        ready = None
+        wait = None
+        for source, entries in self._pending.items():
+            if not entries:
+                continue
+            due = entries[0].enqueued_at + self.batch_delay
+            if source in self._retry_at and not self._closed:
+                due = self._retry_at[source]
+                if due > now:
+                    wait = due - now if wait is None else min(wait, due - now)
+                    continue
+            if len(entries) >= self.batch_size or due <= now or self._closed:
+                if ready is None or entries[0].enqueued_at < self._pending[ready][0].enqueued_at:
+                    ready = source
+            elif wait is None or due - now < wait:
+                wait = due - now
+        return ready, wait
+
+    def _run(self):
+        last_report = time.monotonic()
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    source, wait = self._ready_source(now)
+                    if source is not None or (self._closed and self._pending_items == 0):
+                        break
+                    if self.stats_interval:
+                        report_in = last_report + self.stats_interval - now
+                        wait = report_in if wait is None else min(wait, report_in)
+                        if wait <= 0:
+                            break
+                    self._condition.wait(wait)
+                if source is None and self._closed:
+                    return
+                batch = []
+                if source is not None:
+                    entries = self._pending[source]
+                    while entries and len(batch) < self.batch_size:
+                        batch.append(entries.popleft())
+
+            if batch:
+                self._commit_batch(source, batch)
+            if self.stats_interval and time.monotonic() - last_report >= self.stats_interval:
+                self._report()
+                last_report = time.monotonic()
+
+    def _commit_batch(self, source: str, batch: list[Entry]):
+        key = DEDUPE_KEYS[source]
+        unique = {}
+        for entry in batch:
+            unique[key(entry.item)] = entry.item
+        items = list(unique.values())
+
+        started = time.monotonic()
+        try:
+            self.commit(source, items)
+            error = None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finished = time.monotonic()
+
+        with self._condition:
+            stats = self._stats[source]
+            if error is None:
+                self._pending_items -= len(batch)
+                self._attempts.pop(source, None)
+                self._retry_at.pop(source, None)
+                stats.deduplicated += len(batch) - len(items)
+                stats.record_commit(len(batch), [finished - entry.enqueued_at for entry in batch], finished - started)
+                for entry in batch:
+                    entry.ticket.committed()
+            else:
+                attempts = self._attempts.get(source, 0) + 1
+                if attempts >= self.max_attempts:
+                    print(f"Dropping {source} batch of {len(batch)} after {attempts} failed attempts: {error}")
+                    self._pending_items -= len(batch)
+                    self._attempts.pop(source, None)
+                    self._retry_at.pop(source, None)
+                    stats.failed += len(batch)
+                    for entry in batch:
+                        entry.ticket.failed(error)
+                else:
+                    print(f"Committing {source} batch of {len(batch)} failed, retrying: {error}")
+                    self._attempts[source] = attempts
+                    self._retry_at[source] = finished + self.batch_delay * 2 ** attempts
+                    self._pending[source].extendleft(reversed(batch))
+            self._condition.notify_all()
+
+        if error is None:
+            print(f"Committed {len(items)} {source} items ({len(batch)} submitted) in {finished - started:.1f}s")
+
+    def _report(self):
+        for source, stats in self.stats().items():
+            if stats["submitted"]:
+                print(f"[{source}] {json.dumps(stats)}")
+
+
+daemon = None
+daemon_lock = threading.Lock()
+
+
+def get_ingest_daemon() -> IngestDaemon:
+    """Returns the process-wide ingest daemon, starting it on first use."""
+    global daemon
+    if daemon is None:
+        with daemon_lock:
+            if daemon is None:
+                daemon = IngestDaemon()
+    return daemon
+
+
+ingest_routes = Blueprint("ingest_routes", __name__)
+
+
+@ingest_routes.route("/ingest/<source>", methods=["POST"])
+def receive_submit(source):
+    payload = request.get_json(silent=True) or {}
+    try:
+        ticket = get_ingest_daemon().submit(source, payload.get("items"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except IngestQueueFull as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(int(SUBMIT_BACKOFF))}
+
+    if not payload.get("wait"):
+        return jsonify({"status": "queued"}), 202
+    ticket.wait()
+    if ticket.error:
+        return jsonify({"status": "failed", "error": ticket.error}), 500
+    return jsonify({"status": "committed"}), 200
+
+
+@ingest_routes.route("/ingest/stats", methods=["GET"])
+def report_stats():
+    return jsonify(get_ingest_daemon().stats())
+
+
+"""
+Hands items to the ingest daemon for source. With wait=True, returns once they are
+committed, and raises IngestFailed if the daemon gave up on them. Backs off and retries while
+the daemon's queue is full. If no daemon is running, runs the pipeline in-process.
+"""
+def submit(source: str, items: list = None, wait: bool = False, url: str = INGEST_DAEMON_URL):
+    body = {"items": [] if source in SCAN_SOURCES else items, "wait": wait}
+    backoff = SUBMIT_BACKOFF
+    while True:
+        try:
+            response = requests.post(f"{url}/ingest/{source}", json=body, timeout=None if wait else INGEST_SUBMIT_TIMEOUT * 2)
+        except requests.ConnectionError:
+            print(f"No ingest daemon at {url}, ingesting {source} directly")
+            run_pipeline(source, items or [])
+            return
+        if response.status_code != 503:
+            break
+        time.sleep(backoff)
+        backoff = min(backoff * 2, MAX_SUBMIT_BACKOFF)
+
+    if response.status_code >= 400:
+        raise IngestFailed(f"Ingest daemon refused {source} submit: {response.status_code} {response.text}")
+
+
+def serve(port: int):
+    app = Flask(__name__)
+    app.register_blueprint(ingest_routes)
+    get_ingest_daemon()
+    try:
+        app.run(port=port, threaded=True)
+    finally:
+        get_ingest_daemon().close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the ingest daemon, or submit to it.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="Run the ingest daemon.")
+    serve_parser.add_argument("--port", type=int, default=urlparse(INGEST_DAEMON_URL).port or 5052)
+    submit_parser = commands.add_parser("submit", help="Ask the daemon to ingest changed PDFs or terminal logs.")
+    submit_parser.add_argument("source", choices=sorted(SCAN_SOURCES))
+    submit_parser.add_argument("--wait", action="store_true", help="Return once the changes are committed.")
+    commands.add_parser("stats", help="Print per-source throughput and lag.")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.port)
+    elif args.command == "submit":
+        submit(args.source, wait=args.wait)
+    else:
+        print(json.dumps(requests.get(f"{INGEST_DAEMON_URL}/ingest/stats").json(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
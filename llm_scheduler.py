@@ -0,0 +1,258 @@
+"""
+One scheduler for every LLM call in the process.
+
+Each backend ("gemini", "ollama") has one pooled client (plus one per event loop for async
+calls) and one gate. A gate hands out call slots in priority order, limited by a token
+bucket (requests per minute with a burst allowance) and a cap on calls in flight.
+Interactive answers outrank grading, which outranks background curation, so a large
+curation run can't starve queries.
+
+Rate-limit and transient errors are retried with exponential backoff and jitter. A 429
+also pauses the whole backend for the backoff delay, so the other callers back off too
+instead of piling onto the quota.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+import weakref
+import httpx
+from langchain_community.chat_models import ChatOllama
+from langchain_openai import ChatOpenAI
+from aggregate_documents import LLM_MODEL
+from dotenv import load_dotenv
+
+load_dotenv()
+
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/openai/"
+
+GEMINI_MODEL = "gemini-2.5-flash"
+
+# Priorities, lower runs first
+INTERACTIVE = 0
+GRADING = 1
+BACKGROUND = 2
+
+# requests per minute, burst, calls in flight
+BACKEND_LIMITS = {
+    "gemini": (
+        float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", 60)),
+        int(os.getenv("GEMINI_BURST", 10)),
+        int(os.getenv("GEMINI_CONCURRENCY", 8)),
+    ),
+    "ollama": (
+        float(os.getenv("OLLAMA_REQUESTS_PER_MINUTE", 6000)),
+        int(os.getenv("OLLAMA_BURST", 100)),
+        int(os.getenv("OLLAMA_CONCURRENCY", 2)),
+    ),
+}
+
+MAX_RETRIES = 5
+
+BASE_BACKOFF = 1.0
+
+MAX_BACKOFF = 60.0
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def status_code(error: Exception):
+    code = getattr(error, "status_code", None)
+    if code is None and getattr(error, "response", None) is not None:
+        code = getattr(error.response, "status_code", None)
+    return code
+
+
+def is_rate_limited(error: Exception) -> bool:
+    return status_code(error) == 429 or "RateLimit" in type(error).__name__
+
+
+def is_retryable(error: Exception) -> bool:
+    if is_rate_limited(error) or status_code(error) in RETRYABLE_STATUS:
+        return True
+    name = type(error).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+class PriorityGate:
+    """Grants call slots in priority order, first come first served within a priority."""
+
+    def __init__(self, requests_per_minute: float, burst: int, max_concurrency: int):
+        self.rate = requests_per_minute / 60.0
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, priority: int):
+        with self._condition:
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if (self._waiting[0] == ticket and self._tokens >= 1
+                        and self._in_flight < self.max_concurrency and now >= self._paused_until):
+                    heapq.heappop(self._waiting)
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    self._condition.notify_all()
+                    return
+
+                wait = None
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens < 1:
+                    wait = (1 - self._tokens) / self.rate
+                self._condition.wait(wait)
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def pause(self, seconds: float):
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class LLMScheduler:
+    def __init__(self, limits: dict = BACKEND_LIMITS, max_retries: int = MAX_RETRIES):
+        self.max_retries = max_retries
+        self._gates = {backend: PriorityGate(*limit) for backend, limit in limits.items()}
+        self._clients = {}
+        self._loop_clients = weakref.WeakKeyDictionary()
+        self._http_clients = {}
+        self._async_http_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def client(self, backend: str):
+        """
+        The pooled client for a backend. Its own retries are off; the scheduler retries.
+
+        Async connections are bound to the event loop that opened them, and curation runs each
+        job in its own asyncio.run(), so called inside an event loop this returns a client with
+        an async pool of that loop's own; close it with aclose_loop_clients() before the loop
+        ends. Sync calls share one pool.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        with self._lock:
+            clients = self._clients if loop is None else self._loop_clients.setdefault(loop, {})
+            if backend not in clients:
+                clients[backend] = self._create_client(backend, loop)
+            return clients[backend]
+
+    async def aclose_loop_clients(self):
+        """Closes the async pools of the clients client() made for the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._loop_clients.pop(loop, None)
+            http_clients = self._async_http_clients.pop(loop, [])
+        for http_client in http_clients:
+            await http_client.aclose()
+
+    def invoke(self, runnable, inputs: dict, backend: str, priority: int):
+        for attempt in range(self.max_retries + 1):
+            gate = self._gates[backend]
+            gate.acquire(priority)
+            try:
+                return runnable.invoke(inputs)
+            except Exception as e:
+                delay = self._backoff(backend, e, attempt)
+            finally:
+                gate.release()
+            time.sleep(delay)
+
+    async def ainvoke(self, runnable, inputs: dict, backend: str, priority: int):
+        for attempt in range(self.max_retries + 1):
+            gate = self._gates[backend]
+            await asyncio.to_thread(gate.acquire, priority)
+            try:
+                return await runnable.ainvoke(inputs)
+            except Exception as e:
+                delay = self._backoff(backend, e, attempt)
+            finally:
+                gate.release()
+            await asyncio.sleep(delay)
+
+    def stream(self, runnable, inputs: dict, backend: str, priority: int):
+        """Streams runnable's output. Retries only until the first chunk has been yielded."""
+        for attempt in range(self.max_retries + 1):
+            gate = self._gates[backend]
+            gate.acquire(priority)
+            started = False
+            try:
+                for chunk in runnable.stream(inputs):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started:
+                    raise
+                delay = self._backoff(backend, e, attempt)
+            finally:
+                gate.release()
+            time.sleep(delay)
+
+    def _backoff(self, backend: str, error: Exception, attempt: int) -> float:
+        """Seconds to wait before retrying, or re-raises error if it shouldn't be retried."""
+        if attempt >= self.max_retries or not is_retryable(error):
+            raise error
+        delay = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+        if is_rate_limited(error):
+            self._gates[backend].pause(delay)
+        print(f"LLM call to {backend} failed ({type(error).__name__}), retrying in {delay:.1f}s")
+        return delay
+
+    def _create_client(self, backend: str, loop: asyncio.AbstractEventLoop = None):
+        """A client for backend; one made for loop gets an async pool of its own (see client())."""
+        concurrency = self._gates[backend].max_concurrency
+        if backend == "gemini":
+            limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+            if backend not in self._http_clients:
+                self._http_clients[backend] = httpx.Client(limits=limits)
+            async_pool = {}
+            if loop is not None:
+                async_pool["http_async_client"] = httpx.AsyncClient(limits=limits)
+                self._async_http_clients.setdefault(loop, []).append(async_pool["http_async_client"])
+            return ChatOpenAI(
+                model=GEMINI_MODEL,
+                openai_api_key=os.getenv("GEMINI_KEY"),
+                openai_api_base=GEMINI_URL,
+                temperature=0,
+                max_retries=0,
+                http_client=self._http_clients[backend],
+                **async_pool,
+            )
+        if backend == "ollama":
+            return ChatOllama(model=LLM_MODEL, format="json", temperature=0)
+        raise ValueError(f"Unknown LLM backend: {backend}")
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_llm_scheduler() -> LLMScheduler:
+    """Returns the process-wide LLM scheduler, creating it on first use."""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = LLMScheduler()
+    return _scheduler
@@ -1,118 +1,162 @@
-from slack_sdk import WebClient
-from datetime import datetime
-from dense_embeddings import slack_pipeline
-from dotenv import load_dotenv
-import os, json, time
-
-load_dotenv()
-slack_key = os.getenv("SLACK_KEY")
-client = WebClient(token=slack_key)
-STATE_FILE = "slack_state.json"
-
-def load_last_ts(channel_id: str):
-    if not os.path.exists(STATE_FILE):
-        return None
-    try:
-        with open(STATE_FILE, "r") as f:
-            state = json.load(f)
-    except (json.JSONDecodeError, ValueError):
-        state = {}
-    return state.get(channel_id)
-
-def save_last_ts(channel_id: str, ts: str):
-    state = {}
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, "r") as f:
-                state = json.load(f)
-        except (json.JSONDecodeError, ValueError):
-            state = {}
-    state[channel_id] = ts
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f)
-
-def get_username(msg):
-    user_id = msg.get("user")
-    bot_id = msg.get("bot_id")
-    username = msg.get("username")
-
-    if user_id:
-        try:
-            user_info = client.users_info(user=user_id)
-            return user_info["user"].get("real_name") or user_info["user"].get("name")
-        except Exception:
-            return f"Unknown User ({user_id})"
-
-
-    if bot_id:
-        return f"Bot ({bot_id})"
-
-
-    if username:
-        return username
-
-
-    return "System"
-
-def normalize_message(msg, channel_name, is_thread=False):
-    text = msg.get("text", "")
-    ts = msg.get("ts")
-    dt = datetime.fromtimestamp(float(ts))
-    username = get_username(msg)
-
-    return {
-        "user": username,
-        "text": text,
-        "timestamp": ts,
-        "datetime": dt.strftime("%Y-%m-%d %H:%M:%S"),
-        "thread": is_thread,
-        "channel": channel_name
-    }
-
-def fetch_slack_messages(channel_id, limit=10):
-    channel_info = client.conversations_info(channel=channel_id)
-    channel_name = channel_info["channel"]["name"]
-
-    result = client.conversations_history(channel=channel_id, limit=limit)
-    messages = []
-
-    for msg in result["messages"]:
-        # Add top-level message
-        messages.append(normalize_message(msg, channel_name, is_thread=False))
-
-        # If the message has a thread, fetch replies
-        if "thread_ts" in msg and msg["thread_ts"] == msg["ts"]:
-            replies = client.conversations_replies(channel=channel_id, ts=msg["ts"])
-            for reply in replies["messages"][1:]:  # skip parent
-                messages.append(normalize_message(reply, channel_name, is_thread=True))
-
-    return messages
-
-if __name__ == "__main__":
-    # 🔹 Replace with the list of channel IDs you want to track
-    channel_ids = ["C09HJ17R1EE"]
-
-    while True:
-        for channel_id in channel_ids:
-            msgs = fetch_slack_messages(channel_id)
-
-            last_ts = load_last_ts(channel_id)
-            if msgs:
-                latest_ts = msgs[0]["timestamp"]
-            else:
-                latest_ts = last_ts
-
-            if last_ts:
-                new_msgs = [m for m in msgs if float(m["timestamp"]) > float(last_ts)]
-            else:
-                new_msgs = msgs
-
-            if latest_ts:
-                save_last_ts(channel_id, latest_ts)
-
-            for m in new_msgs:
-                print(f"[{m['datetime']}] (#{m['channel']}) {m['user']}: {m['text']}")
-            slack_pipeline(msgs)
-
-        #slack_pipeline(new_msgs)
-        time.sleep(300)
\ No newline at end of file
+from slack_client import client, get_channel_name, normalize_message
+from concurrent.futures import ThreadPoolExecutor
+from ingest_daemon import submit
+from dotenv import load_dotenv
+import os, json, time, argparse
+
+load_dotenv()
+STATE_FILE = "slack_state.json"
+
+# Messages per conversations_history / conversations_replies page
+PAGE_SIZE = 200
+
+# How far back the first poll of a channel goes
+BACKFILL_DAYS = float(os.getenv("SLACK_BACKFILL_DAYS", 7))
+
+# Threads are re-checked for new replies until they have been quiet this long
+THREAD_WATCH_DAYS = float(os.getenv("SLACK_THREAD_WATCH_DAYS", 7))
+
+# How far back before last_ts history is re-read to catch messages that got their first reply
+# since the poll that saw them
+THREAD_RESCAN_HOURS = float(os.getenv("SLACK_THREAD_RESCAN_HOURS", 24))
+
+POLL_INTERVAL = 300
+
+CHANNEL_CONCURRENCY = 4
+
+
+"""
+slack_state.json: {channel_id: {"last_ts": ts of the newest top-level message seen,
+                                "threads": {thread ts: ts of the newest reply seen}}}
+Older files map channel_id straight to last_ts; those are read as having no threads.
+"""
+def load_state():
+    if not os.path.exists(STATE_FILE):
+        return {}
+    try:
+        with open(STATE_FILE, "r") as f:
+            state = json.load(f)
+    except (json.JSONDecodeError, ValueError):
+        return {}
+    return {
+        channel_id: entry if isinstance(entry, dict) else {"last_ts": entry, "threads": {}}
+        for channel_id, entry in state.items()
+    }
+
+def save_state(state):
+    tmp_path = f"{STATE_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, STATE_FILE)
+
+def paginate(method, **kwargs):
+    """Yields every message from a cursor-paginated conversations_* call."""
+    cursor = None
+    while True:
+        result = method(limit=PAGE_SIZE, cursor=cursor, **kwargs)
+        yield from result["messages"]
+        cursor = (result.get("response_metadata") or {}).get("next_cursor")
+        if not result.get("has_more") or not cursor:
+            return
+
+def fetch_thread_replies(channel_id, thread_ts, after_ts=None):
+    """Replies in a thread newer than after_ts (all replies if None), oldest first."""
+    kwargs = {"channel": channel_id, "ts": thread_ts}
+    if after_ts:
+        kwargs["oldest"] = after_ts
+    return [
+        reply for reply in paginate(client.conversations_replies, **kwargs)
+        if reply["ts"] != thread_ts and (after_ts is None or float(reply["ts"]) > float(after_ts))
+    ]
+
+"""
+Fetches everything in a channel that isn't in entry ({"last_ts", "threads"}) yet: top-level
+messages after last_ts, and new replies in threads that are still being watched.
+
+History is paged from last_ts, plus the THREAD_RESCAN_HOURS before it, since a message can
+get its first reply after the poll that saw it. A thread whose parent shows up in that page
+range is fetched only when its parent's latest_reply is newer than the newest reply seen.
+Watched threads with older parents are re-checked with a replies call until they have been
+quiet for THREAD_WATCH_DAYS.
+
+Returns (new normalized messages, updated entry). entry itself isn't modified.
+"""
+def fetch_new_messages(channel_id, entry):
+    channel_name = get_channel_name(channel_id)
+    last_ts = entry.get("last_ts")
+    threads = dict(entry.get("threads", {}))
+    watch_from = time.time() - THREAD_WATCH_DAYS * 24 * 60 * 60
+    if last_ts:
+        oldest = str(float(last_ts) - THREAD_RESCAN_HOURS * 60 * 60)
+    else:
+        oldest = str(time.time() - BACKFILL_DAYS * 24 * 60 * 60)
+
+    messages = []
+    newest_ts = last_ts
+    unchanged = set()
+    for msg in paginate(client.conversations_history, channel=channel_id, oldest=oldest):
+        if last_ts is None or float(msg["ts"]) > float(last_ts):
+            messages.append(normalize_message(msg, channel_name, is_thread=False))
+            if newest_ts is None or float(msg["ts"]) > float(newest_ts):
+                newest_ts = msg["ts"]
+        if not msg.get("reply_count"):
+            continue
+        seen_ts = threads.setdefault(msg["ts"], None)
+        latest_reply = msg.get("latest_reply")
+        if seen_ts and latest_reply and float(latest_reply) <= float(seen_ts):
+            unchanged.add(msg["ts"])
+
+    for thread_ts, seen_ts in list(threads.items()):
+        if thread_ts not in unchanged:
+            replies = fetch_thread_replies(channel_id, thread_ts, seen_ts)
+            for reply in replies:
+                messages.append(normalize_message(reply, channel_name, is_thread=True))
+            if replies:
+                seen_ts = max((reply["ts"] for reply in replies), key=float)
+            threads[thread_ts] = seen_ts
+        if float(seen_ts or thread_ts) < watch_from:
+            del threads[thread_ts]
+
+    return messages, {"last_ts": newest_ts, "threads": threads}
+
+"""
+Polls every channel concurrently and submits only messages not seen before for ingestion.
+State is saved only after they have been committed, so a failed poll is retried next time.
+"""
+def poll(channel_ids):
+    state = load_state()
+    with ThreadPoolExecutor(max_workers=CHANNEL_CONCURRENCY) as executor:
+        futures = {
+            channel_id: executor.submit(fetch_new_messages, channel_id, state.get(channel_id, {}))
+            for channel_id in channel_ids
+        }
+
+    new_msgs = []
+    for channel_id, future in futures.items():
+        try:
+            msgs, entry = future.result()
+        except Exception as e:
+            print(f"Polling {channel_id} failed: {e}")
+            continue
+        new_msgs.extend(msgs)
+        state[channel_id] = entry
+
+    for m in new_msgs:
+        print(f"[{m['datetime']}] (#{m['channel']}) {m['user']}: {m['text']}")
+    if new_msgs:
+        submit("slack", new_msgs, wait=True)
+    save_state(state)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--once", action="store_true", help="Poll once and exit.")
+    args = parser.parse_args()
+
+    # 🔹 Replace with the list of channel IDs you want to track
+    channel_ids = ["C09HJ17R1EE"]
+
+    while True:
+        poll(channel_ids)
+        if args.once:
+            break
+        time.sleep(POLL_INTERVAL)
@@ -0,0 +1,63 @@
+"""
+Parallel, page-by-page PDF text extraction.
+
+Parsing is CPU bound, so PDFs are parsed in a process pool, a few pages per task, and pages
+are yielded as tasks finish rather than once every file is done: embedding the first pages
+overlaps with parsing the rest. Page text is what PyPDFLoader extracts
+(pypdf's extract_text), so chunk ids of unchanged pages stay the same.
+
+Workers are always started with spawn: the pipeline runs inside the ingest daemon, a
+threaded process holding Chroma, sqlite and HTTP handles, and forking that risks children
+that deadlock on a lock some other thread held. This module only imports pypdf (not even
+aggregate_documents), so spawned workers don't pay for importing langchain.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator, List, Tuple
+
+
+def count_pages(path: str) -> int:
+    from pypdf import PdfReader
+    return len(PdfReader(path).pages)
+
+
+def extract_pages(path: str, start: int, stop: int) -> List[Tuple[str, int, str]]:
+    """(path, page number, text) for pages start to stop - 1."""
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    return [(path, number, reader.pages[number].extract_text()) for number in range(start, stop)]
+
+
+"""
+Yields (path, page number, text) for every page of paths, in no particular order. Files that
+can't be parsed, wholly or in part, are reported and appended to failed; pages of theirs that
+did parse may already have been yielded.
+"""
+def iter_pdf_pages(paths: list[str], failed: list[str], max_workers: int,
+                   pages_per_task: int) -> Iterator[Tuple[str, int, str]]:
+    if not paths:
+        return
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        counts = {executor.submit(count_pages, path): path for path in paths}
+        tasks = {}
+        for future in as_completed(counts):
+            path = counts[future]
+            try:
+                page_count = future.result()
+            except Exception as e:
+                print(f"Couldn't read {path}: {e}")
+                failed.append(path)
+                continue
+            for start in range(0, page_count, pages_per_task):
+                tasks[executor.submit(extract_pages, path, start, min(start + pages_per_task, page_count))] = path
+
+        for future in as_completed(tasks):
+            path = tasks[future]
+            try:
+                pages = future.result()
+            except Exception as e:
+                print(f"Couldn't parse part of {path}: {e}")
+                if path not in failed:
+                    failed.append(path)
+                continue
+            yield from pages
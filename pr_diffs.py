@@ -0,0 +1,216 @@
+"""
+Turns a PR's unified diff into chunks for the vector store.
+
+The diff is read line by line, file by file and hunk by hunk, so a multi-megabyte diff is
+never split or held as one string beyond what the caller already has. Files that say little
+about the code are skipped as a whole: binary files, vendored dependencies, lockfiles and
+other generated output (by path, or by an "@generated"/"DO NOT EDIT" marker at the top).
+
+Chunks follow hunk boundaries: consecutive hunks of one file are packed together up to
+DIFF_CHUNK_CHARS, and only a hunk that is too big on its own is cut, between lines, with its
+@@ header repeated. Each chunk starts with the PR and file it belongs to, so it stands on its
+own when retrieved. DIFF_FILE_BUDGET_CHARS and PR_DIFF_BUDGET_CHARS cap how much of one file
+and of one PR gets embedded; parsing stops as soon as the PR budget is used up.
+"""
+import io
+import os
+import re
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Tuple
+from langchain.schema.document import Document
+from aggregate_documents import DIFF_CHUNK_CHARS, DIFF_FILE_BUDGET_CHARS, PR_DIFF_BUDGET_CHARS
+
+# Directories whose contents are someone else's code or build output
+VENDORED_DIRS = {"vendor", "vendors", "node_modules", "third_party", "third-party", "bower_components",
+                 "site-packages", ".venv", "venv", "dist", "__pycache__"}
+
+GENERATED_FILES = {"package-lock.json", "yarn.lock", "pnpm-lock.yaml", "poetry.lock", "Pipfile.lock",
+                   "Cargo.lock", "Gemfile.lock", "composer.lock", "go.sum", "uv.lock", "bun.lockb"}
+
+GENERATED_SUFFIXES = (".min.js", ".min.css", ".map", ".snap", "_pb2.py", "_pb2_grpc.py", ".pb.go",
+                      ".generated.ts", ".g.dart", ".lock")
+
+BINARY_SUFFIXES = (".png", ".jpg", ".jpeg", ".gif", ".ico", ".webp", ".bmp", ".pdf", ".zip", ".gz",
+                   ".tar", ".jar", ".whl", ".so", ".dll", ".dylib", ".exe", ".bin", ".woff", ".woff2",
+                   ".ttf", ".otf", ".eot", ".mp3", ".mp4", ".mov", ".sqlite3", ".db", ".pyc")
+
+# Markers code generators put at the top of their output, looked for in a file's first lines
+GENERATED_MARKERS = re.compile(r"@generated|do not edit|auto-?generated|generated by", re.IGNORECASE)
+
+GENERATED_MARKER_LINES = 5
+
+HUNK_HEADER = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+
+
+class Hunk(NamedTuple):
+    path: str
+    header: str
+    text: str
+
+
+def skip_reason(path: str):
+    """Why a file with this path isn't worth embedding ("binary", "vendored" or "generated"), or None."""
+    name = os.path.basename(path)
+    lowered = name.lower()
+    if lowered.endswith(BINARY_SUFFIXES):
+        return "binary"
+    if any(part in VENDORED_DIRS for part in path.split("/")[:-1]):
+        return "vendored"
+    if name in GENERATED_FILES or lowered.endswith(GENERATED_SUFFIXES):
+        return "generated"
+    return None
+
+
+def header_path(line: str) -> str:
+    """The new path from a "diff --git a/<old> b/<new>" line."""
+    _, _, new = line.rstrip("\n").rpartition(" b/")
+    return new.strip('"')
+
+
+"""
+Yields the hunks of a unified diff (a string, or any iterable of lines) in order, without
+reading further than the hunk being yielded. Skipped files are appended to skipped as
+(path, reason) when a list is passed.
+"""
+def iter_hunks(diff, skipped: List[Tuple[str, str]] = None) -> Iterator[Hunk]:
+    lines = io.StringIO(diff) if isinstance(diff, str) else diff
+    path = None
+    skip = None
+    header = None
+    body = []
+
+    def finish_hunk():
+        # Returns the pending hunk (or None), checking a file's first lines for generator markers
+        nonlocal skip
+        if header is None or skip:
+            return None
+        match = HUNK_HEADER.match(header)
+        if match and match.group(1) in ("0", "1"):
+            top = "".join(body[:GENERATED_MARKER_LINES])
+            if GENERATED_MARKERS.search(top):
+                skip = "generated"
+                if skipped is not None:
+                    skipped.append((path, skip))
+                return None
+        return Hunk(path, header.rstrip("\n"), "".join(body))
+
+    for line in lines:
+        if line.startswith("diff --git "):
+            hunk = finish_hunk()
+            if hunk:
+                yield hunk
+            path = header_path(line)
+            skip = skip_reason(path)
+            header = None
+            body = []
+            if skip and skipped is not None:
+                skipped.append((path, skip))
+            continue
+
+        if path is None or skip:
+            continue
+
+        if header is None:
+            # Extended header lines between "diff --git" and the first hunk
+            if line.startswith("+++ ") and not line.startswith("+++ /dev/null"):
+                path = line[4:].rstrip("\n").removeprefix("b/").strip('"')
+            elif line.startswith("Binary files ") or line.startswith("GIT binary patch"):
+                skip = "binary"
+                if skipped is not None:
+                    skipped.append((path, skip))
+            elif line.startswith("@@"):
+                header = line
+            continue
+
+        if line.startswith("@@"):
+            hunk = finish_hunk()
+            if hunk:
+                yield hunk
+            header = line
+            body = []
+        else:
+            body.append(line if line.endswith("\n") else line + "\n")
+
+    hunk = finish_hunk()
+    if hunk:
+        yield hunk
+
+
+def split_hunk(hunk: Hunk, size: int) -> List[str]:
+    """The hunk as "<header>\\n<lines>" pieces of at most about size characters, cut between lines."""
+    pieces = []
+    current = hunk.header + "\n"
+    for line in io.StringIO(hunk.text):
+        if len(current) + len(line) > size and current != hunk.header + "\n":
+            pieces.append(current)
+            current = hunk.header + "\n"
+        # A single line longer than size (minified code that slipped through) is cut too
+        while len(current) + len(line) > size:
+            room = max(size - len(current), size // 2)
+            pieces.append(current + line[:room])
+            line = line[room:]
+            current = hunk.header + "\n"
+        current += line
+    if current != hunk.header + "\n":
+        pieces.append(current)
+    return pieces
+
+
+"""
+Packs hunks into (path, text) chunks: consecutive hunks of one file share a chunk while they
+fit in size characters, and a hunk bigger than that is split. At most file_budget characters
+of any one file are yielded; the rest of that file is dropped.
+"""
+def pack_hunks(hunks: Iterable[Hunk], size: int = DIFF_CHUNK_CHARS,
+               file_budget: int = DIFF_FILE_BUDGET_CHARS) -> Iterator[Tuple[str, str]]:
+    path = None
+    current = ""
+    used = 0
+    over_budget = False
+    for hunk in hunks:
+        if hunk.path != path:
+            if current:
+                yield path, current
+            path, current, used, over_budget = hunk.path, "", 0, False
+        if over_budget:
+            continue
+
+        for piece in split_hunk(hunk, size):
+            if used + len(piece) > file_budget:
+                over_budget = True
+                break
+            if current and len(current) + len(piece) > size:
+                yield path, current
+                current = ""
+            current += piece
+            used += len(piece)
+
+    if current:
+        yield path, current
+
+
+"""
+Takes a refined PR record (see github/pr_store.py) and the metadata of its PR document.
+
+Returns one document per diff chunk, with the PR's metadata plus "path", at most budget
+characters of diff in total (not counting the PR/file line each chunk starts with).
+"""
+def pr_diff_documents(pr: Dict, metadata: Dict, budget: int = PR_DIFF_BUDGET_CHARS) -> List[Document]:
+    diff = pr.get("diff")
+    if not diff:
+        return []
+
+    skipped = []
+    documents = []
+    used = 0
+    title = pr.get("title") or ""
+    for path, text in pack_hunks(iter_hunks(diff, skipped)):
+        if used + len(text) > budget:
+            print(f"PR #{pr['pr_number']}: diff is over its {budget} character budget, embedding the first {used}")
+            break
+        used += len(text)
+        content = f"PR #{pr['pr_number']}: {title}\nFile: {path}\n{text}"
+        documents.append(Document(page_content=content, metadata=dict(metadata, path=path)))
+
+    if skipped:
+        print(f"PR #{pr['pr_number']}: skipped {len(skipped)} binary, vendored or generated files")
+    return documents
@@ -1,21 +1,95 @@
 from sentence_transformers import CrossEncoder
 from langchain.schema import Document
-from aggregate_documents import CROSS_ENCODER_MODEL
+from aggregate_documents import CROSS_ENCODER_MODEL, RERANK_BATCH_SIZE, RERANK_LATENCY_BUDGET, RERANK_QUANTIZE
+import threading
+import time
+import torch
+
+
+class Reranker:
+    """
+    Cross-encoder loaded once per process and shared by every query.
+
+    Candidates are scored in batches. Each query gets a latency budget: the candidate list
+    is cut to what the measured per-document cost says fits in it, and scoring stops early
+    if a batch pushes past it anyway. Candidates that didn't get scored keep their incoming
+    (fused) order after the scored ones.
+    """
+
+    def __init__(self, model_name: str = CROSS_ENCODER_MODEL, batch_size: int = RERANK_BATCH_SIZE,
+                 latency_budget: float = RERANK_LATENCY_BUDGET, quantize: bool = RERANK_QUANTIZE):
+        self.batch_size = batch_size
+        self.latency_budget = latency_budget
+        self.model = CrossEncoder(model_name, device="cpu")
+        if quantize:
+            try:
+                self.model.model = torch.quantization.quantize_dynamic(self.model.model, {torch.nn.Linear}, dtype=torch.qint8)
+            except Exception as e:
+                print(f"Could not quantize {model_name}, using full precision: {e}")
+        # Running average of seconds spent per scored document
+        self.seconds_per_document = None
+        # One forward pass at a time; concurrent passes only fight over the same CPU cores
+        self._lock = threading.Lock()
+
+    def warm(self):
+        self.rank([Document(page_content="warm up")], "warm up")
+        # The first pass pays one-off setup costs; don't let it skew the budget estimate
+        self.seconds_per_document = None
+        return self
+
+    def rank(self, documents: list[Document], query: str, latency_budget: float = None):
+        if len(documents) == 0:
+            return documents
+        budget = self.latency_budget if latency_budget is None else latency_budget
+
+        scores = []
+        with self._lock:
+            # Timed from here: waiting for the lock behind other requests isn't scoring time
+            start = time.time()
+            limit = len(documents)
+            if self.seconds_per_document:
+                limit = max(self.batch_size, int(budget / self.seconds_per_document))
+
+            for batch_start in range(0, min(limit, len(documents)), self.batch_size):
+                batch = documents[batch_start:min(batch_start + self.batch_size, limit)]
+                pairs = [(query, document.page_content) for document in batch]
+                scores.extend(self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False).tolist())
+                if time.time() - start > budget:
+                    break
+            elapsed = time.time() - start
+
+            observed = elapsed / len(scores)
+            if self.seconds_per_document is None:
+                self.seconds_per_document = observed
+            else:
+                self.seconds_per_document = 0.8 * self.seconds_per_document + 0.2 * observed
+
+        if len(scores) < len(documents):
+            print(f"Rerank budget: scored {len(scores)} of {len(documents)} candidates")
+
+        order = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        return [documents[i] for i in order] + documents[len(scores):]
+
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> Reranker:
+    """Returns the process-wide reranker, loading the model on first use."""
+    global _reranker
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = Reranker()
+    return _reranker
+
 
 """
 Reranking documents with a cross encoder based on relevance to query.
 """
 def rank_docs(documents: list[Document], query: str):
-    if len(documents) == 0:
-        return documents
-    model = CrossEncoder(CROSS_ENCODER_MODEL)
-    ranks = model.rank(query, [document.page_content for document in documents])
-
-    reordered = []
-    for rank in ranks:
-        reordered.append(documents[rank['corpus_id']])
-
-    return reordered
+    return get_reranker().rank(documents, query)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,189 @@
+"""
+Process-wide retrieval context.
+
+Holds the Chroma store, the sparse index and the embedding function so that every
+query in the process reuses the same clients instead of rebuilding them. The answer
+LLM is the pooled Gemini client owned by the LLM scheduler. Everything is opened lazily
+on first use and guarded by a lock, so Flask worker threads can share one context safely.
+
+Ingestion calls refresh() once it has written new chunks. That bumps a generation
+marker on disk and runs any registered refresh hooks; readers in other processes
+notice the new marker and reopen their Chroma handle on next use. Queries use the
+handle through reading(), and a reopen waits until no query is using the old one.
+"""
+import os
+import threading
+from contextlib import contextmanager
+from chromadb.api.client import SharedSystemClient
+from langchain_community.vectorstores.chroma import Chroma
+from langchain_openai import ChatOpenAI
+from llm_scheduler import get_llm_scheduler
+from embedding_function import get_embedding_function
+from aggregate_documents import (
+    CHROMA_PATH, SPARSE_INDEX_PATH, CHUNK_MANIFEST_PATH,
+    ANSWER_CACHE_PATH, ANSWER_CACHE_TTL, ANSWER_CACHE_SIZE, ANSWER_CACHE_SIMILARITY,
+)
+from answer_cache import AnswerCache
+from chunk_manifest import ChunkManifest
+from sparse_index import SparseIndex
+
+
+class RetrievalContext:
+    def __init__(self, persist_directory: str = CHROMA_PATH, sparse_index_path: str = SPARSE_INDEX_PATH):
+        self.persist_directory = persist_directory
+        self.sparse_index_path = sparse_index_path
+        self.generation_path = os.path.join(persist_directory, "generation")
+        self._lock = threading.RLock()
+        self._embedding_function = None
+        self._db = None
+        self._sparse_index = None
+        self._chunk_manifest = None
+        self._answer_cache = None
+        self._seen_generation = None
+        self._refresh_hooks = []
+        self._readers = 0
+        self._readers_done = threading.Condition(self._lock)
+        self._leases = threading.local()
+
+    @property
+    def embedding_function(self):
+        if self._embedding_function is None:
+            with self._lock:
+                if self._embedding_function is None:
+                    self._embedding_function = get_embedding_function()
+        return self._embedding_function
+
+    @property
+    def db(self) -> Chroma:
+        with self._lock:
+            generation = self._read_generation()
+            # A thread inside reading() keeps its handle until it is done with it
+            if self._db is not None and generation != self._seen_generation and not getattr(self._leases, "depth", 0):
+                # Another process ingested since we opened the store; drop chroma's
+                # cached system so the reopened handle sees the new segments.
+                self._reopen(generation)
+            if self._db is None:
+                self._db = Chroma(
+                    persist_directory=self.persist_directory,
+                    embedding_function=self.embedding_function,
+                )
+            self._seen_generation = generation
+            return self._db
+
+    @contextmanager
+    def reading(self):
+        """
+        Yields the Chroma handle and keeps it open until the block is done with it, so a
+        reopen triggered by another thread can't close it under an in-flight query.
+        """
+        with self._lock:
+            db = self.db
+            self._readers += 1
+            self._leases.depth = getattr(self._leases, "depth", 0) + 1
+        try:
+            yield db
+        finally:
+            with self._lock:
+                self._readers -= 1
+                self._leases.depth -= 1
+                self._readers_done.notify_all()
+
+    @property
+    def sparse_index(self) -> SparseIndex:
+        if self._sparse_index is None:
+            with self._lock:
+                if self._sparse_index is None:
+                    self._sparse_index = SparseIndex(self.sparse_index_path)
+        return self._sparse_index
+
+    @property
+    def chunk_manifest(self) -> ChunkManifest:
+        if self._chunk_manifest is None:
+            with self._lock:
+                if self._chunk_manifest is None:
+                    self._chunk_manifest = ChunkManifest(CHUNK_MANIFEST_PATH)
+        return self._chunk_manifest
+
+    @property
+    def answer_cache(self) -> AnswerCache:
+        if self._answer_cache is None:
+            with self._lock:
+                if self._answer_cache is None:
+                    self._answer_cache = AnswerCache(
+                        ANSWER_CACHE_PATH, ANSWER_CACHE_TTL, ANSWER_CACHE_SIZE, ANSWER_CACHE_SIMILARITY
+                    )
+        return self._answer_cache
+
+    @property
+    def llm(self) -> ChatOpenAI:
+        """Shared with curation; call it through get_llm_scheduler() so it is rate limited."""
+        return get_llm_scheduler().client("gemini")
+
+    def warm(self):
+        """Opens every client up front so the first request doesn't pay for it."""
+        self.db
+        self.sparse_index
+        self.llm
+        return self
+
+    def on_refresh(self, hook):
+        """Registers a callable run (with no arguments) every time refresh() is called."""
+        with self._lock:
+            self._refresh_hooks.append(hook)
+        return hook
+
+    def refresh(self):
+        """
+        Signals that the corpus changed. Bumps the on-disk generation marker and runs
+        the refresh hooks. Call this after ingestion has written to Chroma.
+        """
+        with self._lock:
+            generation = (self._read_generation() or 0) + 1
+            os.makedirs(self.persist_directory, exist_ok=True)
+            tmp_path = f"{self.generation_path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(str(generation))
+            os.replace(tmp_path, self.generation_path)
+            # Our own handle already saw the writes that triggered this refresh.
+            self._seen_generation = generation
+            hooks = list(self._refresh_hooks)
+
+        for hook in hooks:
+            try:
+                hook()
+            except Exception as e:
+                print(f"Refresh hook {getattr(hook, '__name__', hook)} failed: {e}")
+
+    def generation(self):
+        """The on-disk generation marker: changes whenever any process refreshes the corpus."""
+        return self._read_generation()
+
+    def _read_generation(self):
+        try:
+            with open(self.generation_path, "r") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return None
+
+    def _reopen(self, generation):
+        """Called with the lock held. Clearing chroma's system cache closes every handle on it."""
+        while self._readers:
+            self._readers_done.wait()
+        # Another thread may have reopened at this generation while we waited
+        if generation != self._seen_generation:
+            SharedSystemClient.clear_system_cache()
+            self._db = None
+
+
+_context = None
+_context_lock = threading.Lock()
+
+
+def get_retrieval_context() -> RetrievalContext:
+    """Returns the process-wide retrieval context, creating it on first use."""
+    global _context
+    if _context is None:
+        with _context_lock:
+            if _context is None:
+                _context = RetrievalContext()
+    return _context
@@ -0,0 +1,92 @@
+from slack_sdk import WebClient
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+from datetime import datetime
+from collections import OrderedDict
+from dotenv import load_dotenv
+import os, time, threading
+
+load_dotenv()
+slack_key = os.getenv("SLACK_KEY")
+client = WebClient(token=slack_key)
+# Wait out Slack's Retry-After on 429s instead of failing the call
+client.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=3))
+
+
+"""
+LRU cache of user display names that also expires entries after ttl seconds, so renamed
+users are picked up eventually without calling users_info for every message.
+"""
+class UserCache:
+    def __init__(self, max_entries: int = 1000, ttl: float = 60 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str):
+        with self._lock:
+            entry = self._names.get(user_id)
+            if entry is None or entry[1] < time.time():
+                return None
+            self._names.move_to_end(user_id)
+            return entry[0]
+
+    def put(self, user_id: str, name: str):
+        with self._lock:
+            self._names[user_id] = (name, time.time() + self.ttl)
+            self._names.move_to_end(user_id)
+            while len(self._names) > self.max_entries:
+                self._names.popitem(last=False)
+
+
+user_cache = UserCache()
+channel_names = {}
+
+def get_username(msg):
+    user_id = msg.get("user")
+    bot_id = msg.get("bot_id")
+    username = msg.get("username")
+
+    if user_id:
+        name = user_cache.get(user_id)
+        if name is not None:
+            return name
+        try:
+            user_info = client.users_info(user=user_id)
+            name = user_info["user"].get("real_name") or user_info["user"].get("name")
+            user_cache.put(user_id, name)
+            return name
+        except Exception:
+            return f"Unknown User ({user_id})"
+
+
+    if bot_id:
+        return f"Bot ({bot_id})"
+
+
+    if username:
+        return username
+
+
+    return "System"
+
+def get_channel_name(channel_id):
+    if channel_id not in channel_names:
+        channel_info = client.conversations_info(channel=channel_id)
+        channel_names[channel_id] = channel_info["channel"]["name"]
+    return channel_names[channel_id]
+
+def normalize_message(msg, channel_name, is_thread=False):
+    text = msg.get("text", "")
+    ts = msg.get("ts")
+    dt = datetime.fromtimestamp(float(ts))
+    username = get_username(msg)
+
+    return {
+        "user": username,
+        "text": text,
+        "timestamp": ts,
+        "datetime": dt.strftime("%Y-%m-%d %H:%M:%S"),
+        "thread": is_thread,
+        "channel": channel_name
+    }
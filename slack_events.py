@@ -0,0 +1,246 @@
+"""
+Push-based Slack ingestion: receives Events API payloads instead of polling.
+
+    python slack_events.py serve [--port 5051]
+
+serves POST /slack/events. Point the Slack app's Event Subscriptions Request URL at it and
+subscribe to message.channels (and message.groups for private channels). Requests are
+checked against SLACK_SIGNING_SECRET, and serve refuses to start without it unless
+--allow-unsigned is given (for replay and local testing only). Message events are
+acknowledged immediately and micro-batched: a batch is ingested once it has max_size
+messages or its oldest message has waited max_delay seconds, so new messages are
+searchable within seconds and nothing calls Slack while the workspace is idle.
+
+    python slack_events.py replay events.jsonl [--url ...] [--rate 20]
+
+is a local stand-in for Slack: it POSTs recorded payloads (one JSON object per line, either
+full event_callback payloads or bare message events) to the receiver, signed like Slack
+signs them.
+"""
+from flask import Flask, Blueprint, request, jsonify
+from slack_client import get_channel_name, normalize_message
+from ingest_daemon import submit
+from collections import OrderedDict
+from dotenv import load_dotenv
+import os, json, time, threading, hashlib, hmac, argparse
+import requests
+
+load_dotenv()
+SIGNING_SECRET = os.getenv("SLACK_SIGNING_SECRET")
+
+BATCH_SIZE = int(os.getenv("SLACK_EVENT_BATCH_SIZE", 50))
+
+BATCH_DELAY = float(os.getenv("SLACK_EVENT_BATCH_DELAY", 2.0))
+
+# Message subtypes that don't carry new knowledge
+IGNORED_SUBTYPES = {"message_deleted", "channel_join", "channel_leave", "channel_topic", "channel_purpose"}
+
+# Requests older than this are rejected as replays
+MAX_REQUEST_AGE = 5 * 60
+
+# Accept unsigned requests when SLACK_SIGNING_SECRET isn't set; only serve --allow-unsigned sets it
+allow_unsigned = False
+
+
+"""
+Collects items from any thread and hands them to flush(items) in batches from one
+background thread. A batch that fails is put back and retried, up to max_attempts times.
+"""
+class MicroBatcher:
+    def __init__(self, flush, max_size: int = BATCH_SIZE, max_delay: float = BATCH_DELAY, max_attempts: int = 3):
+        self.flush = flush
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._items = []
+        self._oldest = None
+        self._attempts = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, item):
+        with self._condition:
+            if not self._items:
+                self._oldest = time.monotonic()
+            self._items.append(item)
+            self._condition.notify()
+
+    def close(self):
+        """Flushes whatever is pending and stops the background thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    if self._items:
+                        wait = self._oldest + self.max_delay - time.monotonic()
+                        if len(self._items) >= self.max_size or wait <= 0:
+                            break
+                        self._condition.wait(wait)
+                    else:
+                        self._condition.wait()
+                if not self._items:
+                    return
+                batch, self._items = self._items[:self.max_size], self._items[self.max_size:]
+                self._oldest = time.monotonic() if self._items else None
+
+            try:
+                self.flush(batch)
+                self._attempts = 0
+            except Exception as e:
+                self._attempts += 1
+                if self._attempts >= self.max_attempts:
+                    print(f"Dropping batch of {len(batch)} after {self._attempts} failed attempts: {e}")
+                    self._attempts = 0
+                    continue
+                print(f"Ingesting batch of {len(batch)} failed, retrying: {e}")
+                with self._condition:
+                    self._items[:0] = batch
+                    self._oldest = time.monotonic()
+
+
+def ingest_events(events):
+    msgs = [normalize_event(event) for event in events]
+    for m in msgs:
+        print(f"[{m['datetime']}] (#{m['channel']}) {m['user']}: {m['text']}")
+    submit("slack", msgs, wait=True)
+
+
+batcher = None
+batcher_lock = threading.Lock()
+seen_events = OrderedDict()
+seen_events_lock = threading.Lock()
+
+
+def get_batcher():
+    global batcher
+    if batcher is None:
+        with batcher_lock:
+            if batcher is None:
+                batcher = MicroBatcher(ingest_events)
+    return batcher
+
+
+def verify_signature(body: bytes, timestamp: str, signature: str) -> bool:
+    if not SIGNING_SECRET:
+        return allow_unsigned
+    try:
+        if abs(time.time() - int(timestamp)) > MAX_REQUEST_AGE:
+            return False
+    except (TypeError, ValueError):
+        return False
+    return hmac.compare_digest(sign(body, timestamp), signature or "")
+
+
+def sign(body: bytes, timestamp: str) -> str:
+    base = b"v0:" + str(timestamp).encode() + b":" + body
+    return "v0=" + hmac.new(SIGNING_SECRET.encode(), base, hashlib.sha256).hexdigest()
+
+
+def first_delivery(event_id) -> bool:
+    """Slack redelivers events it didn't get a timely 200 for; drop the repeats."""
+    if not event_id:
+        return True
+    with seen_events_lock:
+        if event_id in seen_events:
+            return False
+        seen_events[event_id] = True
+        while len(seen_events) > 10000:
+            seen_events.popitem(last=False)
+    return True
+
+
+def message_event(event):
+    """The message in a message event as {"channel", "ts", "text", ...}, or None if it should be skipped."""
+    if event.get("type") != "message" or event.get("subtype") in IGNORED_SUBTYPES:
+        return None
+    channel_id = event.get("channel")
+    if event.get("subtype") == "message_changed":
+        # An edit: re-ingesting the same ts replaces the old text's chunks
+        event = event.get("message") or {}
+    if not channel_id or not event.get("ts") or not event.get("text"):
+        return None
+    return dict(event, channel=channel_id)
+
+
+def normalize_event(event):
+    # Looks up user and channel names, so it runs in the batcher rather than the request
+    is_thread = bool(event.get("thread_ts")) and event["thread_ts"] != event["ts"]
+    return normalize_message(event, get_channel_name(event["channel"]), is_thread=is_thread)
+
+
+slack_events = Blueprint("slack_events", __name__)
+
+
+@slack_events.route("/slack/events", methods=["POST"])
+def receive_event():
+    body = request.get_data()
+    if not verify_signature(body, request.headers.get("X-Slack-Request-Timestamp"), request.headers.get("X-Slack-Signature")):
+        return "invalid signature", 401
+
+    payload = json.loads(body or b"{}")
+    if payload.get("type") == "url_verification":
+        return jsonify({"challenge": payload.get("challenge")})
+
+    if payload.get("type") == "event_callback" and first_delivery(payload.get("event_id")):
+        event = message_event(payload.get("event") or {})
+        if event is not None:
+            get_batcher().add(event)
+
+    return "", 200
+
+
+def replay(path: str, url: str, rate: float):
+    with open(path, "r") as f:
+        payloads = [json.loads(line) for line in f if line.strip()]
+
+    for i, payload in enumerate(payloads):
+        if payload.get("type") == "message":
+            payload = {"type": "event_callback", "event_id": f"replay-{i}-{payload.get('ts')}", "event": payload}
+        body = json.dumps(payload).encode()
+        headers = {"Content-Type": "application/json"}
+        if SIGNING_SECRET:
+            timestamp = str(int(time.time()))
+            headers["X-Slack-Request-Timestamp"] = timestamp
+            headers["X-Slack-Signature"] = sign(body, timestamp)
+        response = requests.post(url, data=body, headers=headers)
+        if response.status_code != 200:
+            print(f"Event {i} was refused: {response.status_code} {response.text}")
+        if rate > 0:
+            time.sleep(1 / rate)
+    print(f"Replayed {len(payloads)} events")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="Receive Slack events and ingest them.")
+    serve_parser.add_argument("--port", type=int, default=5051)
+    serve_parser.add_argument("--allow-unsigned", action="store_true",
+                              help="Accept unsigned requests if SLACK_SIGNING_SECRET isn't set (local testing only).")
+    replay_parser = commands.add_parser("replay", help="POST recorded events to a running receiver.")
+    replay_parser.add_argument("path", help="JSONL file of event payloads or message events.")
+    replay_parser.add_argument("--url", default="http://localhost:5051/slack/events")
+    replay_parser.add_argument("--rate", type=float, default=20, help="Events per second, 0 for no limit.")
+    args = parser.parse_args()
+
+    if args.command == "replay":
+        replay(args.path, args.url, args.rate)
+    else:
+        if not SIGNING_SECRET:
+            if not args.allow_unsigned:
+                parser.error("SLACK_SIGNING_SECRET isn't set; set it, or pass --allow-unsigned for local testing")
+            print("Warning: SLACK_SIGNING_SECRET isn't set, accepting unsigned requests")
+            allow_unsigned = True
+        app = Flask(__name__)
+        app.register_blueprint(slack_events)
+        try:
+            app.run(port=args.port, threaded=True)
+        finally:
+            get_batcher().close()
@@ -1,73 +1,51 @@
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import numpy as np
-from langchain.schema import Document
-from aggregate_documents import get_all_documents
-import pickle
+from aggregate_documents import get_all_documents, get_documents_by_ids, total_documents
+from retrieval_context import get_retrieval_context
+from sparse_index import SparseIndex
 
 
 """
-Tfidf Vectorizer takes in string data for page content of every document
+Rebuilds the BM25 index from scratch out of every chunk in Chroma.
 
-return embeddings, the vectorizer fit to the data, and the length of the used data
+Only needed once to migrate an existing Chroma store; after that add_to_chroma keeps
+the index up to date as chunks arrive.
 """
-def generate_sparse_embeddings(documents: list[Document]):
-    content = []
-    for document in documents:
-        content.append(document.page_content)
-    vectorizer = TfidfVectorizer()
-    data_embeddings = vectorizer.fit_transform(content)
-    return data_embeddings, vectorizer, len(content)
+def rebuild_sparse_index():
+    context = get_retrieval_context()
+    documents = get_all_documents(context.db)
 
+    index = context.sparse_index
+    index.clear()
+    index.add([document.metadata["id"] for document in documents], [document.page_content for document in documents])
+    index.merge()
+    print(f"Indexed {len(index)} chunks")
+    return index
 
-"""
-Related data to sparse embeddings is stored in a pickle file
-
-pickle file has length 3 tuple:
-(data_embeddings, vectorizer, length)
-
-length is used to determine if there is any new data; if there is, regenerate Tfidf vectorizer
 
-This will be useful once there is a lot of data and generating embeddings takes a while
 """
-def load_sparse_embeddings():
-    try:
-        embeddings_and_vectorizer = pickle.load(open("sparse_embeddings.pickle", "rb"))
-        data = get_all_documents()
-        if len(data) > embeddings_and_vectorizer[2]:
-            return dump_sparse_embeddings()
-        else:
-            return embeddings_and_vectorizer[0], embeddings_and_vectorizer[1], embeddings_and_vectorizer[2]
-    except(OSError, IOError) as e:
-        return dump_sparse_embeddings()
-
-
-def dump_sparse_embeddings():
-    data_embeddings, vectorizer, length = generate_sparse_embeddings(get_all_documents())
-    pickle.dump((data_embeddings, vectorizer, length), open("sparse_embeddings.pickle", "wb"))
-    return data_embeddings, vectorizer, length
+Returns the sparse index, building it first if Chroma has chunks the index has never seen
+(e.g. a store ingested before the index existed).
+"""
+def load_sparse_index() -> SparseIndex:
+    context = get_retrieval_context()
+    index = context.sparse_index
+    if len(index) == 0:
+        with context.reading() as db:
+            chunks_in_chroma = total_documents(db)
+        if chunks_in_chroma > 0:
+            return rebuild_sparse_index()
+    return index
 
 
 def sparse_relevant_documents(query: str, num_docs: int):
-    data = get_all_documents()
-    data_embeddings, vectorizer, length = load_sparse_embeddings()
-
-    query_embedding = vectorizer.transform([query])
-
-    similarities = cosine_similarity(data_embeddings, query_embedding)
-    ranked_indices = np.argsort(similarities, axis=0)[::-1].flatten()
-    ranked_documents = [data[i] for i in ranked_indices]
-
-    final = []
-    for i in range(len(ranked_documents)):
-        if len(final) == num_docs:
-            break
-        final.append(ranked_documents[i])
+    index = load_sparse_index()
+    ranked = index.search(query, num_docs)
 
-    return final
+    with get_retrieval_context().reading() as db:
+        return get_documents_by_ids(db, [chunk_id for chunk_id, score in ranked])
 
 
 def main():
+    rebuild_sparse_index()
     documents = sparse_relevant_documents("Query relevant to documents,", 15)
 
     for doc in documents:
@@ -75,4 +53,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,362 @@
+"""
+Persistent BM25 inverted index with append-only segments.
+
+Layout under the index directory:
+    manifest.json         {"next_segment": int, "segments": [int, ...], "deleted": {chunk_id: int}}
+    seg_<n>.pickle        {"ids": [...], "lengths": [...], "postings": {term: [(doc, tf), ...]}}
+
+Every add() writes one new immutable segment. "segments" lists them oldest first, and a
+chunk id that shows up again in a later segment supersedes its older copy. delete()
+records a tombstone holding the newest segment number at the time of the delete, so
+copies in segments that existed then are dead. Dead postings are skipped at query time
+and dropped for good when their segment is merged.
+
+Merging is size-tiered: a segment's tier is the power of merge_factor its live chunk
+count falls under, and once merge_factor segments share a tier, those are merged into
+one segment of the next tier up (which may cascade). Every chunk is therefore rewritten
+about log(chunks / segment size) times over the life of the index, instead of on every
+merge, and big segments are left alone. A segment that is mostly dead
+(over max_dead_ratio) is rewritten on its own to drop its tombstoned postings.
+
+Queries only touch the posting lists of the query's terms, so their cost follows
+those lists rather than the size of the corpus.
+"""
+import fcntl
+import heapq
+import json
+import math
+import os
+import pickle
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+# Same token pattern as sklearn's TfidfVectorizer, which this index replaces.
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class SparseIndex:
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75, merge_factor: int = 8,
+                 max_dead_ratio: float = 0.5):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.merge_factor = merge_factor
+        self.max_dead_ratio = max_dead_ratio
+        self.manifest_path = os.path.join(path, "manifest.json")
+        self._lock = threading.RLock()
+        self._manifest_mtime = None
+        self._load()
+
+    def __len__(self):
+        return len(self._live)
+
+    def add(self, chunk_ids: list[str], texts: list[str]):
+        """Indexes the given chunks as a new segment. Re-adding an id replaces its old text."""
+        if not chunk_ids:
+            return
+        with self._write():
+            postings = {}
+            lengths = []
+            for doc, text in enumerate(texts):
+                counts = Counter(tokenize(text))
+                lengths.append(sum(counts.values()))
+                for term, tf in counts.items():
+                    postings.setdefault(term, []).append((doc, tf))
+
+            number = self._manifest["next_segment"]
+            segment = {"ids": list(chunk_ids), "lengths": lengths, "postings": postings}
+            self._write_segment(number, segment)
+            self._manifest["next_segment"] = number + 1
+            self._manifest["segments"].append(number)
+            self._attach(number, segment)
+
+            self._merge_tiers()
+            self._write_manifest()
+
+    def delete(self, chunk_ids: list[str]):
+        """Tombstones the given ids. Unknown ids are ignored."""
+        with self._write():
+            newest = self._manifest["next_segment"] - 1
+            for chunk_id in chunk_ids:
+                if chunk_id in self._live:
+                    self._forget(chunk_id)
+                    self._manifest["deleted"][chunk_id] = newest
+            self._merge_tiers()
+            self._write_manifest()
+
+    def clear(self):
+        with self._write():
+            self._pending_removal = list(self._manifest["segments"])
+            self._manifest["segments"] = []
+            self._manifest["deleted"] = {}
+            self._write_manifest()
+            self._reset()
+
+    def merge(self):
+        """Merges every segment into one and drops all tombstones."""
+        with self._write():
+            if len(self._manifest["segments"]) > 1 or self._manifest["deleted"]:
+                self._merge(list(self._manifest["segments"]))
+            self._write_manifest()
+
+    def search(self, query: str, k: int) -> list[tuple[str, float]]:
+        """Returns up to k (chunk_id, score) pairs, best first."""
+        with self._lock:
+            self.reload_if_stale()
+            if not self._live:
+                return []
+
+            n = len(self._live)
+            avgdl = self._total_length / n
+            scores = {}
+            for term in set(tokenize(query)):
+                matches = self._term_matches(term)
+                if not matches:
+                    continue
+
+                idf = self._idf(n, len(matches))
+                for chunk_id, tf, length in matches:
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + self._term_score(idf, tf, length, avgdl)
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def text_scorer(self, texts: list[str]):
+        """
+        Returns score(query) giving the BM25 score of each text that shares a term with query,
+        using the index's current statistics. The texts are tokenized once up front so the
+        scorer is cheap to call for many queries.
+        """
+        lengths = []
+        postings = {}
+        for i, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((i, tf))
+
+        def score(query: str) -> list[float]:
+            with self._lock:
+                self.reload_if_stale()
+                n = len(self._live)
+                avgdl = self._total_length / n if n else 1.0
+                terms = [term for term in set(tokenize(query)) if term in postings]
+                idfs = {term: self._idf(n, len(self._term_matches(term))) for term in terms}
+
+            scores = {}
+            for term, idf in idfs.items():
+                for i, tf in postings[term]:
+                    scores[i] = scores.get(i, 0.0) + self._term_score(idf, tf, lengths[i], avgdl)
+            return list(scores.values())
+
+        return score
+
+    def _term_matches(self, term: str) -> list[tuple[str, int, int]]:
+        """(chunk_id, tf, doc length) for every live posting of term."""
+        matches = []
+        for number, segment in self._segments.items():
+            ids = segment["ids"]
+            lengths = segment["lengths"]
+            for doc, tf in segment["postings"].get(term, ()):
+                chunk_id = ids[doc]
+                if self._live.get(chunk_id) == (number, doc):
+                    matches.append((chunk_id, tf, lengths[doc]))
+        return matches
+
+    def _idf(self, n: int, df: int) -> float:
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def _term_score(self, idf: float, tf: int, length: int, avgdl: float) -> float:
+        return idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avgdl))
+
+    def reload_if_stale(self):
+        """Picks up segments written by another process since we last loaded."""
+        with self._lock:
+            if self._read_manifest_mtime() != self._manifest_mtime:
+                self._load()
+
+    def _load(self):
+        with self._lock:
+            loaded = getattr(self, "_segments", {})
+            while True:
+                mtime = self._read_manifest_mtime()
+                try:
+                    self._load_manifest(loaded)
+                    self._manifest_mtime = mtime
+                    return
+                except FileNotFoundError:
+                    # A writer in another process merged the segments this manifest lists and
+                    # removed them; it replaces the manifest before removing anything, so a
+                    # newer manifest is in place. Anything else is a damaged index.
+                    if self._read_manifest_mtime() == mtime:
+                        raise
+
+    def _load_manifest(self, loaded: dict):
+        """Rebuilds the live set from the manifest, reusing segments already in memory (they never change)."""
+        self._reset()
+        try:
+            with open(self.manifest_path, "r") as f:
+                self._manifest = json.load(f)
+        except (OSError, ValueError):
+            self._manifest = {"next_segment": 1, "segments": [], "deleted": {}}
+
+        for number in self._manifest["segments"]:
+            segment = loaded.get(number)
+            if segment is None:
+                with open(self._segment_path(number), "rb") as f:
+                    segment = pickle.load(f)
+            self._attach(number, segment)
+
+        for chunk_id, deleted_at in self._manifest["deleted"].items():
+            location = self._live.get(chunk_id)
+            if location is not None and location[0] <= deleted_at:
+                self._forget(chunk_id)
+
+    def _reset(self):
+        self._segments = {}
+        self._live = {}
+        self._live_counts = {}
+        self._total_length = 0
+
+    def _attach(self, number: int, segment: dict):
+        self._segments[number] = segment
+        self._live_counts[number] = 0
+        for doc, chunk_id in enumerate(segment["ids"]):
+            if chunk_id in self._live:
+                self._forget(chunk_id)
+            self._live[chunk_id] = (number, doc)
+            self._live_counts[number] += 1
+            self._total_length += segment["lengths"][doc]
+
+    def _forget(self, chunk_id: str):
+        number, doc = self._live.pop(chunk_id)
+        self._live_counts[number] -= 1
+        self._total_length -= self._segments[number]["lengths"][doc]
+
+    def _tier(self, number: int) -> int:
+        live = max(self._live_counts[number], 1)
+        tier = 0
+        while live >= self.merge_factor:
+            live //= self.merge_factor
+            tier += 1
+        return tier
+
+    def _merge_tiers(self):
+        """Applies the merge policy (see the module docstring) until nothing is left to merge."""
+        for number in list(self._manifest["segments"]):
+            total = len(self._segments[number]["ids"])
+            if total and (total - self._live_counts[number]) / total > self.max_dead_ratio:
+                self._merge([number])
+
+        while True:
+            tiers = {}
+            for number in self._manifest["segments"]:
+                tiers.setdefault(self._tier(number), []).append(number)
+            full = [numbers for numbers in tiers.values() if len(numbers) >= self.merge_factor]
+            if not full:
+                return
+            self._merge(min(full, key=lambda numbers: self._tier(numbers[0]))[:self.merge_factor])
+
+    def _merge(self, numbers: list[int]):
+        """
+        Replaces the given segments with one holding just their live chunks. The new segment
+        takes the place of the newest of them in "segments": none of its chunks has a newer
+        copy anywhere (it wouldn't be live otherwise), and older dead copies still load first.
+        """
+        merging = set(numbers)
+        postings = {}
+        ids = []
+        lengths = []
+        remap = {}
+        for number in numbers:
+            segment = self._segments[number]
+            for doc, chunk_id in enumerate(segment["ids"]):
+                if self._live.get(chunk_id) == (number, doc):
+                    remap[(number, doc)] = len(ids)
+                    ids.append(chunk_id)
+                    lengths.append(segment["lengths"][doc])
+
+            for term, entries in segment["postings"].items():
+                for doc, tf in entries:
+                    merged_doc = remap.get((number, doc))
+                    if merged_doc is not None:
+                        postings.setdefault(term, []).append((merged_doc, tf))
+        for entries in postings.values():
+            entries.sort()
+
+        segments = self._manifest["segments"]
+        last = max(segments.index(old) for old in numbers)
+        replacement = []
+        if ids:
+            number = self._manifest["next_segment"]
+            merged = {"ids": ids, "lengths": lengths, "postings": postings}
+            self._write_segment(number, merged)
+            self._manifest["next_segment"] = number + 1
+            replacement = [number]
+        segments = [old for old in segments[:last] if old not in merging] + replacement + segments[last + 1:]
+        self._manifest["segments"] = segments
+
+        for old in numbers:
+            del self._segments[old]
+            del self._live_counts[old]
+        if ids:
+            self._segments[number] = merged
+            self._live_counts[number] = len(ids)
+            for doc, chunk_id in enumerate(ids):
+                self._live[chunk_id] = (number, doc)
+
+        # A tombstone only matters while a segment that existed when it was written is left
+        oldest = min(segments, default=self._manifest["next_segment"])
+        self._manifest["deleted"] = {chunk_id: deleted_at for chunk_id, deleted_at in self._manifest["deleted"].items()
+                                     if deleted_at >= oldest}
+        # Old segments go only after the new manifest is in place, see _write().
+        self._pending_removal.extend(numbers)
+
+    @contextmanager
+    def _write(self):
+        """Serializes writers across threads and processes and reloads first."""
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock, open(os.path.join(self.path, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.reload_if_stale()
+                self._pending_removal = []
+                yield
+                for number in self._pending_removal:
+                    self._remove_segment(number)
+                self._pending_removal = []
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_manifest(self):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+        self._manifest_mtime = self._read_manifest_mtime()
+
+    def _write_segment(self, number: int, segment: dict):
+        path = self._segment_path(number)
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump(segment, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    def _remove_segment(self, number: int):
+        try:
+            os.remove(self._segment_path(number))
+        except FileNotFoundError:
+            pass
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.path, f"seg_{number:06d}.pickle")
+
+    def _read_manifest_mtime(self):
+        try:
+            return os.stat(self.manifest_path).st_mtime_ns
+        except OSError:
+            return None
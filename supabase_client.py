@@ -1,8 +1,11 @@
 import os
 from supabase import create_client, Client
 from dotenv import load_dotenv
-import psycopg2
+import threading
 from typing import Iterable, Union
+from aggregate_documents import DOCS_SNAPSHOT_PATH
+from docs_snapshot import DocsSnapshot
+from docs_executor import PostgresBackend, SQLiteBackend, SupabaseRpcBackend, validate_statements
 
 
 load_dotenv()
@@ -12,48 +15,81 @@ SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-def get_docs_structure():
-    """Fetches all collections, pages, and their blocks from Supabase and formats them into a structured string."""
-    try:
-        response = supabase.from_("collections").select("*, pages(*, page_blocks(*))").execute()
-        data = response.data
-        
-        if not data:
-            return "No documentation found."
-
-        output = []
-        for collection in data:
-            collection_info = {k: v for k, v in collection.items() if k != 'pages'}
-            output.append(f"Collection: {collection_info}")
-            
-            if collection.get('pages'):
-                # Sort pages by position
-                sorted_pages = sorted(collection['pages'], key=lambda p: p.get('position', 0))
-                for page in sorted_pages:
-                    page_info = {k: v for k, v in page.items() if k != 'page_blocks'}
-                    output.append(f"  Page: {page_info}")
-                    
-                    if page.get('page_blocks'):
-                        # Sort blocks by position
-                        sorted_blocks = sorted(page['page_blocks'], key=lambda b: b.get('position', 0))
-                        for block in sorted_blocks:
-                            output.append(f"    Block: {block}")
-            output.append("-" * 20)
-        
-        return "\n".join(output)
-        
-    except Exception as e:
-        print(f"Error fetching docs structure: {e}")
+_backend = None
+_snapshot = None
+_docs_lock = threading.Lock()
+
+
+def get_docs_backend():
+    """
+    The database curation SQL runs against: Postgres over a connection pool if DOCS_DATABASE_URL
+    is set, a local sqlite stand-in if DOCS_SQLITE_PATH is set, otherwise Supabase's execute_sql RPC.
+    """
+    global _backend
+    if _backend is None:
+        with _docs_lock:
+            if _backend is None:
+                if os.getenv("DOCS_DATABASE_URL"):
+                    _backend = PostgresBackend(os.getenv("DOCS_DATABASE_URL"))
+                elif os.getenv("DOCS_SQLITE_PATH"):
+                    _backend = SQLiteBackend(os.getenv("DOCS_SQLITE_PATH"))
+                else:
+                    _backend = SupabaseRpcBackend(supabase)
+    return _backend
+
+
+def get_docs_snapshot() -> DocsSnapshot:
+    """Returns the process-wide docs snapshot. Call sync() on it before reading."""
+    global _snapshot
+    if _snapshot is None:
+        backend = get_docs_backend()
+        with _docs_lock:
+            if _snapshot is None:
+                _snapshot = DocsSnapshot(DOCS_SNAPSHOT_PATH, backend.fetch_tables, backend.fetch_version)
+    return _snapshot
+
+
+def get_docs_structure(page_ids=None, collection_ids=None):
+    """
+    Formats collections, pages, and their blocks into a structured string, from the local
+    snapshot (refetched from Supabase only when the docs version changed).
+    Returns None if there is neither a snapshot nor a way to fetch one.
+    """
+    snapshot = get_docs_snapshot()
+    if not snapshot.sync():
         return None
+    return snapshot.render(page_ids=page_ids, collection_ids=collection_ids)
+
 
+"""
+Validates queries locally, dry-running them on the docs snapshot, then executes the valid ones
+as a single transaction.
 
+Returns one {"query", "status", "details"?} per query, in order. status is "success",
+"rejected" (failed validation, never sent) or "error" (the transaction was rolled back).
+"""
 def execute_documentation_changes(queries: Iterable[Union[str, dict]]):
-    results = []
-    for item in queries:
-        sql = item
+    queries = list(queries)
+    snapshot = get_docs_snapshot()
+    snapshot.sync()
+    accepted, rejected = validate_statements(queries, snapshot.tables)
+
+    error = None
+    if accepted:
         try:
-            supabase.rpc("execute_sql", {"query": sql}).execute()
-            results.append({"query": sql, "status": "success"})
+            version = get_docs_backend().execute_batch(accepted)
         except Exception as e:
-            results.append({"query": sql, "status": "error", "details": str(e)})
-    return results
\ No newline at end of file
+            error = f"transaction rolled back: {e}"
+            snapshot.mark_dirty()
+        else:
+            snapshot.apply(accepted, version)
+
+    results = []
+    for index, sql in enumerate(queries):
+        if index in rejected:
+            results.append({"query": sql, "status": "rejected", "details": rejected[index]})
+        elif error is not None:
+            results.append({"query": sql, "status": "error", "details": error})
+        else:
+            results.append({"query": sql, "status": "success"})
+    return results
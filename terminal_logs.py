@@ -0,0 +1,194 @@
+"""
+Incremental reading of the `script` session logs oterm/oterm.sh writes to oterm/logs.
+
+terminal_offsets.json:
+    {path: {"offset": int, "size": int, "inode": int}}
+
+offset is where the next read of the log starts. Logs are only ever appended to, so a log whose
+size and inode are unchanged is skipped without opening it, and a changed one is read from
+offset on, in blocks, one complete line at a time. A log that shrank or was replaced is read
+again from the start.
+
+Lines have their terminal control sequences stripped and carriage returns/backspaces applied
+as the terminal would have drawn them, then are split into records at shell prompts: a
+record is the command typed at a prompt plus the output that follows it. A record's page is
+the byte offset its prompt starts at, so it is its own (source, page) unit. The last record
+of a log might still be growing (a command that is running, or a session that is still
+open), so the next read starts over at its prompt and re-ingests it, which replaces its
+chunks; only a "Script done" trailer closes it for good.
+"""
+import json
+import os
+import re
+from typing import Dict, Iterator, List, Tuple
+from aggregate_documents import TERMINAL_OFFSETS_PATH, TERMINAL_PROMPT_PATTERN, TERMINAL_OUTPUT_CHARS
+
+READ_BLOCK_SIZE = 1 << 20
+
+# CSI (colors, cursor movement), OSC (window titles; possibly unterminated at the end of a
+# line), DCS/PM/APC strings, charset selection and the remaining two-character escapes
+CONTROL_SEQUENCE = re.compile(
+    r"\x1b\[[0-?]*[ -/]*[@-~]"
+    r"|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\|$)"
+    r"|\x1b[PX^_][^\x1b]*(?:\x1b\\|$)"
+    r"|\x1b[()*+][0-9A-Za-z]"
+    r"|\x1b[@-Z\\-_=>78]"
+)
+
+# Control characters left over once the line is rendered (tab is kept)
+CONTROL_CHARACTERS = re.compile(r"[\x00-\x08\x0b-\x1f\x7f]")
+
+PROMPT = re.compile(TERMINAL_PROMPT_PATTERN)
+
+
+def strip_control_sequences(line: str) -> str:
+    return CONTROL_SEQUENCE.sub("", line)
+
+
+def render_line(line: str) -> str:
+    """Applies \\r and \\b the way the terminal did, so redrawn text (progress bars, line editing) shows once."""
+    if "\r" not in line and "\b" not in line:
+        return CONTROL_CHARACTERS.sub("", line)
+    cells = []
+    column = 0
+    for char in line:
+        if char == "\r":
+            column = 0
+        elif char == "\b":
+            column = max(column - 1, 0)
+        else:
+            if column < len(cells):
+                cells[column] = char
+            else:
+                cells.append(char)
+            column += 1
+    return CONTROL_CHARACTERS.sub("", "".join(cells))
+
+
+"""
+Reads path from offset and yields (start, end, text) for every complete line: the byte
+offsets the line spans and its text with control sequences stripped. A last line without a
+newline yet is left for the next read.
+"""
+def read_lines(path: str, offset: int = 0, block_size: int = READ_BLOCK_SIZE) -> Iterator[Tuple[int, int, str]]:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        carry = b""
+        position = offset
+        while True:
+            block = f.read(block_size)
+            if not block:
+                return
+            data = carry + block
+            lines = data.split(b"\n")
+            carry = lines.pop()
+            for raw in lines:
+                end = position + len(raw) + 1
+                text = raw.decode("utf-8", errors="replace").rstrip("\r")
+                yield position, end, render_line(strip_control_sequences(text))
+                position = end
+
+
+class Record:
+    def __init__(self, start: int, command: str):
+        self.start = start
+        self.end = start
+        self.command = command
+        self.output = []
+        self.output_chars = 0
+        self.dropped_lines = 0
+        self.closed = False
+
+    def add_output(self, text: str, max_chars: int):
+        if self.dropped_lines or self.output_chars + len(text) > max_chars:
+            self.dropped_lines += 1
+            return
+        self.output.append(text)
+        self.output_chars += len(text) + 1
+
+    def text(self) -> str:
+        output = "\n".join(self.output).strip("\n")
+        if self.dropped_lines:
+            output += f"\n[... {self.dropped_lines} more lines of output]"
+        if self.command:
+            return f"$ {self.command}\n{output}".rstrip("\n")
+        return output
+
+
+def split_records(lines: Iterator[Tuple[int, int, str]], prompt: re.Pattern = PROMPT,
+                  max_output_chars: int = TERMINAL_OUTPUT_CHARS) -> Iterator[Record]:
+    """
+    Groups lines into records at every prompt. Output before the first prompt gets a record
+    with no command. Every record but the last is closed.
+    """
+    record = None
+    for start, end, text in lines:
+        if text.startswith("Script started on"):
+            continue
+        if text.startswith("Script done on"):
+            if record is not None:
+                record.closed = True
+                yield record
+                record = None
+            continue
+
+        match = prompt.match(text)
+        if match:
+            if record is not None:
+                record.closed = True
+                yield record
+            record = Record(start, (match.group("command") or "").strip())
+        else:
+            if record is None:
+                record = Record(start, "")
+            record.add_output(text, max_output_chars)
+        record.end = end
+
+    if record is not None:
+        yield record
+
+
+def load_offsets(path: str = TERMINAL_OFFSETS_PATH) -> Dict[str, dict]:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_offsets(offsets: Dict[str, dict], path: str = TERMINAL_OFFSETS_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(offsets, f)
+    os.replace(tmp_path, path)
+
+
+def log_changed(path: str, entry: dict) -> bool:
+    stat = os.stat(path)
+    return entry is None or stat.st_size != entry.get("size") or stat.st_ino != entry.get("inode")
+
+
+"""
+Reads what is new in a log since entry (its terminal_offsets.json entry, or None).
+
+Returns (records, new entry, from_start): the records that start at or after the old
+offset, and whether the log was read from the beginning, in which case everything
+previously ingested from it should be replaced.
+"""
+def read_new_records(path: str, entry: dict = None) -> Tuple[List[Record], dict, bool]:
+    stat = os.stat(path)
+    offset = entry.get("offset", 0) if entry else 0
+    from_start = entry is None or stat.st_ino != entry.get("inode") or stat.st_size < offset
+    if from_start:
+        offset = 0
+
+    records = list(split_records(read_lines(path, offset)))
+    if records and not records[-1].closed:
+        # Read the possibly unfinished last record again next time
+        next_offset = records[-1].start
+    elif records:
+        next_offset = records[-1].end
+    else:
+        next_offset = offset
+    return records, {"offset": next_offset, "size": stat.st_size, "inode": stat.st_ino}, from_start
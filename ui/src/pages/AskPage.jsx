@@ -8,27 +8,56 @@ const AskPage = () => {
   const [input, setInput] = useState('');
   const [events, setEvents] = useState([]);
   const [isLoading, setIsLoading] = useState(false);
+  const [isStreaming, setIsStreaming] = useState(false);
 
   // ✅ new state for timeline width toggle
   const [isWideTimeline, setIsWideTimeline] = useState(false);
 
-  const handleSend = async () => {
+  const handleSend = () => {
     if (input.trim()) {
       const userMessage = input;
       setMessages([...messages, { role: 'user', content: userMessage }]);
       setInput('');
       setIsLoading(true);
-      
-      try {
-        const response = await fetch(`http://localhost:5050/output?query=${encodeURIComponent(userMessage)}`);
-        const data = await response.json();
-        setMessages(msgs => [...msgs, { role: 'assistant', content: data.response }]);
-        setEvents(data.docs);
-      } catch (error) {
-        setMessages(msgs => [...msgs, { role: 'assistant', content: 'Error fetching response.' }]);
-      } finally {
+
+      // Sources arrive as soon as retrieval finishes, then the answer streams in token by token.
+      const source = new EventSource(`http://localhost:5050/output/stream?query=${encodeURIComponent(userMessage)}`);
+      let started = false;
+
+      const appendToAnswer = (text) => {
+        const first = !started;
+        started = true;
+        setMessages(msgs => {
+          if (first) {
+            return [...msgs, { role: 'assistant', content: text }];
+          }
+          const last = msgs[msgs.length - 1];
+          return [...msgs.slice(0, -1), { ...last, content: last.content + text }];
+        });
+      };
+
+      const finish = () => {
+        source.close();
+        setIsLoading(false);
+        setIsStreaming(false);
+      };
+
+      source.addEventListener('docs', (e) => {
+        setEvents(JSON.parse(e.data));
+      });
+      source.addEventListener('token', (e) => {
         setIsLoading(false);
-      }
+        setIsStreaming(true);
+        appendToAnswer(JSON.parse(e.data));
+      });
+      source.addEventListener('done', finish);
+      source.addEventListener('error', (e) => {
+        if (!started) {
+          started = true;
+          setMessages(msgs => [...msgs, { role: 'assistant', content: 'Error fetching response.' }]);
+        }
+        finish();
+      });
     }
   };
 
@@ -88,10 +117,10 @@ const AskPage = () => {
               />
               <button
                 onClick={handleSend}
-                disabled={isLoading}
+                disabled={isLoading || isStreaming}
                 className="px-4 py-2 rounded-md bg-primary text-primary-foreground hover:bg-primary/90 flex-shrink-0 disabled:opacity-50 disabled:cursor-not-allowed"
               >
-                {isLoading ? 'Sending...' : 'Send'}
+                {isLoading || isStreaming ? 'Sending...' : 'Send'}
               </button>
             </div>
           </div>